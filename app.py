@@ -1,26 +1,24 @@
 import ast
-import glob
-import os
-import uuid
-from typing import List
+import json
+import time
 
-import gnpsdata
 import pandas as pd
-from gnpsdata import workflow_fbmn
 from streamlit.components.v1 import html
 
-import massql_launch
 from utils import (
-    download_and_filter_mgf,
-    filter_mgf_by_scans,
-    highlight_hydroxy,
+    highlight_classification,
     MassQLQueries,
     bile_acid_tree,
     add_df_and_filtering,
+    get_derived_results,
     get_git_short_rev,
+    get_result_cache,
+    get_job_queue,
 )
-from tree_plotter import create_custom_tree
-from tree_classifier import check_classification_paths
+from job_queue import DONE, FAILED, JOB_RESULTS_KIND, QUEUED, Job
+from pipeline import RESULT_VIEW_COLUMNS, process_results, table_digest
+from result_cache import text_digest
+from tree_plotter import create_aggregated_tree, create_custom_tree
 import streamlit as st
 
 
@@ -31,6 +29,10 @@ stage2 = massql_queries.stage2
 mono_queries = massql_queries.mono_queries
 di_queries = massql_queries.di_queries
 tri_queries = massql_queries.tri_queries
+# Identifies the analysis definition, part of the persistent cache keys
+analysis_digest = text_digest(json.dumps([ALL_MASSQL_QUERIES, bile_acid_tree], sort_keys=True))
+# Bump when the cached bundle of result tables changes shape
+TABLES_FORMAT_VERSION = 3
 
 # Set page configuration
 page_title = "Multi-Step MassQL Bile Acid Isomer Annotation"
@@ -61,90 +63,32 @@ html(
 )
 
 
-def process_results(
-    massql_results_df: List, library_matches: pd.DataFrame, all_scans: List[str]
-):
-    """
-    Process results and include scans without library matches in full_table output.
-
-    Args:
-        massql_results_df: List of MassQL results
-        library_matches: DataFrame with library matches
-        all_scans: List of all scan numbers as strings
-    """
-
-    # Process MassQL results
-    all_query_results_df = pd.DataFrame(massql_results_df)
-    all_query_results_df["scan_list"] = all_query_results_df["scan_list"].apply(
-        lambda x: ast.literal_eval(x) if isinstance(x, str) else x
-    )
-    all_query_results_df = all_query_results_df.explode("scan_list")
-    all_query_results_df = all_query_results_df.rename(
-        columns={"scan_list": "#Scan#", "query": "query_validation"}
-    )
+# Seconds between two job status checks while an analysis is running
+JOB_POLL_SECONDS = 2
+JOB_STAGE_LABELS = {
+    "download": "Downloading library matches...",
+    "stage1": "Downloading files and running Stage 1 queries...",
+    "stage2": "Running MassQL for filtered scans... This may take a while, please be patient!",
+}
 
-    with st.spinner("Merging results..."):
-        # Ensure consistent data types
-        all_query_results_df["#Scan#"] = all_query_results_df["#Scan#"].astype(str)
-        library_matches["#Scan#"] = library_matches["#Scan#"].astype(str)
 
-        # Create complete scan list DataFrame
-        all_scans_df = pd.DataFrame({"#Scan#": [str(scan) for scan in all_scans]})
-
-        # Merge everything: all_scans -> library_matches -> query_results
-        full_table = all_scans_df.merge(library_matches, on="#Scan#", how="left").merge(
-            all_query_results_df, on="#Scan#", how="left"
-        )
-
-        # Fill missing values
-        full_table["query_validation"] = full_table["query_validation"].fillna(
-            "Did not pass stage1 filtering"
-        )
-
-        # Library matches only (existing functionality)
-        library_matches_only = library_matches.merge(
-            all_query_results_df, on="#Scan#", how="left"
-        )
-
-        # Reorder columns and aggregate
-        cols = ["query_validation", "Compound_Name"] + [
-            col
-            for col in full_table.columns
-            if col not in ["query_validation", "Compound_Name"]
-        ]
-        full_table = full_table[cols]
-
-        # Group by scan and aggregate
-        full_table = full_table.groupby("#Scan#", as_index=False).agg(
-            {
-                "query_validation": lambda x: ";".join(set(x.dropna())),
-                **{
-                    col: "first"
-                    for col in full_table.columns
-                    if col not in ["#Scan#", "query_validation"]
-                },
-            }
-        )
-
-    return library_matches_only, full_table, all_query_results_df
-
-
-def cleanup_massql_files():
-    feather_files = glob.glob("temp_mgf/*.feather")
-    for file in feather_files:
-        try:
-            os.remove(file)
-        except Exception as e:
-            st.warning(f"Could not delete {file}: {e}")
+def show_job_progress(job: Job):
+    """Status of a queued or running analysis job."""
+    st.title("🔢 Multi-step MassQL Results")
+    if job.status == QUEUED:
+        position = get_job_queue().queue_position(job.job_id)
+        st.info(f"Task {job.task_id} is queued, {position} analyses ahead of it. This page updates automatically.")
+        return
+    st.info(f"Analysing task {job.task_id}. You can close this page and come back with the same URL.")
+    st.progress(job.progress, text=JOB_STAGE_LABELS.get(job.stage, "Starting..."))
+    if job.message:
+        st.caption(job.message)
 
 
 def load_example_data():
     st.session_state.library_matches = pd.read_csv(
         "examples/example_library_matches.csv", dtype=str
     )
-    st.session_state.all_query_results_df = pd.read_csv(
-        "examples/example_all_results.csv", dtype=str
-    )
     st.session_state.full_table = pd.read_csv(
         "examples/example_lib_and_query_results.csv", dtype=str
     ).fillna("No match")
@@ -154,22 +98,6 @@ def load_example_data():
         st.session_state.all_scans = [line.strip() for line in f]
 
 
-def get_bile_acids_classifications(results_df, exclude_string: str):
-    passed_queries = results_df[
-        ~results_df["query_validation"].str.contains(exclude_string, case=False)
-    ]
-    passed_queries["classification"] = passed_queries["query_validation"].apply(
-        lambda x: check_classification_paths(str(x).split(";"), bile_acid_tree)[
-            "satisfied_paths"
-        ]
-    )
-    filtered_classifications = passed_queries[
-        passed_queries["classification"].apply(lambda x: bool(x))
-    ]
-
-    return filtered_classifications
-
-
 task_id_value = st.query_params.get('task_id', '')
 
 with st.sidebar:
@@ -181,6 +109,13 @@ with st.sidebar:
         task_id_value = "4e5f76ebc4c6481aba4461356f20bc35"
 
     task_id = st.text_input("FBMN task ID:", value=task_id_value, disabled=load_example)
+    full_query_evaluation = st.checkbox(
+        "Evaluate all queries on all scans",
+        value=False,
+        key="full_query_evaluation",
+        help="Debug option. By default each query only runs on the scans that passed its parent "
+             "query in the bile acid tree.",
+    )
 
     col1, col2 = st.columns(2)
     with col1:
@@ -195,6 +130,8 @@ with st.sidebar:
         ):
             # Reset the session state
             st.session_state.clear()
+            if "job_id" in st.query_params:
+                del st.query_params["job_id"]
             st.session_state.load_example_checkbox = False
             st.rerun()
 
@@ -217,92 +154,151 @@ with st.sidebar:
         unsafe_allow_html=True,
     )
 
-if not run_query and "run_query_done" not in st.session_state:
+# A running analysis job survives reruns and browser refreshes (through the URL)
+active_job_id = st.session_state.get("job_id") or st.query_params.get("job_id")
+
+if not run_query and "run_query_done" not in st.session_state and not active_job_id:
     from welcome import welcome_page
 
     welcome_page()
 
-if run_query:
-    st.session_state["run_query_done"] = True
-    if not load_example:
-        with st.spinner("Downloading files..."):
-            library_matches = workflow_fbmn.get_library_match_dataframe(task_id)
-            cleaned_mgf_path, all_mgf_scans = download_and_filter_mgf(task_id)
-            mgf_path = cleaned_mgf_path
-
-        with st.spinner("Running Stage 1 queries..."):
-            stage1_all_results = massql_launch.run_massql(mgf_path, queries_dict=stage1)
-            stage1_results_df = pd.DataFrame(stage1_all_results)
-            # create a new mgf filtering to just maintain the scans that passed stage1
-            scans_to_keep = set(sum(stage1_results_df["scan_list"], []))
-            stage1_passed_mgf = filter_mgf_by_scans(
-                mgf_path,
-                f"temp_mgf/{task_id}_stg1_passed.mgf",
-                scans_to_keep,
-            )
 
-        with st.spinner(
-            "Running MassQL for filtered scans... This may take a while, please be patient!"
-        ):
-            container = st.empty()
-            with container:
-                # Run all queries for the filtered data
-                massql_results_df = massql_launch.run_massql(
-                    stage1_passed_mgf, ALL_MASSQL_QUERIES
-                )
+def store_table_digests():
+    """Digests of the result tables in the session, part of the key of get_derived_results."""
+    st.session_state["full_table_digest"] = table_digest(st.session_state["full_table"])
+    st.session_state["library_matches_digest"] = table_digest(st.session_state["only_library_matches"])
 
-        cleanup_massql_files()
-
-    else:
-        # this function stores the static result file dataframes in st.session_state, just as above.
-        load_example_data()
-        all_mgf_scans = st.session_state.get("all_scans")
-        massql_results_df = st.session_state.get("massql_results_df")
-        library_matches = st.session_state.get("library_matches")
 
+def store_result_tables(massql_results_df, library_matches, all_mgf_scans, tables_key: str = None):
+    """Build the result tables, keep them in the session state and in the result cache (with tables_key)."""
     with st.spinner("Processing tables..."):
         (
             only_library_matches,
             full_table,
-            all_query_results_df,
+            query_hit_matrix,
         ) = process_results(massql_results_df, library_matches, all_mgf_scans)
 
         # #TODO:remove later (saving example files)
         # pd.DataFrame(massql_results_df).to_csv('examples/example_massql_results_after_stg1.csv', index=False)
         # full_table.to_csv('example_lib_and_query_results.csv', index=False)
         # only_library_matches.to_csv('example_library_matches.csv', index=False)
-        # all_query_results_df.to_csv('example_all_results.csv', index=False)
 
         # Store results in session state
         st.session_state["only_library_matches"] = only_library_matches
         st.session_state["full_table"] = full_table
-        st.session_state["all_query_results_df"] = all_query_results_df
+        st.session_state["query_hit_matrix"] = query_hit_matrix
+        store_table_digests()
+        st.session_state["run_query_done"] = True
+
+        if tables_key is not None:
+            get_result_cache().put_pickle(
+                "tables",
+                tables_key,
+                {
+                    "only_library_matches": only_library_matches,
+                    "full_table": full_table,
+                    "query_hit_matrix": query_hit_matrix,
+                },
+            )
 
 
-if run_query or st.session_state.get("run_query_done"):
-    st.title("🔢 Multi-step MassQL Results")
-    only_library_matches = st.session_state["only_library_matches"]
-    full_table = st.session_state["full_table"]
-    full_table["Compound_Name"] = full_table["Compound_Name"].fillna("No match")
+def forget_job():
+    st.session_state.pop("job_id", None)
+    if "job_id" in st.query_params:
+        del st.query_params["job_id"]
 
-    filtered_classifications = get_bile_acids_classifications(
-        full_table, exclude_string="did not pass"
-    )
-    if len(filtered_classifications) > 0:
-        feature_ids_dict = filtered_classifications[["#Scan#", "Compound_Name"]].astype(
-            str
+
+if run_query:
+    result_cache = get_result_cache()
+    forget_job()
+    active_job_id = None
+    st.session_state.pop("query_report", None)
+    if load_example:
+        # this function stores the static result file dataframes in st.session_state
+        load_example_data()
+        store_result_tables(
+            st.session_state.get("massql_results_df"),
+            st.session_state.get("library_matches"),
+            st.session_state.get("all_scans"),
         )
-        feature_ids_dict = feature_ids_dict.set_index("#Scan#")[
-            "Compound_Name"
-        ].to_dict()
-        feature_ids_dict = dict(
-            sorted(feature_ids_dict.items(), key=lambda item: item[1])
+    else:
+        # Final tables of a task only depend on the query set, the tree and the evaluation mode
+        tables_key = result_cache.key(task_id, analysis_digest, full_query_evaluation, TABLES_FORMAT_VERSION)
+        cached_tables = result_cache.get_pickle("tables", tables_key)
+        if cached_tables is not None:
+            st.session_state.update(cached_tables)
+            store_table_digests()
+            st.session_state["run_query_done"] = True
+        else:
+            # The analysis runs in a job worker, sessions asking for the same analysis share the job
+            st.session_state.pop("run_query_done", None)
+            job = get_job_queue().submit(
+                task_id,
+                {
+                    "queries": ALL_MASSQL_QUERIES,
+                    "tree": bile_acid_tree,
+                    "full_evaluation": full_query_evaluation,
+                },
+                dedup_key=tables_key,
+            )
+            active_job_id = st.session_state["job_id"] = job.job_id
+            st.query_params["job_id"] = job.job_id
+
+if active_job_id:
+    job = get_job_queue().get(active_job_id)
+    if job is None:
+        forget_job()
+    elif job.status == DONE:
+        forget_job()
+        job_outputs = get_result_cache().get_pickle(JOB_RESULTS_KIND, job.result_key)
+        if job_outputs is None:
+            # The results were evicted from the cache before this session read them
+            job = get_job_queue().submit(job.task_id, job.params, dedup_key=job.dedup_key)
+            st.session_state["job_id"] = job.job_id
+            st.query_params["job_id"] = job.job_id
+            st.rerun()
+        store_result_tables(
+            job_outputs["massql_results"],
+            job_outputs["library_matches"],
+            job_outputs["all_scans"],
+            tables_key=job.dedup_key,
         )
+        st.session_state["query_report"] = job_outputs.get("query_report")
+    elif job.status == FAILED:
+        forget_job()
+        st.error(f"The analysis of task {job.task_id} failed: {job.error}")
+        st.stop()
     else:
+        show_job_progress(job)
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
+
+
+if st.session_state.get("run_query_done"):
+    st.title("🔢 Multi-step MassQL Results")
+    query_report = st.session_state.get("query_report")
+    if query_report is not None:
+        with st.expander(query_report.summary()):
+            st.dataframe(query_report.to_frame(), hide_index=True)
+    if "library_matches_digest" not in st.session_state:
+        store_table_digests()
+    # Classifications and merged tables are computed once per result, not on every rerun
+    derived_results = get_derived_results(
+        st.session_state["full_table_digest"],
+        st.session_state["library_matches_digest"],
+        st.session_state.get("query_hit_matrix") is not None,
+        st.session_state["full_table"],
+        st.session_state["only_library_matches"],
+        st.session_state.get("query_hit_matrix"),
+    )
+    full_table = derived_results["full_table"]
+    filtered_classifications = derived_results["classifications"]
+    feature_ids_dict = derived_results["feature_ids"]
+    if len(filtered_classifications) == 0:
         st.warning(
             "No classifications retrieved for this task ID. Inspect the full table below for details"
         )
-        st.write(full_table)
+        add_df_and_filtering(full_table, key_prefix="full")
         st.stop()
 
     viz_tab, class_tab, lib_tab, full_tab = st.tabs(
@@ -314,9 +310,12 @@ if run_query or st.session_state.get("run_query_done"):
         ]
     )
 
-    default_cols = ["#Scan#", "Compound_Name", "classification"]
+    default_cols = RESULT_VIEW_COLUMNS
 
     with viz_tab:
+        st.subheader("Classification Overview")
+        st.plotly_chart(create_aggregated_tree(filtered_classifications["classification"]))
+
         st.subheader("Feature Classification")
         selected_feature = st.selectbox(
             f"Select a feature : :blue-badge[{len(feature_ids_dict)} of {len(full_table)}]",
@@ -325,9 +324,7 @@ if run_query or st.session_state.get("run_query_done"):
         )
         fid = selected_feature.split(":")[0]
 
-        validation_lists = filtered_classifications[
-            filtered_classifications["#Scan#"] == fid
-        ]["classification"].values[0]
+        validation_lists = derived_results["classification_by_scan"][fid]
 
         if isinstance(validation_lists, list):
             if len(validation_lists) >= 2:
@@ -347,12 +344,12 @@ if run_query or st.session_state.get("run_query_done"):
             st.plotly_chart(ba_tree_fig)
 
     with class_tab:
-        class_df = add_df_and_filtering(
+        add_df_and_filtering(
             filtered_classifications,
             key_prefix="class_table",
             default_cols=default_cols,
+            style=highlight_classification,
         )
-        st.dataframe(class_df.style.apply(highlight_hydroxy, subset=['classification']))
         with st.expander("How to interpret this table"):
             st.markdown(
                 """
@@ -362,27 +359,7 @@ if run_query or st.session_state.get("run_query_done"):
             )
 
     with lib_tab:
-        only_library_matches = only_library_matches.merge(
-            filtered_classifications[["#Scan#", "classification"]],
-            on="#Scan#",
-            how="left",
-        )
-        only_library_matches = only_library_matches[
-            default_cols
-            + [col for col in only_library_matches.columns if col not in default_cols]
-        ]
-        library_df = add_df_and_filtering(only_library_matches, key_prefix="lib_matches")
-        st.dataframe(library_df)
+        add_df_and_filtering(derived_results["library_matches_view"], key_prefix="lib_matches")
 
     with full_tab:
-        full_table = full_table.merge(
-            filtered_classifications[["#Scan#", "classification"]],
-            on="#Scan#",
-            how="left",
-        )
-        full_table = full_table[
-            default_cols
-            + [col for col in full_table.columns if col not in default_cols]
-        ]
-        full_df = add_df_and_filtering(full_table, key_prefix="full")
-        st.dataframe(full_df)
+        add_df_and_filtering(derived_results["full_table_view"], key_prefix="full")
@@ -0,0 +1,232 @@
+"""
+Annotate many FBMN tasks or local MGF files without the Streamlit app.
+
+Every input goes through the same pipeline as the app (stage 1, the classification tree
+queries, process_results and the bile acid classification). The tables of each input are
+written to OUTPUT_DIR/<task id or MGF name>/, OUTPUT_DIR/summary.csv lists all inputs and
+OUTPUT_DIR/classifications.<format> merges the ones that succeeded. A local MGF can come
+with its library matches in a .tsv or .csv file of the same name. Examples:
+
+    python batch_annotate.py 4e5f76ebc4c6481aba4461356f20bc35 --output-dir results
+    python batch_annotate.py --inputs-file task_ids.txt --parallel 4 --format csv
+    python batch_annotate.py data/*.mgf --parallel 2 --workers 2
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import yaml
+
+import pipeline
+from result_cache import ResultCache
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_FORMATS = ("parquet", "csv")
+NO_CLASSIFICATION = "did not pass"
+
+
+def read_inputs(inputs: list, inputs_file: str = None) -> list:
+    """
+    Task ids and MGF paths from the command line and from inputs_file (one per line, # comments).
+
+    Raises:
+        ValueError: If two different inputs would write to the same output directory, e.g.
+            MGFs with the same file name in different directories.
+    """
+    inputs = list(inputs)
+    if inputs_file:
+        with open(inputs_file, "r") as f:
+            inputs.extend(line.split("#")[0].strip() for line in f)
+    # Keep the order, drop blank lines and repeated inputs (the same MGF however its path is written)
+    unique_inputs = {}
+    for value in inputs:
+        if value:
+            unique_inputs.setdefault(os.path.abspath(value) if is_mgf_input(value) else value, value)
+    inputs = list(unique_inputs.values())
+
+    sources_by_name = {}
+    for source in inputs:
+        sources_by_name.setdefault(input_name(source), []).append(source)
+    clashes = [sources for sources in sources_by_name.values() if len(sources) > 1]
+    if clashes:
+        raise ValueError("Inputs with the same output directory name: "
+                         + "; ".join(", ".join(sources) for sources in clashes))
+    return inputs
+
+
+def is_mgf_input(source: str) -> bool:
+    return source.lower().endswith(".mgf")
+
+
+def input_name(source: str) -> str:
+    """Name of the output directory of an input, the task id or the MGF file name."""
+    return os.path.splitext(os.path.basename(source))[0] if is_mgf_input(source) else source
+
+
+def load_local_library_matches(mgf_path: str) -> pd.DataFrame:
+    """Library matches next to a local MGF (same name, .tsv or .csv), empty if there are none."""
+    stem = os.path.splitext(mgf_path)[0]
+    for extension, separator in ((".tsv", "\t"), (".csv", ",")):
+        if os.path.exists(stem + extension):
+            return pd.read_csv(stem + extension, sep=separator)
+    return pd.DataFrame(columns=pipeline.LIBRARY_MATCH_COLUMNS)
+
+
+def write_table(df: pd.DataFrame, path: str, output_format: str) -> str:
+    """Write df to path + the extension of output_format."""
+    path = f"{path}.{output_format}"
+    if output_format == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+def _with_classification(df: pd.DataFrame, classifications: pd.DataFrame) -> pd.DataFrame:
+    """df with the classification column of its scans, first columns like the app's tables."""
+    default_cols = ["#Scan#", "Compound_Name", "classification"]
+    df = df.merge(classifications[["#Scan#", "classification"]], on="#Scan#", how="left")
+    return df[default_cols + [col for col in df.columns if col not in default_cols]]
+
+
+def annotate(source: str, output_dir: str, queries_dict: dict, classification_tree: dict,
+             output_format: str = "parquet", full_evaluation: bool = False, workers: int = 1,
+             cache_dir: str = None, compact: bool = None) -> dict:
+    """
+    Run the whole analysis for one task id or MGF file and write its tables.
+
+    Returns:
+        dict: Summary row of the input (scans, classified scans, per category counts,
+            run time), with status "failed" and the error if the analysis raised.
+    """
+    start = time.perf_counter()
+    name = input_name(source)
+    summary = {"input": source, "name": name, "status": "ok", "error": ""}
+    try:
+        local_mgf = source if is_mgf_input(source) else None
+        outputs = pipeline.run_analysis(
+            name,
+            queries_dict,
+            classification_tree,
+            full_evaluation=full_evaluation,
+            result_cache=ResultCache(cache_dir),
+            workers=workers,
+            mgf_path=local_mgf,
+            library_matches=load_local_library_matches(local_mgf) if local_mgf else None,
+            compact=compact,
+        )
+        only_library_matches, full_table, query_hit_matrix = pipeline.process_results(
+            outputs["massql_results"], outputs["library_matches"], outputs["all_scans"]
+        )
+        full_table["Compound_Name"] = full_table["Compound_Name"].fillna("No match")
+        classifications = pipeline.get_bile_acids_classifications(
+            full_table, NO_CLASSIFICATION, classification_tree, query_hit_matrix
+        )
+
+        task_dir = os.path.join(output_dir, name)
+        os.makedirs(task_dir, exist_ok=True)
+        write_table(classifications, os.path.join(task_dir, "classifications"), output_format)
+        write_table(_with_classification(only_library_matches, classifications),
+                    os.path.join(task_dir, "library_matches"), output_format)
+        write_table(_with_classification(full_table, classifications),
+                    os.path.join(task_dir, "full_table"), output_format)
+        # Which queries were evaluated again and which came from the result cache
+        outputs["query_report"].to_frame().to_csv(os.path.join(task_dir, "query_report.csv"), index=False)
+
+        summary["recomputed_queries"] = len(outputs["query_report"].computed)
+        summary["recompute_seconds"] = round(outputs["query_report"].computed_seconds, 2)
+        summary["scans"] = len(full_table)
+        summary["scans_with_hits"] = int(
+            (~full_table["query_validation"].str.contains(NO_CLASSIFICATION, case=False)).sum()
+        )
+        summary["classified"] = len(classifications)
+        summary["chimeric"] = int(classifications["classification"].apply(len).ge(2).sum())
+        for category in classification_tree:
+            summary[category] = int(classifications["classification"].apply(
+                lambda paths: any(path[0] == category for path in paths)
+            ).sum())
+    except Exception as e:
+        logging.getLogger(__name__).exception(f"Annotation of {source} failed")
+        summary.update(status="failed", error=f"{type(e).__name__}: {e}")
+    summary["seconds"] = round(time.perf_counter() - start, 2)
+    return summary
+
+
+def merge_classifications(output_dir: str, names: list, output_format: str) -> pd.DataFrame:
+    """Classification tables of the given inputs in one table, with a "task" column."""
+    tables = []
+    for name in names:
+        path = os.path.join(output_dir, name, f"classifications.{output_format}")
+        if os.path.exists(path):
+            table = pd.read_parquet(path) if output_format == "parquet" else pd.read_csv(path)
+            table.insert(0, "task", name)
+            tables.append(table)
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=["task"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="*", help="FBMN task ids and/or local .mgf files")
+    parser.add_argument("--inputs-file", help="File with one task id or MGF path per line")
+    parser.add_argument("--output-dir", default="batch_results", help="Directory the tables are written to")
+    parser.add_argument("--format", default="parquet", choices=OUTPUT_FORMATS, help="Format of the tables")
+    parser.add_argument("--parallel", type=int, default=1, help="Number of inputs analysed at the same time")
+    parser.add_argument("--workers", type=int, default=1, help="MassQL worker processes per input")
+    parser.add_argument("--queries", default=os.path.join(ROOT, "massql_queries.yaml"), help="MassQL queries YAML")
+    parser.add_argument("--tree", default=os.path.join(ROOT, "bile_acid_tree.yaml"), help="Classification tree YAML")
+    parser.add_argument("--full-evaluation", action="store_true", help="Evaluate all queries on all scans")
+    parser.add_argument("--compact", action="store_true", default=None,
+                        help="Strip the peaks no query uses before stage 2 (default: MASSQL_COMPACT)")
+    parser.add_argument("--cache-dir", help="Result cache directory, defaults to MASSQL_CACHE_DIR or ./cache")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    try:
+        inputs = read_inputs(args.inputs, args.inputs_file)
+    except ValueError as e:
+        parser.error(str(e))
+    if not inputs:
+        parser.error("no task ids or MGF files given")
+    with open(args.queries, "r") as f:
+        queries_dict = yaml.safe_load(f)["ALL_MASSQL_QUERIES"]
+    with open(args.tree, "r") as f:
+        classification_tree = yaml.safe_load(f)
+    os.makedirs(args.output_dir, exist_ok=True)
+    pipeline.reclaim_orphans(ResultCache(args.cache_dir))
+
+    annotate_args = (args.output_dir, queries_dict, classification_tree, args.format, args.full_evaluation,
+                     args.workers, args.cache_dir, args.compact)
+    summaries = []
+    if args.parallel > 1 and len(inputs) > 1:
+        with ProcessPoolExecutor(max_workers=args.parallel) as executor:
+            futures = {executor.submit(annotate, source, *annotate_args): source for source in inputs}
+            for future in as_completed(futures):
+                summaries.append(future.result())
+                logging.info(f"[{len(summaries)}/{len(inputs)}] {futures[future]}: {summaries[-1]['status']} "
+                             f"in {summaries[-1]['seconds']} s")
+    else:
+        for source in inputs:
+            summaries.append(annotate(source, *annotate_args))
+            logging.info(f"[{len(summaries)}/{len(inputs)}] {source}: {summaries[-1]['status']} "
+                         f"in {summaries[-1]['seconds']} s")
+
+    # Summary rows in input order, whatever order the inputs finished in
+    order = {source: position for position, source in enumerate(inputs)}
+    summary = pd.DataFrame(sorted(summaries, key=lambda row: order[row["input"]])).convert_dtypes()
+    summary.to_csv(os.path.join(args.output_dir, "summary.csv"), index=False)
+    # Failed inputs can have the tables of an earlier run in their directory, they are left out
+    names = summary.loc[summary["status"] == "ok", "name"].tolist()
+    write_table(merge_classifications(args.output_dir, names, args.format),
+                os.path.join(args.output_dir, "classifications"), args.format)
+
+    failed = int((summary["status"] != "ok").sum())
+    logging.info(f"Annotated {len(inputs) - failed} of {len(inputs)} inputs, results in {args.output_dir}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
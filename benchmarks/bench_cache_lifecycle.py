@@ -0,0 +1,169 @@
+"""
+Check the lifecycle of the result cache: byte budget, pinning, orphans and usage counters.
+
+Fills a cache with a small byte budget and checks that the least recently used entries go
+first and usage() does not change their order, that entries pinned by ResultCache.use (in
+this process or another one) survive eviction until the run ends, that the temporary
+directories and feather files of crashed runs are reclaimed, and that usage() reports the
+same counts. Scan lists stored from the callbacks of MassQL worker processes must belong to
+the run as well. Then times a full eviction pass over --entries entries. Example:
+
+    python benchmarks/bench_cache_lifecycle.py --entries 5000
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import massql_launch  # noqa: E402
+import pipeline  # noqa: E402
+from result_cache import ResultCache  # noqa: E402
+from synthetic_mgf import write_synthetic_mgf  # noqa: E402
+
+ENTRY_BYTES = 64 * 1024
+
+
+def fill(size: int):
+    def writer(directory):
+        with open(os.path.join(directory, "data.bin"), "wb") as f:
+            f.write(b"\0" * size)
+    return writer
+
+
+def hold_entry(cache_dir: str, key: str, pinned, release):
+    """Pin an entry from another process until release is set."""
+    cache = ResultCache(cache_dir, max_bytes=10 ** 12)
+    with cache.use("other process"):
+        cache.get("blob", key)
+        pinned.set()
+        release.wait()
+
+
+def report(name: str, ok: bool):
+    print(f"{name:<36} {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+def check_lifecycle(tmp_dir: str) -> bool:
+    cache_dir = os.path.join(tmp_dir, "cache")
+    # Room for ten entries and their task files
+    cache = ResultCache(cache_dir, max_bytes=10 * ENTRY_BYTES + 1024)
+    keys = [cache.key("entry", number) for number in range(10)]
+    for number, key in enumerate(keys):
+        cache.put("blob", key, fill(ENTRY_BYTES))
+        os.utime(cache.entry_path("blob", key), (number, number))
+    ok = True
+    cache.usage()
+    ok &= report("usage keeps the LRU order",
+                 [os.stat(cache.entry_path("blob", key)).st_mtime for key in keys] == list(range(10)))
+    cache.get("blob", keys[0])
+
+    # Entry 1 is pinned and the least recently used, 2 and 3 go instead, entry 0 was just read
+    with cache.use("this process"):
+        cache.get("blob", keys[1])
+        os.utime(cache.entry_path("blob", keys[1]), (1, 1))
+        cache.put("blob", cache.key("entry", 10), fill(ENTRY_BYTES))
+        cache.put("blob", cache.key("entry", 11), fill(ENTRY_BYTES))
+        exists = [os.path.isdir(cache.entry_path("blob", key)) for key in keys]
+        ok &= report("LRU eviction, pinned entry kept", exists[1] and not exists[2] and not exists[3] and exists[0])
+        usage = cache.usage()
+        ok &= report("usage while pinned", usage["in_use"] == 3 and usage["tasks"]["this process"]["entries"] == 2)
+    cache.put("blob", cache.key("entry", 12), fill(ENTRY_BYTES))
+    ok &= report("unpinned entry evicted afterwards", not os.path.isdir(cache.entry_path("blob", keys[1])))
+    ok &= report("budget respected", cache.usage()["bytes"] <= cache.max_bytes)
+
+    context = multiprocessing.get_context("spawn")
+    pinned, release = context.Event(), context.Event()
+    process = context.Process(target=hold_entry, args=(cache_dir, keys[4], pinned, release), daemon=True)
+    process.start()
+    pinned.wait(60)
+    os.utime(cache.entry_path("blob", keys[4]), (4, 4))
+    for number in range(13, 25):
+        cache.put("blob", cache.key("entry", number), fill(ENTRY_BYTES))
+    ok &= report("entry pinned by another process kept", os.path.isdir(cache.entry_path("blob", keys[4])))
+    release.set()
+    process.join()
+    cache.put("blob", cache.key("entry", 25), fill(ENTRY_BYTES))
+    ok &= report("and evicted once the process ended", not os.path.isdir(cache.entry_path("blob", keys[4])))
+
+    before = cache.usage()
+    stale = cache.scratch_dir()
+    os.utime(stale, (0, 0))
+    fresh = cache.scratch_dir()
+    with cache.partial_dir("blob", cache.key("crashed download")) as partial:
+        os.utime(partial, (0, 0))
+    feather_file = os.path.join(massql_launch.FEATHER_DIR, "crashed_run.feather")
+    with open(feather_file, "wb") as f:
+        f.write(b"\0" * ENTRY_BYTES)
+    usage = pipeline.reclaim_orphans(cache)
+    reclaimed = usage["reclaimed_orphans"] - before["reclaimed_orphans"]
+    ok &= report("orphans reclaimed", not os.path.exists(stale) and not os.path.exists(partial)
+                 and not os.path.exists(feather_file) and os.path.exists(fresh) and reclaimed == 3)
+    ok &= report("eviction counts", usage["evicted_entries"] == 16 and usage["skipped_in_use"] == 14
+                 and usage["evicted_bytes"] >= 16 * ENTRY_BYTES)
+    return ok
+
+
+def check_worker_callbacks(tmp_dir: str) -> bool:
+    """Scan lists stored by QueryExecutor callbacks on the thread of a worker pool."""
+    with open(os.path.join(ROOT, "massql_queries.yaml")) as f:
+        queries = yaml.safe_load(f)["ALL_MASSQL_QUERIES"]
+    queries = dict(list(queries.items())[:4])
+    mgf_path = os.path.join(tmp_dir, "workers.mgf")
+    write_synthetic_mgf(mgf_path, 200, bile_acid_fraction=0.5)
+    cache = ResultCache(os.path.join(tmp_dir, "cache_workers"), max_bytes=10 ** 12)
+    fast_path = os.environ.get(massql_launch.FASTPATH_ENV_VAR)
+    # MassQL queries go to the worker processes
+    os.environ[massql_launch.FASTPATH_ENV_VAR] = "0"
+    try:
+        with cache.use("worker run"):
+            massql_launch.run_massql(mgf_path, queries, workers=2, result_cache=cache, task_id="worker run")
+            usage = cache.usage()
+    finally:
+        massql_launch.remove_feather_cache(mgf_path)
+        if fast_path is None:
+            os.environ.pop(massql_launch.FASTPATH_ENV_VAR, None)
+        else:
+            os.environ[massql_launch.FASTPATH_ENV_VAR] = fast_path
+    scan_lists = usage["kinds"]["scan_list"]["entries"]
+    return report("worker results tagged and pinned", scan_lists == len(queries)
+                  and usage["tasks"]["worker run"]["entries"] == usage["entries"] == usage["in_use"])
+
+
+def time_eviction(tmp_dir: str, entries: int):
+    cache = ResultCache(os.path.join(tmp_dir, "cache_timing"), max_bytes=10 ** 12)
+    for number in range(entries):
+        cache.put("blob", cache.key(number), fill(1024))
+    cache.max_bytes = entries * 1024 // 2
+    start = time.perf_counter()
+    removed = cache.evict()
+    print(f"evict {removed} of {entries} entries: {time.perf_counter() - start:.2f} s")
+    start = time.perf_counter()
+    cache.usage()
+    print(f"usage of {entries - removed} entries: {time.perf_counter() - start:.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=2000, help="Number of entries of the eviction timing")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    os.chdir(ROOT)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ok = check_lifecycle(tmp_dir)
+        ok &= check_worker_callbacks(tmp_dir)
+        time_eviction(tmp_dir, args.entries)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
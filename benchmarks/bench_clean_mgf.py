@@ -0,0 +1,100 @@
+"""
+Benchmark the streaming MGF cleaner against the previous readlines() implementation.
+
+Each implementation runs in its own subprocess so that the reported peak RSS is not
+polluted by the other one. Example:
+
+    python benchmarks/bench_clean_mgf.py --spectra 200000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mgf_processing import clean_mgf  # noqa: E402
+from synthetic_mgf import write_synthetic_mgf  # noqa: E402
+
+
+def legacy_clean_mgf(input_mgf_path, output_mgf_path):
+    """The implementation download_and_filter_mgf used before the streaming cleaner."""
+    with open(input_mgf_path, "r") as mgf_file:
+        lines = mgf_file.readlines()
+    cleaned_mgf_lines = []
+    inside_scan = False
+    current_scan = []
+    for line in lines:
+        if line.startswith("BEGIN IONS"):
+            inside_scan = True
+            current_scan = [line]
+        elif line.startswith("END IONS"):
+            current_scan.append(line)
+            if any(
+                    len(peak.split()) == 2
+                    and all(part.replace(".", "", 1).isdigit() for part in peak.split())
+                    for peak in current_scan
+            ):
+                cleaned_mgf_lines.extend(current_scan)
+            inside_scan = False
+        elif inside_scan:
+            current_scan.append(line)
+        else:
+            cleaned_mgf_lines.append(line)
+    with open(output_mgf_path, "w") as fout:
+        fout.writelines(cleaned_mgf_lines)
+    scans_list = []
+    with open(output_mgf_path, "r") as mgf_file:
+        for line in mgf_file:
+            if line.startswith("SCANS="):
+                scans_list.append(line.strip().split("=")[1])
+    return scans_list
+
+
+def _run_worker(mode, input_path, output_path):
+    start = time.perf_counter()
+    if mode == "streaming":
+        scans = clean_mgf(input_path, output_path)
+    else:
+        scans = legacy_clean_mgf(input_path, output_path)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{elapsed} {peak_rss_mb} {len(scans)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--spectra", type=int, default=100000, help="Number of synthetic spectra")
+    parser.add_argument("--peaks", type=int, default=60, help="Peaks per spectrum")
+    parser.add_argument("--skip-legacy", action="store_true", help="Only run the streaming cleaner")
+    parser.add_argument("--worker", nargs=3, metavar=("MODE", "INPUT", "OUTPUT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        _run_worker(*args.worker)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, "synthetic_all.mgf")
+        size_bytes = write_synthetic_mgf(input_path, args.spectra, peaks_per_spectrum=args.peaks)
+        size_mb = size_bytes / 1024 / 1024
+        print(f"Synthetic MGF: {args.spectra} spectra, {size_mb:.1f} MB")
+
+        modes = ["streaming"] if args.skip_legacy else ["streaming", "legacy"]
+        for mode in modes:
+            output_path = os.path.join(tmp_dir, f"{mode}_cleaned.mgf")
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", mode, input_path, output_path],
+                check=True, capture_output=True, text=True,
+            ).stdout.split()
+            elapsed, peak_rss_mb, n_scans = float(out[0]), float(out[1]), int(out[2])
+            print(f"{mode:>10}: {elapsed:6.2f} s  {size_mb / elapsed:7.1f} MB/s  "
+                  f"peak RSS {peak_rss_mb:7.1f} MB  kept {n_scans} scans")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Check that compacting the stage 2 input (spectrum_compaction.py) does not change any result.
+
+The stage 1 passed MGF is written once as is and once compacted. Every query of
+massql_queries.yaml is then run on both files, with MassQL and with the vectorised
+engine (on the compacted SpectrumStore too), and the scan lists must be identical.
+Prints the peaks kept and the timings, exits with 1 on any difference. Example:
+
+    python benchmarks/bench_compaction.py --spectra 5000
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import massql_launch  # noqa: E402
+from spectrum_compaction import compact_mgf, compact_store, compaction_windows  # noqa: E402
+from spectrum_store import SpectrumStore  # noqa: E402
+from synthetic_mgf import write_synthetic_mgf  # noqa: E402
+
+
+def run_all(mgf_path: str, queries: dict, fast_path: bool, store: SpectrumStore = None):
+    """(scan lists, seconds) of all queries on all scans of mgf_path."""
+    os.environ[massql_launch.FASTPATH_ENV_VAR] = "1" if fast_path else "0"
+    start = time.perf_counter()
+    results = massql_launch.run_massql(mgf_path, queries, workers=1, store=store)
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mgf", help="Raw MGF file, a synthetic one is generated if omitted")
+    parser.add_argument("--spectra", type=int, default=3000, help="Number of synthetic spectra")
+    parser.add_argument("--skip-massql", action="store_true", help="Only compare the vectorised engine")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with open(os.path.join(ROOT, "massql_queries.yaml")) as f:
+        queries = yaml.safe_load(f)["ALL_MASSQL_QUERIES"]
+    stage1 = {key: value for key, value in queries.items() if "stage1" in key.lower()}
+    windows = compaction_windows(queries)
+    if windows is None:
+        print("Some queries are not supported by the vectorised engine, nothing can be compacted")
+        return 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_mgf = os.path.join(tmp_dir, "raw.mgf")
+        if args.mgf:
+            shutil.copy(args.mgf, raw_mgf)
+        else:
+            write_synthetic_mgf(raw_mgf, args.spectra, bile_acid_fraction=0.5)
+        passed_mgf = os.path.join(tmp_dir, "passed.mgf")
+        _, _, store = massql_launch.run_stage1_inline(raw_mgf, os.path.join(tmp_dir, "cleaned.mgf"), stage1,
+                                                      passed_mgf)
+
+        start = time.perf_counter()
+        compact_path = os.path.join(tmp_dir, "compact.mgf")
+        total_peaks, kept_peaks = compact_mgf(passed_mgf, compact_path, windows)
+        compacted = compact_store(store, windows)
+        compact_time = time.perf_counter() - start
+        print(f"{len(store)} spectra passed stage 1, kept {kept_peaks} of {total_peaks} peaks "
+              f"({os.path.getsize(compact_path) / max(os.path.getsize(passed_mgf), 1):.0%} of the file size) "
+              f"in {compact_time:.2f} s")
+
+        identical = True
+        parsed = SpectrumStore.from_ms2_df(massql_launch.load_spectra(compact_path)[1])
+        for column in ("scans", "precmz", "offsets", "mz", "intensity", "intensity_norm"):
+            if not np.array_equal(getattr(parsed, column), getattr(compacted, column)):
+                print(f"Compacted MGF and compacted store differ in {column}")
+                identical = False
+
+        runs = [("vectorised, store", True, store, compacted), ("vectorised, MGF", True, None, None)]
+        if not args.skip_massql:
+            runs.append(("MassQL", False, None, None))
+        for label, fast_path, full_store, compact_store_ in runs:
+            expected, full_time = run_all(passed_mgf, queries, fast_path, full_store)
+            actual, compact_run_time = run_all(compact_path, queries, fast_path, compact_store_)
+            differing = [a["query"] for a, b in zip(expected, actual) if sorted(a["scan_list"]) != sorted(b["scan_list"])]
+            identical &= not differing
+            print(f"{label:<20} full {full_time:7.2f} s  compacted {compact_run_time:7.2f} s  "
+                  f"{'identical' if not differing else 'DIFFERENT: ' + ', '.join(differing)}")
+
+        for mgf_path in (passed_mgf, compact_path):
+            massql_launch.remove_feather_cache(mgf_path)
+    os.environ[massql_launch.FASTPATH_ENV_VAR] = "1"
+    return 0 if identical else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Compare the codecs of the intermediate files (MASSQL_COMPRESSION) by wall time and bytes written.
+
+For every available codec the pipeline steps that write MGFs run on a fresh result cache:
+storing the raw MGF (as a download does), cleaning it, the fused clean + stage 1 pass,
+copying the stage 1 passed scans, compacting them and loading them into MassQL; the
+results are pickled like the job results. Every codec must give the same passed scans
+and the same MassQL dataframes. The bytes written include the fragment index and the
+spectrum stores, which stay uncompressed (they are memory-mapped). Example:
+
+    python benchmarks/bench_compression.py --spectra 20000
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import compression  # noqa: E402
+import massql_launch  # noqa: E402
+import pipeline  # noqa: E402
+from result_cache import ResultCache, file_digest  # noqa: E402
+from synthetic_mgf import write_synthetic_mgf  # noqa: E402
+
+
+def directory_bytes(path: str, mgf_only: bool = False) -> int:
+    return sum(os.path.getsize(os.path.join(dir_path, name))
+               for dir_path, _, names in os.walk(path) for name in names
+               if not mgf_only or ".mgf" in name)
+
+
+def run_codec(mgf_path: str, mgf_digest: str, queries: dict, cache_dir: str) -> (dict, dict):
+    """Time the steps with the codec set in the environment. Returns (step -> seconds, outputs)."""
+    cache = ResultCache(cache_dir)
+    stage1 = pipeline.stage1_queries(queries)
+    timings = {}
+
+    start = time.perf_counter()
+    stored_mgf = compression.compressed_path(os.path.join(cache_dir, "all.mgf"))
+    with open(mgf_path, "rb") as infile, compression.open_write(stored_mgf) as outfile:
+        shutil.copyfileobj(infile, outfile, compression.COPY_BUFFER_SIZE)
+    timings["store raw"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pipeline.clean_and_index_mgf(stored_mgf, mgf_digest, cache)
+    timings["clean"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cleaned_mgf, _, _, _, stage1_store = pipeline.prefilter_mgf(stored_mgf, mgf_digest, stage1, cache)
+    timings["clean + stage 1"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    passed_mgf = pipeline.write_stage1_passed_mgf(cleaned_mgf, stage1_store, stage1, mgf_digest, cache)
+    timings["copy passed"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compact_mgf, _ = pipeline.compact_stage2_input(passed_mgf, None, queries, stage1, mgf_digest, cache)
+    timings["compact"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        _, ms2_df = massql_launch.load_spectra(compact_mgf)
+    finally:
+        massql_launch.remove_feather_cache(compact_mgf)
+    timings["MassQL load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cache.put_pickle("job_results", cache.key("benchmark"), {"ms2_df": ms2_df})
+    timings["pickle results"] = time.perf_counter() - start
+
+    with compression.open_read(passed_mgf) as f:
+        passed_content = f.read()
+    return timings, {"passed": passed_content, "ms2_df": ms2_df}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mgf", help="Raw MGF file, a synthetic one is generated if omitted")
+    parser.add_argument("--spectra", type=int, default=10000, help="Number of synthetic spectra")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    with open(os.path.join(ROOT, "massql_queries.yaml")) as f:
+        queries = yaml.safe_load(f)["ALL_MASSQL_QUERIES"]
+
+    codec_env = os.environ.get(compression.COMPRESSION_ENV_VAR)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mgf_path = os.path.join(tmp_dir, "input.mgf")
+        if args.mgf:
+            shutil.copy(args.mgf, mgf_path)
+        else:
+            write_synthetic_mgf(mgf_path, args.spectra, bile_acid_fraction=0.5)
+        mgf_digest = file_digest(mgf_path)
+        print(f"MGF: {os.path.getsize(mgf_path) / 1024 ** 2:.1f} MB")
+
+        reference = None
+        try:
+            # Untimed, the first run also compiles the queries
+            os.environ[compression.COMPRESSION_ENV_VAR] = "none"
+            run_codec(mgf_path, mgf_digest, queries, os.path.join(tmp_dir, "cache_warmup"))
+            for codec in compression.available_codecs():
+                os.environ[compression.COMPRESSION_ENV_VAR] = codec
+                cache_dir = os.path.join(tmp_dir, f"cache_{codec}")
+                timings, outputs = run_codec(mgf_path, mgf_digest, queries, cache_dir)
+                if reference is None:
+                    reference = outputs
+                identical = (outputs["passed"] == reference["passed"]
+                             and outputs["ms2_df"].equals(reference["ms2_df"]))
+                steps = "  ".join(f"{step} {seconds:.2f}" for step, seconds in timings.items())
+                print(f"{codec:>5}: {sum(timings.values()):6.2f} s  "
+                      f"{directory_bytes(cache_dir) / 1024 ** 2:7.1f} MB written, "
+                      f"{directory_bytes(cache_dir, mgf_only=True) / 1024 ** 2:6.1f} MB of MGFs  "
+                      f"{'identical' if identical else 'DIFFERENT RESULTS'}\n       {steps}")
+        finally:
+            if codec_env is None:
+                os.environ.pop(compression.COMPRESSION_ENV_VAR, None)
+            else:
+                os.environ[compression.COMPRESSION_ENV_VAR] = codec_env
+
+
+if __name__ == "__main__":
+    main()
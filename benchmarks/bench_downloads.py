@@ -0,0 +1,207 @@
+"""
+Check resumable downloads and measure the streamed download + stage 1 of a task.
+
+A local HTTP server stands in for GNPS2 (MASSQL_GNPS_URL points at it). It serves a
+synthetic MGF and library matches with Range / If-Range support, throttled to
+--rate MB/s and dropping every connection after --drop-mb MB.
+
+Checks that the download survives the dropped connections and a .part file left by an
+earlier attempt, and that a wrong checksum is rejected. Then times the previous order
+(download the library matches, download the MGF, then clean it and run stage 1) against
+run_analysis, which fetches the library matches alongside the MGF and runs stage 1 while
+it arrives, and checks that its results are identical to the analysis of the local file.
+Example:
+
+    python benchmarks/bench_downloads.py --spectra 20000 --rate 5 --drop-mb 4
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import downloads  # noqa: E402
+import pipeline  # noqa: E402
+from result_cache import ResultCache  # noqa: E402
+from synthetic_mgf import write_synthetic_mgf  # noqa: E402
+
+TASK_ID = "benchmark"
+SEND_BLOCK = 64 * 1024
+
+
+def make_handler(files: dict, rate: float, drop_bytes: int, requests_log: list):
+    """Request handler serving files (name -> bytes) like the resultfile endpoint of GNPS2."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            name = parse_qs(urlparse(self.path).query).get("file", [""])[0]
+            if name not in files:
+                self.send_error(404)
+                return
+            data = files[name]
+            etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+            start = 0
+            match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+            if match and self.headers.get("If-Range", etag) == etag:
+                start = int(match.group(1))
+            requests_log.append(start)
+            if start >= len(data) and start:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206 if start else 200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(data) - start))
+            if start:
+                self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            self.end_headers()
+
+            sent = 0
+            for offset in range(start, len(data), SEND_BLOCK):
+                block = data[offset:offset + SEND_BLOCK]
+                if drop_bytes and sent + len(block) > drop_bytes:
+                    # A flaky network: close the connection in the middle of the body
+                    self.wfile.write(block[:drop_bytes - sent])
+                    self.close_connection = True
+                    return
+                self.wfile.write(block)
+                sent += len(block)
+                if rate:
+                    time.sleep(len(block) / rate)
+
+    return Handler
+
+
+def check_downloads(url: str, data: bytes, tmp_dir: str, requests_log: list):
+    digest = hashlib.sha256(data).hexdigest()
+
+    path = os.path.join(tmp_dir, "flaky.mgf")
+    del requests_log[:]
+    with downloads.ResumableDownload(url, path, expected_sha256=digest) as download:
+        download.close()
+    with open(path, "rb") as f:
+        ok = f.read() == data
+    print(f"dropped connections:   {len(requests_log) - 1} resumes, "
+          f"{'identical' if ok else 'DIFFERENT'} file")
+
+    path = os.path.join(tmp_dir, "partial.mgf")
+    with open(f"{path}.part", "wb") as f:
+        f.write(data[:len(data) // 2])
+    del requests_log[:]
+    received = downloads.download_file(url, path)
+    print(f"leftover .part file:   first request at byte {requests_log[0]} of {len(data)}, "
+          f"{'identical' if received == digest else 'DIFFERENT'} digest")
+
+    path = os.path.join(tmp_dir, "corrupt.mgf")
+    try:
+        downloads.download_file(url, path, expected_sha256="0" * 64)
+        print("wrong checksum:        NOT DETECTED")
+    except downloads.DownloadError:
+        removed = not os.path.exists(path) and not os.path.exists(f"{path}.part")
+        print(f"wrong checksum:        rejected, {'nothing' if removed else 'SOMETHING'} left behind")
+
+
+def run_sequential(cache: ResultCache, stage1: dict) -> float:
+    """The previous order: library matches, then the whole MGF, then cleaning and stage 1."""
+    start = time.perf_counter()
+    pipeline.download_library_matches(TASK_ID, cache)
+    mgf_path, mgf_digest = pipeline.download_mgf(TASK_ID, cache)
+    pipeline.prefilter_mgf(mgf_path, mgf_digest, stage1, cache, TASK_ID)
+    return time.perf_counter() - start
+
+
+def run_concurrent(cache: ResultCache, stage1: dict) -> float:
+    """The library matches alongside the MGF, stage 1 while the MGF arrives."""
+    start = time.perf_counter()
+    with pipeline.ThreadPoolExecutor(max_workers=1) as executor:
+        library_future = executor.submit(pipeline.download_library_matches, TASK_ID, cache)
+        pipeline.download_and_prefilter_mgf(TASK_ID, stage1, cache)
+        library_future.result()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--spectra", type=int, default=10000, help="Number of synthetic spectra")
+    parser.add_argument("--rate", type=float, default=5.0, help="Download speed of the server in MB/s, 0: unlimited")
+    parser.add_argument("--drop-mb", type=float, default=4.0,
+                        help="The server drops every connection after this many MB, 0: never")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    with open(os.path.join(ROOT, "massql_queries.yaml")) as f:
+        queries = yaml.safe_load(f)["ALL_MASSQL_QUERIES"]
+    with open(os.path.join(ROOT, "bile_acid_tree.yaml")) as f:
+        tree = yaml.safe_load(f)
+    stage1 = pipeline.stage1_queries(queries)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mgf_path = os.path.join(tmp_dir, "input.mgf")
+        write_synthetic_mgf(mgf_path, args.spectra, bile_acid_fraction=0.5)
+        with open(mgf_path, "rb") as f:
+            mgf_data = f.read()
+        library_matches = pd.DataFrame({"#Scan#": range(1, args.spectra + 1, 7)})
+        library_matches["Compound_Name"] = [f"Compound {scan}" for scan in library_matches["#Scan#"]]
+        library_path = os.path.join(tmp_dir, "input.tsv")
+        library_matches.to_csv(library_path, sep="\t", index=False)
+        with open(library_path, "rb") as f:
+            library_data = f.read()
+
+        requests_log = []
+        files = {downloads.FBMN_MGF_FILE: mgf_data, downloads.FBMN_LIBRARY_MATCHES_FILE: library_data}
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(
+            files, args.rate * 1024 ** 2, int(args.drop_mb * 1024 ** 2), requests_log
+        ))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        gnps_url = os.environ.get(downloads.GNPS_URL_ENV_VAR)
+        os.environ[downloads.GNPS_URL_ENV_VAR] = base_url
+        print(f"MGF: {len(mgf_data) / 1024 ** 2:.1f} MB, served at {args.rate or 'unlimited'} MB/s")
+        try:
+            downloads.RETRY_BACKOFF_SECONDS = 0.01
+            check_downloads(downloads.task_file_url(TASK_ID, downloads.FBMN_MGF_FILE), mgf_data, tmp_dir,
+                            requests_log)
+
+            sequential = run_sequential(ResultCache(os.path.join(tmp_dir, "cache_sequential")), stage1)
+            concurrent = run_concurrent(ResultCache(os.path.join(tmp_dir, "cache_concurrent")), stage1)
+            print(f"sequential download + stage 1: {sequential:7.2f} s")
+            print(f"streamed download + stage 1:   {concurrent:7.2f} s  speedup {sequential / concurrent:5.2f}x")
+
+            streamed = pipeline.run_analysis(TASK_ID, queries, tree,
+                                             result_cache=ResultCache(os.path.join(tmp_dir, "cache_streamed")))
+            local = pipeline.run_analysis(TASK_ID, queries, tree, mgf_path=mgf_path,
+                                          library_matches=pd.read_csv(library_path, sep="\t"),
+                                          result_cache=ResultCache(os.path.join(tmp_dir, "cache_local")))
+            identical = (streamed["massql_results"] == local["massql_results"]
+                         and streamed["all_scans"] == local["all_scans"]
+                         and streamed["library_matches"].equals(local["library_matches"]))
+            print(f"run_analysis of the task vs the local file: {'identical' if identical else 'DIFFERENT RESULTS'}")
+        finally:
+            server.shutdown()
+            if gnps_url is None:
+                os.environ.pop(downloads.GNPS_URL_ENV_VAR, None)
+            else:
+                os.environ[downloads.GNPS_URL_ENV_VAR] = gnps_url
+
+
+if __name__ == "__main__":
+    main()
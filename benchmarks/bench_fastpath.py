@@ -0,0 +1,76 @@
+"""
+Compare the vectorised query engine (massql_fastpath.py) with MassQL, query by query.
+
+Every query of massql_queries.yaml is run on all scans with both engines, the timings are
+printed and the scan sets are checked to be identical. Example:
+
+    python benchmarks/bench_fastpath.py --spectra 5000
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import massql_launch  # noqa: E402
+from massql_fastpath import VectorisedEngine, compile_query  # noqa: E402
+from spectrum_store import SpectrumStore  # noqa: E402
+from synthetic_mgf import write_synthetic_mgf  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mgf", help="MGF file to query, a synthetic one is generated if omitted")
+    parser.add_argument("--spectra", type=int, default=2000, help="Number of synthetic spectra")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with open(os.path.join(ROOT, "massql_queries.yaml")) as f:
+        queries = yaml.safe_load(f)["ALL_MASSQL_QUERIES"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mgf_path = os.path.join(tmp_dir, "input.mgf")
+        if args.mgf:
+            shutil.copy(args.mgf, mgf_path)
+        else:
+            write_synthetic_mgf(mgf_path, args.spectra, bile_acid_fraction=0.5)
+
+        ms1_df, ms2_df = massql_launch.load_spectra(mgf_path)
+        start = time.perf_counter()
+        engine = VectorisedEngine(SpectrumStore.from_ms2_df(ms2_df))
+        print(f"Building the spectrum store: {time.perf_counter() - start:.3f} s")
+
+        total_massql = total_vectorised = 0.0
+        for query_name, query_string in queries.items():
+            start = time.perf_counter()
+            expected = massql_launch._run_query(query_name, query_string, mgf_path, ms1_df, ms2_df,
+                                                massql_launch.MASSQL_CACHE)
+            massql_time = time.perf_counter() - start
+
+            compiled = compile_query(query_string)
+            if compiled is None:
+                print(f"{query_name:<50} not supported by the vectorised engine")
+                continue
+            start = time.perf_counter()
+            passed = engine.run(compiled)
+            vectorised_time = time.perf_counter() - start
+
+            total_massql += massql_time
+            total_vectorised += vectorised_time
+            identical = "identical" if sorted(passed) == sorted(expected) else "DIFFERENT RESULTS"
+            print(f"{query_name:<50} massql {massql_time:7.3f} s  vectorised {vectorised_time:7.4f} s  "
+                  f"{len(passed):>6} scans  {identical}")
+
+        print(f"{'Total':<50} massql {total_massql:7.3f} s  vectorised {total_vectorised:7.4f} s  "
+              f"speedup {total_massql / max(total_vectorised, 1e-9):.0f}x")
+
+
+if __name__ == "__main__":
+    main()
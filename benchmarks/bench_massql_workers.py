@@ -0,0 +1,77 @@
+"""
+Measure how run_massql_tree scales with the number of worker processes.
+
+Runs the full query set of massql_queries.yaml on an MGF (e.g. the stage 1 passed MGF of
+the example task, or a synthetic one) with 1..N workers and checks that every run returns
+exactly the same results. The queries are evaluated by MassQL (MASSQL_FASTPATH=0), the
+worker pool only parallelises MassQL. The feather cache of the MGF is written before the
+timed runs, so every run reads it the same way, and removed at the end. Example:
+
+    python benchmarks/bench_massql_workers.py --mgf temp_mgf/<task>_stg1_passed.mgf --max-workers 8
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import massql_launch  # noqa: E402
+from synthetic_mgf import write_synthetic_mgf  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mgf", help="MGF file to query, a synthetic one is generated if omitted")
+    parser.add_argument("--spectra", type=int, default=2000, help="Number of synthetic spectra")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--full", action="store_true", help="Evaluate every query on every scan")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with open(os.path.join(ROOT, "massql_queries.yaml")) as f:
+        queries = yaml.safe_load(f)["ALL_MASSQL_QUERIES"]
+    with open(os.path.join(ROOT, "bile_acid_tree.yaml")) as f:
+        tree = yaml.safe_load(f)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mgf_path = os.path.join(tmp_dir, "input.mgf")
+        if args.mgf:
+            shutil.copy(args.mgf, mgf_path)
+        else:
+            write_synthetic_mgf(mgf_path, args.spectra, bile_acid_fraction=0.5)
+
+        fast_path = os.environ.get(massql_launch.FASTPATH_ENV_VAR)
+        os.environ[massql_launch.FASTPATH_ENV_VAR] = "0"
+        try:
+            # Untimed, writes the feather cache every timed run reads
+            massql_launch.load_spectra(mgf_path)
+            reference = None
+            baseline = None
+            workers = 1
+            while workers <= args.max_workers:
+                start = time.perf_counter()
+                results = massql_launch.run_massql_tree(mgf_path, queries, tree, full_evaluation=args.full,
+                                                        workers=workers)
+                elapsed = time.perf_counter() - start
+                if reference is None:
+                    reference, baseline = results, elapsed
+                identical = "identical" if results == reference else "DIFFERENT RESULTS"
+                print(f"{workers:>3} workers: {elapsed:7.2f} s  speedup {baseline / elapsed:5.2f}x  {identical}")
+                workers *= 2
+        finally:
+            massql_launch.remove_feather_cache(mgf_path)
+            if fast_path is None:
+                os.environ.pop(massql_launch.FASTPATH_ENV_VAR, None)
+            else:
+                os.environ[massql_launch.FASTPATH_ENV_VAR] = fast_path
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Compare the separate clean / stage 1 / filter steps with the fused single pass.
+
+The separate pipeline cleans the MGF, runs the stage 1 queries with MassQL, copies the
+passed scans to a new MGF and parses that file again for stage 2. The fused pipeline
+(massql_launch.run_stage1_inline) does all of it while streaming the MGF once. Both
+outputs are checked to be identical. Example:
+
+    python benchmarks/bench_stage1_pipeline.py --spectra 20000
+"""
+import argparse
+import filecmp
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import massql_launch  # noqa: E402
+from mgf_processing import clean_mgf, copy_indexed_scans, load_scan_index, scan_index_path  # noqa: E402
+from synthetic_mgf import write_synthetic_mgf  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mgf", help="Raw MGF file, a synthetic one is generated if omitted")
+    parser.add_argument("--spectra", type=int, default=5000, help="Number of synthetic spectra")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with open(os.path.join(ROOT, "massql_queries.yaml")) as f:
+        queries = yaml.safe_load(f)["ALL_MASSQL_QUERIES"]
+    stage1 = {key: value for key, value in queries.items() if "stage1" in key.lower()}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_mgf = os.path.join(tmp_dir, "raw.mgf")
+        if args.mgf:
+            shutil.copy(args.mgf, raw_mgf)
+        else:
+            write_synthetic_mgf(raw_mgf, args.spectra, bile_acid_fraction=0.5)
+
+        start = time.perf_counter()
+        cleaned_mgf = os.path.join(tmp_dir, "separate_cleaned.mgf")
+        scans_list = clean_mgf(raw_mgf, cleaned_mgf, index_path=scan_index_path(cleaned_mgf))
+        os.environ[massql_launch.FASTPATH_ENV_VAR] = "0"
+        stage1_results = massql_launch.run_massql(cleaned_mgf, stage1)
+        os.environ[massql_launch.FASTPATH_ENV_VAR] = "1"
+        passed_mgf = os.path.join(tmp_dir, "separate_passed.mgf")
+        scans_to_keep = set(scan for result in stage1_results for scan in result["scan_list"])
+        copy_indexed_scans(cleaned_mgf, passed_mgf, scans_to_keep, load_scan_index(scan_index_path(cleaned_mgf)))
+        massql_launch.load_spectra(passed_mgf)
+        separate_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fused_cleaned_mgf = os.path.join(tmp_dir, "fused_cleaned.mgf")
+        fused_passed_mgf = os.path.join(tmp_dir, "fused_passed.mgf")
+        fused_scans, fused_results, store = massql_launch.run_stage1_inline(
+            raw_mgf, fused_cleaned_mgf, stage1, fused_passed_mgf, index_path=scan_index_path(fused_cleaned_mgf)
+        )
+        fused_time = time.perf_counter() - start
+
+        identical = (
+            fused_scans == scans_list
+            and [(r["query"], r["scan_list"]) for r in fused_results]
+            == [(r["query"], sorted(r["scan_list"])) for r in stage1_results]
+            and filecmp.cmp(cleaned_mgf, fused_cleaned_mgf, shallow=False)
+            and filecmp.cmp(passed_mgf, fused_passed_mgf, shallow=False)
+        )
+        size_mb = os.path.getsize(raw_mgf) / 1024 ** 2
+        print(f"MGF: {size_mb:.1f} MB, {len(scans_list)} spectra, {len(store)} passed stage 1")
+        print(f"Separate steps: {separate_time:7.2f} s")
+        print(f"Fused pass:     {fused_time:7.2f} s  ({size_mb / fused_time:.0f} MB/s)  "
+              f"speedup {separate_time / fused_time:.1f}x  {'identical' if identical else 'DIFFERENT RESULTS'}")
+
+    for feather_file in os.listdir(massql_launch.FEATHER_DIR):
+        if feather_file.endswith(".feather") and "_separate_" in feather_file:
+            os.remove(os.path.join(massql_launch.FEATHER_DIR, feather_file))
+
+
+if __name__ == "__main__":
+    main()
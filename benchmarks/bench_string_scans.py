@@ -0,0 +1,147 @@
+"""
+Check the analysis of MGF files whose SCANS= values are not integers (e.g. SCANS=F1:1).
+
+Runs pipeline.run_analysis on a synthetic MGF and on copies of it where all, or every
+other, SCANS= value is renamed, with the vectorised engine and with MassQL alone. The
+results must be the same up to the names of the scans, which are reported as in the
+file. The copies also go through batch_annotate with library matches of renamed scans.
+Example:
+
+    python benchmarks/bench_string_scans.py --spectra 2000
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+import pandas as pd
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import batch_annotate  # noqa: E402
+import massql_launch  # noqa: E402
+import pipeline  # noqa: E402
+from result_cache import ResultCache  # noqa: E402
+from synthetic_mgf import write_synthetic_mgf  # noqa: E402
+
+
+def rename_scans(input_mgf: str, output_mgf: str, every: int) -> dict:
+    """Copy of input_mgf with every every-th SCANS= value renamed to F1:<scan>, returns {scan: new name}."""
+    names = {}
+
+    def rename(match):
+        scan = match.group(1)
+        if len(names) % every == 0:
+            names[scan] = f"F1:{scan}"
+        else:
+            names[scan] = scan
+        return f"SCANS={names[scan]}"
+
+    with open(input_mgf) as f:
+        text = re.sub(r"^SCANS=(\d+)$", rename, f.read(), flags=re.M)
+    with open(output_mgf, "w") as f:
+        f.write(text)
+    return names
+
+
+def scan_sets(outputs: dict, names: dict = None) -> dict:
+    """Scans of every query and of all_scans as strings, renamed back with names."""
+    names = names or {}
+    original = {name: scan for scan, name in names.items()}
+    sets = {result["query"]: sorted(original.get(str(scan), str(scan)) for scan in result["scan_list"])
+            for result in outputs["massql_results"]}
+    sets["all_scans"] = sorted(original.get(str(scan), str(scan)) for scan in outputs["all_scans"])
+    return sets
+
+
+def validations(outputs: dict) -> dict:
+    """query_validation of every scan of the full result table."""
+    _, full_table, _ = pipeline.process_results(outputs["massql_results"], outputs["library_matches"],
+                                                outputs["all_scans"])
+    return dict(zip(full_table["#Scan#"], full_table["query_validation"]))
+
+
+def annotated_tables(output_dir: str, source: str, names: dict = None) -> dict:
+    """Classification and library match rows of an input annotated by batch_annotate, renamed back with names."""
+    original = {name: scan for scan, name in (names or {}).items()}
+    tables = {}
+    for table in ("classifications", "library_matches"):
+        df = pd.read_csv(os.path.join(output_dir, batch_annotate.input_name(source), f"{table}.csv"),
+                         dtype={"#Scan#": str})
+        tables[table] = sorted((original.get(scan, scan), str(classification)) for scan, classification
+                               in zip(df["#Scan#"], df["classification"]))
+    return tables
+
+
+def report(name: str, ok: bool):
+    print(f"{name:<44} {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--spectra", type=int, default=500, help="Number of synthetic spectra")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    os.chdir(ROOT)
+    with open("massql_queries.yaml") as f:
+        queries = yaml.safe_load(f)["ALL_MASSQL_QUERIES"]
+    with open("bile_acid_tree.yaml") as f:
+        tree = yaml.safe_load(f)
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        numeric_mgf = os.path.join(tmp_dir, "numeric.mgf")
+        write_synthetic_mgf(numeric_mgf, args.spectra, bile_acid_fraction=0.5)
+        variants = {}
+        for variant, every in (("renamed", 1), ("mixed", 2)):
+            mgf_path = os.path.join(tmp_dir, f"{variant}.mgf")
+            variants[variant] = (mgf_path, rename_scans(numeric_mgf, mgf_path, every))
+        # Library matches of every tenth scan, next to each MGF under its scan names
+        scans = sorted(variants["renamed"][1], key=int)[::10]
+        for mgf_path, names in [(numeric_mgf, None)] + list(variants.values()):
+            pd.DataFrame({"#Scan#": [names[scan] if names else scan for scan in scans],
+                          "Compound_Name": [f"Compound {scan}" for scan in scans]}).to_csv(
+                os.path.splitext(mgf_path)[0] + ".tsv", sep="\t", index=False)
+
+        for engine, fast_path in (("vectorised", "1"), ("MassQL", "0")):
+            os.environ[massql_launch.FASTPATH_ENV_VAR] = fast_path
+            cache = ResultCache(os.path.join(tmp_dir, f"cache_{engine}"))
+            numeric = pipeline.run_analysis("numeric", queries, tree, result_cache=cache, mgf_path=numeric_mgf)
+            expected = scan_sets(numeric)
+            expected_table = validations(numeric)
+            for variant, (mgf_path, names) in variants.items():
+                start = time.perf_counter()
+                outputs = pipeline.run_analysis(variant, queries, tree, result_cache=cache, mgf_path=mgf_path)
+                seconds = time.perf_counter() - start
+                # Renamed scans are reported by name, the others as numbers like before
+                reported = set(scan for result in outputs["massql_results"] for scan in result["scan_list"])
+                valid = set(name if name != scan else int(scan) for scan, name in names.items())
+                ok &= report(f"{variant} scans, {engine} ({seconds:.2f} s)",
+                             scan_sets(outputs, names) == expected and reported <= valid)
+                ok &= report(f"{variant} scans, {engine} result table",
+                             validations(outputs) == {names[scan]: value for scan, value in expected_table.items()})
+
+        # Local MGFs in batch_annotate, with their library matches
+        os.environ[massql_launch.FASTPATH_ENV_VAR] = "1"
+        output_dir = os.path.join(tmp_dir, "batch")
+        annotate_args = (output_dir, queries, tree, "csv", False, 1, os.path.join(tmp_dir, "cache_batch"))
+        batch_annotate.annotate(numeric_mgf, *annotate_args)
+        expected = annotated_tables(output_dir, numeric_mgf)
+        for variant, (mgf_path, names) in variants.items():
+            summary = batch_annotate.annotate(mgf_path, *annotate_args)
+            ok &= report(f"{variant} scans, batch_annotate",
+                         summary["status"] == "ok" and summary["classified"] > 0
+                         and annotated_tables(output_dir, mgf_path, names) == expected
+                         and len(expected["library_matches"]) > 0)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
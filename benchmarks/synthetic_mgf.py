@@ -0,0 +1,56 @@
+import random
+
+# Product ions from the stage 1 / stage 2 queries, sprinkled into a fraction of the spectra
+# so that the synthetic files exercise the MassQL queries and not only the parsers
+# Precursor m/z -> neutral loss checked by the matching *_stage2 query (MS2PROD=X-loss)
+BILE_ACID_PRECURSOR_LOSSES = {375.2894: 358.2871, 391.2843: 374.2894, 407.2792: 390.277}
+BILE_ACID_FRAGMENTS = [
+    341.28, 323.27, 339.27, 321.26, 337.25, 319.24,
+    107.086, 109.101, 161.132, 173.132, 175.148, 199.148,
+    201.163, 209.132, 211.147, 213.163, 239.179, 243.174,
+]
+
+
+def write_synthetic_mgf(path, n_spectra, peaks_per_spectrum=60, empty_fraction=0.1,
+                        bile_acid_fraction=0.2, seed=0):
+    """
+    Write an FBMN-like MGF file with random spectra.
+
+    Args:
+        path (str): Output MGF path.
+        n_spectra (int): Number of BEGIN IONS/END IONS blocks to write.
+        peaks_per_spectrum (int): Number of random peaks per non-empty spectrum.
+        empty_fraction (float): Fraction of blocks written without any peak.
+        bile_acid_fraction (float): Fraction of spectra that also get bile acid fragments.
+        seed (int): Random seed, the same arguments always produce the same file.
+
+    Returns:
+        int: Size of the written file in bytes.
+    """
+    rng = random.Random(seed)
+    written = 0
+    with open(path, "w") as f:
+        for scan in range(1, n_spectra + 1):
+            precmz = rng.choice(list(BILE_ACID_PRECURSOR_LOSSES) + [rng.uniform(150, 900)])
+            lines = [
+                "BEGIN IONS",
+                f"FEATURE_ID={scan}",
+                f"PEPMASS={precmz:.4f}",
+                f"SCANS={scan}",
+                f"RTINSECONDS={rng.uniform(30, 900):.2f}",
+                "CHARGE=1",
+                "MSLEVEL=2",
+            ]
+            if rng.random() >= empty_fraction:
+                peaks = {round(rng.uniform(50, precmz), 4): round(rng.uniform(1e2, 1e5), 1)
+                         for _ in range(peaks_per_spectrum)}
+                if rng.random() < bile_acid_fraction:
+                    for mz in rng.sample(BILE_ACID_FRAGMENTS, 8):
+                        peaks[round(mz + rng.uniform(-0.002, 0.002), 4)] = round(rng.uniform(1e4, 1e6), 1)
+                    peaks[round(precmz - BILE_ACID_PRECURSOR_LOSSES.get(precmz, 358.2871), 4)] = round(rng.uniform(1e4, 1e6), 1)
+                lines.extend(f"{mz} {i}" for mz, i in sorted(peaks.items()))
+            lines.append("END IONS")
+            block = "\n".join(lines) + "\n\n"
+            f.write(block)
+            written += len(block)
+    return written
@@ -0,0 +1,100 @@
+import gzip
+import io
+import logging
+import os
+import shutil
+from typing import BinaryIO, List, Optional
+
+try:
+    import zstandard
+except ImportError:  # Optional, gzip is used without it
+    zstandard = None
+
+# Codec of the intermediate MGFs and result files: "zstd", "gzip" or "none"
+COMPRESSION_ENV_VAR = "MASSQL_COMPRESSION"
+# The codec of a file is told by its suffix, readers open whichever variant exists
+CODEC_SUFFIXES = {"zstd": ".zst", "gzip": ".gz", "none": ""}
+# Fast levels, the files are written once and read a few times
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def available_codecs() -> List[str]:
+    return [codec for codec in CODEC_SUFFIXES if codec != "zstd" or zstandard is not None]
+
+
+def get_codec() -> str:
+    """
+    Codec new files are written with, from the MASSQL_COMPRESSION env var.
+
+    Defaults to zstd when the zstandard package is installed and gzip otherwise.
+    """
+    default = "zstd" if zstandard is not None else "gzip"
+    value = os.environ.get(COMPRESSION_ENV_VAR, default).strip().lower()
+    if value not in available_codecs():
+        logging.getLogger(__name__).warning(f"Unavailable {COMPRESSION_ENV_VAR}={value!r}, using {default}")
+        return default
+    return value
+
+
+def compressed_path(path: str, codec: str = None) -> str:
+    """Path a file is written to with codec (defaults to get_codec())."""
+    return path + CODEC_SUFFIXES[codec or get_codec()]
+
+
+def codec_of(path: str) -> str:
+    for codec, suffix in CODEC_SUFFIXES.items():
+        if suffix and path.endswith(suffix):
+            return codec
+    return "none"
+
+
+def find_file(path: str) -> Optional[str]:
+    """
+    The variant of path that exists, compressed with any codec or not at all, None if there is none.
+
+    Files written with another MASSQL_COMPRESSION setting are found as well.
+    """
+    for codec in [get_codec()] + list(CODEC_SUFFIXES):
+        if os.path.exists(path + CODEC_SUFFIXES[codec]):
+            return path + CODEC_SUFFIXES[codec]
+    return None
+
+
+def open_read(path: str) -> BinaryIO:
+    """Binary reader of the uncompressed content of path, the codec is told by its suffix."""
+    codec = codec_of(path)
+    if codec == "gzip":
+        return gzip.open(path, "rb")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError(f"{path} is zstd compressed, install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+def open_write(path: str, buffer_size: int = COPY_BUFFER_SIZE) -> BinaryIO:
+    """
+    Binary writer compressing to path, the codec is told by its suffix.
+
+    Writes are buffered, so writing an MGF block by block does not call the compressor
+    for every block.
+    """
+    codec = codec_of(path)
+    if codec == "none":
+        return open(path, "wb", buffering=buffer_size)
+    if codec == "gzip":
+        # No timestamp in the header, the same content always gives the same file
+        writer = gzip.GzipFile(path, "wb", compresslevel=GZIP_LEVEL, mtime=0)
+    elif zstandard is None:
+        raise RuntimeError(f"Writing {path} needs the zstandard package")
+    else:
+        writer = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, "wb"), closefd=True)
+    return io.BufferedWriter(writer, buffer_size)
+
+
+def decompress_file(path: str, output_path: str):
+    """Write the uncompressed content of path to output_path."""
+    with open_read(path) as infile, open(output_path, "wb") as outfile:
+        shutil.copyfileobj(infile, outfile, COPY_BUFFER_SIZE)
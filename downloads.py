@@ -0,0 +1,248 @@
+import hashlib
+import logging
+import os
+import time
+from typing import BinaryIO, Optional
+
+import requests
+
+# Base URL of the GNPS2 server, e.g. a local stand-in server for testing
+GNPS_URL_ENV_VAR = "MASSQL_GNPS_URL"
+DEFAULT_GNPS_URL = "https://gnps2.org"
+# Result files of an FBMN task
+FBMN_MGF_FILE = "nf_output/clustering/specs_ms.mgf"
+FBMN_LIBRARY_MATCHES_FILE = "nf_output/library/merged_results_with_gnps.tsv"
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# (connect, read) timeouts in seconds
+DOWNLOAD_TIMEOUT = (10, 120)
+# Attempts in a row without receiving a single byte before giving up
+DOWNLOAD_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 1.0
+
+
+class DownloadError(IOError):
+    """A download could not be completed or its content is not what was expected."""
+
+
+def task_file_url(task_id: str, file_path: str) -> str:
+    """URL of a result file of a GNPS2 task."""
+    base_url = os.environ.get(GNPS_URL_ENV_VAR, DEFAULT_GNPS_URL).rstrip("/")
+    return f"{base_url}/resultfile?task={task_id}&file={file_path}"
+
+
+class ResumableDownload:
+    """
+    Binary file-like reader of a URL that survives dropped connections.
+
+    read() returns the bytes of the URL in order, so the download can be consumed while it
+    arrives (e.g. by clean_mgf). Every byte is also written to path + ".part" and hashed.
+    When the connection fails, the request is sent again with a Range header starting at
+    the first missing byte (and If-Range, so a file that changed on the server is never
+    spliced). A .part file left by an earlier attempt is read back first and the download
+    continues after it.
+
+    Once everything is read, close() checks the length announced by the server and
+    expected_sha256 (if given), then renames the .part file to path, or removes it when
+    keep_file is False (the caller stored what it read, e.g. compressed to copy_to). A
+    failed check removes the .part file and raises DownloadError.
+
+    Use it as a context manager, leaving it early keeps the .part file for the next attempt.
+    """
+
+    def __init__(self, url: str, path: str, expected_sha256: Optional[str] = None,
+                 session: requests.Session = None, retries: int = DOWNLOAD_RETRIES,
+                 copy_to: Optional[BinaryIO] = None, keep_file: bool = True):
+        self.url = url
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.expected_sha256 = expected_sha256
+        self.session = session or requests.Session()
+        self.retries = retries
+        # Gets every byte read, the bytes replayed from a .part file too
+        self.copy_to = copy_to
+        self.keep_file = keep_file
+        self.received = 0
+        self.total_size = None
+        self.resumed = 0  # number of requests that continued a partial download
+        self._sha256 = hashlib.sha256()
+        self._validator = None
+        self._response = None
+        self._chunks = None
+        self._pending = b""
+        self._finished = False
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._replay = open(self.part_path, "rb") if os.path.exists(self.part_path) else None
+        self._part_file = open(self.part_path, "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._release()
+        return False
+
+    def hexdigest(self) -> str:
+        """sha256 of the bytes read so far, of the whole file after close()."""
+        return self._sha256.hexdigest()
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(DOWNLOAD_CHUNK_SIZE), b""))
+        if self._replay is not None:
+            data = self._replay.read(size)
+            if data:
+                self._consumed(data)
+                return data
+            self._replay.close()
+            self._replay = None
+
+        while len(self._pending) < size and not self._finished:
+            chunk = self._next_chunk()
+            if chunk is None:
+                self._finished = True
+            else:
+                self._pending += chunk
+        data, self._pending = self._pending[:size], self._pending[size:]
+        if data:
+            self._part_file.write(data)
+            self._consumed(data)
+        return data
+
+    def _consumed(self, data: bytes):
+        self._sha256.update(data)
+        self.received += len(data)
+        if self.copy_to is not None:
+            self.copy_to.write(data)
+
+    def _next_chunk(self) -> Optional[bytes]:
+        """Next chunk from the server, None at the end. Reconnects after network errors."""
+        failures = 0
+        while True:
+            try:
+                if self._chunks is None:
+                    if self.total_size is not None and self.received + len(self._pending) >= self.total_size:
+                        return None
+                    self._connect()
+                return next(self._chunks)
+            except StopIteration:
+                self._close_response()
+                if self.total_size is None or self.received + len(self._pending) >= self.total_size:
+                    return None
+                # The connection ended early without an error
+                failures += 1
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                self._close_response()
+                failures += 1
+                logging.getLogger(__name__).warning(
+                    f"Download of {self.url} interrupted at {self.received + len(self._pending)} bytes: {e}"
+                )
+            if failures > self.retries:
+                raise DownloadError(f"Download of {self.url} failed after {failures} attempts")
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (failures - 1))
+
+    def _connect(self):
+        offset = self.received + len(self._pending)
+        # Byte ranges are offsets into the file itself, not into a compressed transfer
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if self._validator is not None:
+                headers["If-Range"] = self._validator
+        response = self.session.get(self.url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code == 416 and self.total_size is None and offset:
+            # The .part file of an earlier attempt already holds the whole file
+            response.close()
+            self.total_size = offset
+            self._chunks = iter(())
+            return
+        if response.status_code >= 500:
+            response.close()
+            raise requests.ConnectionError(f"{self.url} answered HTTP {response.status_code}")
+        response.raise_for_status()
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+        if offset and response.status_code == 206:
+            self.resumed += 1
+            content_range = response.headers.get("Content-Range", "")
+            start, _, total = content_range.replace("bytes ", "").partition("/")
+            if not start.startswith(f"{offset}-"):
+                response.close()
+                raise DownloadError(f"{self.url} answered a resume at {offset} with {content_range!r}")
+            if total.isdigit():
+                self.total_size = int(total)
+        else:
+            if offset and self._validator is not None and validator != self._validator:
+                response.close()
+                raise DownloadError(f"{self.url} changed on the server during the download")
+            content_length = response.headers.get("Content-Length")
+            if content_length is not None:
+                self.total_size = int(content_length)
+        self._validator = validator or self._validator
+        self._response = response
+        self._chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+        if offset and response.status_code != 206:
+            # The server ignored the Range header, skip what was already received
+            self._skip(offset)
+
+    def _skip(self, count: int):
+        for chunk in self._chunks:
+            if len(chunk) >= count:
+                self._pending += chunk[count:]
+                return
+            count -= len(chunk)
+        raise requests.ConnectionError("Connection closed before the resume offset")
+
+    def _close_response(self):
+        if self._response is not None:
+            self._response.close()
+        self._response = None
+        self._chunks = None
+
+    def _release(self):
+        self._close_response()
+        if self._replay is not None:
+            self._replay.close()
+            self._replay = None
+        self._part_file.close()
+
+    def close(self):
+        """Finish reading, verify the download and move it to path."""
+        if self._part_file.closed:
+            return
+        while self.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+        self._release()
+        problem = None
+        if self.total_size is not None and self.received != self.total_size:
+            problem = f"received {self.received} of {self.total_size} bytes"
+        elif self.expected_sha256 is not None and self.hexdigest() != self.expected_sha256:
+            problem = f"sha256 {self.hexdigest()} instead of {self.expected_sha256}"
+        if problem is not None:
+            os.remove(self.part_path)
+            raise DownloadError(f"Download of {self.url} is corrupt: {problem}")
+        if self.keep_file:
+            os.replace(self.part_path, self.path)
+        else:
+            os.remove(self.part_path)
+        logging.getLogger(__name__).info(
+            f"Downloaded {self.url} ({self.received} bytes, resumed {self.resumed} times)"
+            + (f" to {self.path}" if self.keep_file else "")
+        )
+
+
+def download_file(url: str, path: str, expected_sha256: Optional[str] = None,
+                  session: requests.Session = None, copy_to: Optional[BinaryIO] = None,
+                  keep_file: bool = True) -> str:
+    """
+    Download url to path with ResumableDownload (see there for copy_to and keep_file).
+
+    Returns:
+        str: sha256 hex digest of the file.
+    """
+    with ResumableDownload(url, path, expected_sha256, session, copy_to=copy_to, keep_file=keep_file) as download:
+        download.close()
+    return download.hexdigest()
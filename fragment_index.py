@@ -0,0 +1,224 @@
+import json
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from spectrum_store import SpectrumStore
+
+# Directory of the index, stored next to the cleaned MGF in the result cache
+FRAGMENT_INDEX_DIR = "fragments"
+# Bump when the files written by FragmentIndexWriter change
+FRAGMENT_INDEX_VERSION = 2
+# Width of the m/z bins in Da, widened for files with an unusually wide m/z range
+DEFAULT_BIN_WIDTH = 0.01
+MAX_BINS = 1 << 22
+
+# Posting arrays, each saved as <column>.npy
+POSTING_COLUMNS = (("mz", np.float64), ("spectrum", np.int32),
+                   ("intensity", np.float64), ("intensity_norm", np.float64))
+# While the index is built, postings are spilled to disk grouped by coarse m/z bucket:
+# bucket b holds b * BUCKET_WIDTH <= mz < (b + 1) * BUCKET_WIDTH, the last one everything above
+BUCKET_WIDTH = 2.0
+N_BUCKETS = 1024
+# Postings read at once when scanning a whole column
+SCAN_BLOCK = 1 << 24
+
+
+@dataclass
+class FragmentIndex:
+    """
+    Inverted index of the fragment peaks of a set of spectra.
+
+    Every peak is a posting (spectrum, mz, intensity, intensity_norm), the postings are
+    sorted by m/z and bin_offsets[b] is the first posting of the m/z bin
+    [mz_min + b * bin_width, mz_min + (b + 1) * bin_width). The postings of an m/z window
+    are the contiguous run of its bins (plus one neighbouring bin on each side against
+    float rounding of the bin edges), checked exactly afterwards.
+
+    The index holds all the data of the spectra, take() gives back a SpectrumStore of any
+    of them, so a saved index can be queried without parsing the MGF again. It is written
+    by FragmentIndexWriter and loaded memory-mapped, a lookup only reads the postings of
+    its window.
+    """
+    scans: np.ndarray           # int64, one per spectrum
+    precmz: np.ndarray          # float64, one per spectrum
+    mz: np.ndarray              # float64, one per posting, sorted
+    spectrum: np.ndarray        # int32, spectrum of every posting
+    intensity: np.ndarray       # float64, one per posting
+    intensity_norm: np.ndarray  # float64, one per posting
+    bin_offsets: np.ndarray     # int64, n_bins + 1
+    mz_min: float
+    bin_width: float
+
+    def __len__(self):
+        return len(self.scans)
+
+    def window(self, low: float, high: float) -> np.ndarray:
+        """Postings with low < mz < high."""
+        n_bins = len(self.bin_offsets) - 1
+        first_bin = int(np.clip(np.floor((low - self.mz_min) / self.bin_width) - 1, 0, n_bins))
+        last_bin = int(np.clip(np.floor((high - self.mz_min) / self.bin_width) + 1, -1, n_bins - 1))
+        if last_bin < first_bin:
+            return np.empty(0, dtype=np.int64)
+        postings = np.arange(self.bin_offsets[first_bin], self.bin_offsets[last_bin + 1])
+        mz = self.mz[postings]
+        return postings[(mz > low) & (mz < high)]
+
+    def take(self, spectra: np.ndarray) -> SpectrumStore:
+        """
+        SpectrumStore of the given spectra (sorted indices), in that order.
+
+        Only the postings of those spectra are loaded, the result is the same as taking
+        them from the store the index was built from.
+        """
+        spectra = np.asarray(spectra, dtype=np.int64)
+        selected = np.zeros(len(self.scans), dtype=bool)
+        selected[spectra] = True
+        postings = np.concatenate([
+            np.flatnonzero(selected[np.asarray(self.spectrum[start:start + SCAN_BLOCK])]) + start
+            for start in range(0, len(self.spectrum), SCAN_BLOCK)
+        ] or [np.empty(0, dtype=np.int64)])
+
+        posting_spectra = np.searchsorted(spectra, self.spectrum[postings])
+        mz = self.mz[postings]
+        # Postings of equal m/z keep their order, the order they had in the spectrum
+        order = np.lexsort((mz, posting_spectra))
+        offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(posting_spectra, minlength=len(spectra)), out=offsets[1:])
+        postings = postings[order]
+        return SpectrumStore(self.scans[spectra], self.precmz[spectra], offsets,
+                             mz[order], self.intensity[postings], self.intensity_norm[postings])
+
+    def header_store(self) -> SpectrumStore:
+        """
+        Store of the indexed spectra without peaks, only their scans and precursor m/z.
+
+        Enough for a SharedPredicateEngine with this index when no condition depends on X,
+        the product ion predicates then come from the postings alone.
+        """
+        empty = np.empty(0, dtype=np.float64)
+        return SpectrumStore(np.asarray(self.scans), np.asarray(self.precmz),
+                             np.zeros(len(self.scans) + 1, dtype=np.int64), empty, empty, empty)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "FragmentIndex":
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["version"] != FRAGMENT_INDEX_VERSION:
+            raise ValueError(f"{directory} was written by another version of the fragment index")
+        mmap_mode = "r" if mmap else None
+        columns = {column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode=mmap_mode)
+                   for column in ("scans", "precmz", "bin_offsets") + tuple(name for name, _ in POSTING_COLUMNS)}
+        return cls(**columns, mz_min=meta["mz_min"], bin_width=meta["bin_width"])
+
+
+class FragmentIndexWriter:
+    """
+    Builds a FragmentIndex on disk from stores added one chunk at a time.
+
+    add() groups the postings of a chunk by coarse m/z bucket and appends them to spill
+    files, finish() sorts one bucket at a time and appends it to the output files. Memory
+    stays bounded by a chunk and a bucket, whatever the size of the MGF. The postings end
+    up in the same order as a stable sort by m/z of all stores one after the other.
+    """
+
+    def __init__(self, directory: str, bin_width: float = DEFAULT_BIN_WIDTH):
+        self.directory = directory
+        self.bin_width = bin_width
+        os.makedirs(directory, exist_ok=True)
+        self._spill_files = {column: open(self._spill_path(column), "wb") for column, _ in POSTING_COLUMNS}
+        self._bucket_counts = []  # per added store, postings per bucket
+        self._scans = []
+        self._precmz = []
+        self._n_spectra = 0
+        self._mz_min = np.inf
+        self._mz_max = -np.inf
+
+    def _spill_path(self, column: str) -> str:
+        return os.path.join(self.directory, f"{column}.spill")
+
+    def add(self, store: SpectrumStore):
+        bucket = np.clip(np.floor(store.mz / BUCKET_WIDTH), 0, N_BUCKETS - 1).astype(np.int64)
+        order = np.argsort(bucket, kind="stable")
+        columns = {
+            "mz": store.mz[order],
+            "spectrum": store.peak_spectrum[order] + self._n_spectra,
+            "intensity": store.intensity[order],
+            "intensity_norm": store.intensity_norm[order],
+        }
+        for column, dtype in POSTING_COLUMNS:
+            self._spill_files[column].write(np.ascontiguousarray(columns[column], dtype=dtype).tobytes())
+        self._bucket_counts.append(np.bincount(bucket, minlength=N_BUCKETS))
+        self._scans.append(store.scans)
+        self._precmz.append(store.precmz)
+        self._n_spectra += len(store)
+        if len(store.mz):
+            self._mz_min = min(self._mz_min, float(store.mz.min()))
+            self._mz_max = max(self._mz_max, float(store.mz.max()))
+
+    def _read_bucket(self, spill_file, dtype, run_starts: np.ndarray, run_counts: np.ndarray) -> np.ndarray:
+        """Postings of one bucket from a spill file, the runs of the added stores one after the other."""
+        itemsize = np.dtype(dtype).itemsize
+        runs = []
+        for start, count in zip(run_starts.tolist(), run_counts.tolist()):
+            if count:
+                spill_file.seek(start * itemsize)
+                runs.append(np.fromfile(spill_file, dtype=dtype, count=count))
+        return np.concatenate(runs)
+
+    def finish(self) -> FragmentIndex:
+        """Write the index files, remove the spill files and return the loaded index."""
+        for spill_file in self._spill_files.values():
+            spill_file.close()
+        counts = np.array(self._bucket_counts, dtype=np.int64).reshape(-1, N_BUCKETS)
+        n_postings = int(counts.sum())
+        # Start of the run of every (store, bucket) in the spill files
+        run_starts = (np.cumsum(counts.reshape(-1)) - counts.reshape(-1)).reshape(counts.shape)
+
+        mz_min = self._mz_min if n_postings else 0.0
+        span = self._mz_max - mz_min if n_postings else 0.0
+        bin_width = max(self.bin_width, span / MAX_BINS)
+        n_bins = int(span // bin_width) + 1
+        bin_edges = mz_min + np.arange(n_bins + 1) * bin_width
+        # bin_offsets[b] is the number of postings below edge b, counted bucket by bucket
+        below_edge = np.zeros(n_bins + 2, dtype=np.int64)
+
+        # The sorted buckets are appended to the .npy files, nothing but a bucket is in memory
+        spill_files = {column: open(self._spill_path(column), "rb") for column, _ in POSTING_COLUMNS}
+        outputs = {column: open(os.path.join(self.directory, f"{column}.npy"), "wb") for column, _ in POSTING_COLUMNS}
+        try:
+            for column, dtype in POSTING_COLUMNS:
+                np.lib.format.write_array_header_1_0(outputs[column], {
+                    "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                    "fortran_order": False,
+                    "shape": (n_postings,),
+                })
+            for bucket in range(N_BUCKETS):
+                bucket_counts = counts[:, bucket]
+                if not bucket_counts.any():
+                    continue
+                mz = self._read_bucket(spill_files["mz"], np.float64, run_starts[:, bucket], bucket_counts)
+                order = np.argsort(mz, kind="stable")
+                mz = mz[order]
+                below_edge += np.bincount(np.searchsorted(bin_edges, mz, side="right"), minlength=n_bins + 2)
+                outputs["mz"].write(mz.tobytes())
+                for column, dtype in POSTING_COLUMNS[1:]:
+                    values = self._read_bucket(spill_files[column], dtype, run_starts[:, bucket], bucket_counts)
+                    outputs[column].write(values[order].tobytes())
+        finally:
+            for open_file in list(spill_files.values()) + list(outputs.values()):
+                open_file.close()
+        for column, _ in POSTING_COLUMNS:
+            os.remove(self._spill_path(column))
+
+        bin_offsets = np.cumsum(below_edge)[:n_bins + 1]
+        bin_offsets[-1] = n_postings
+
+        empty_int = np.empty(0, dtype=np.int64)
+        np.save(os.path.join(self.directory, "scans.npy"), np.concatenate(self._scans or [empty_int]))
+        np.save(os.path.join(self.directory, "precmz.npy"), np.concatenate(self._precmz or [empty_int.astype(float)]))
+        np.save(os.path.join(self.directory, "bin_offsets.npy"), bin_offsets)
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump({"version": FRAGMENT_INDEX_VERSION, "mz_min": mz_min, "bin_width": bin_width}, f)
+        return FragmentIndex.load(self.directory)
@@ -0,0 +1,412 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from result_cache import CACHE_DIR_ENV_VAR, DEFAULT_CACHE_DIR, ResultCache
+
+# Environment variables configuring the job subsystem
+JOBS_DB_ENV_VAR = "MASSQL_JOBS_DB"
+JOB_WORKERS_ENV_VAR = "MASSQL_JOB_WORKERS"
+DEFAULT_JOB_WORKERS = 2
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Running jobs whose worker did not send a heartbeat for this long are given to another worker
+HEARTBEAT_SECONDS = 10
+STALE_JOB_SECONDS = 120
+MAX_ATTEMPTS = 2
+POLL_SECONDS = 1.0
+
+# ResultCache kind holding the outputs of finished analysis jobs
+JOB_RESULTS_KIND = "job_results"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    dedup_key TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT NOT NULL DEFAULT '',
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT NOT NULL DEFAULT '',
+    error TEXT,
+    result_key TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_dedup_key ON jobs (dedup_key, status);
+"""
+
+
+def default_jobs_db() -> str:
+    """Path of the job database, MASSQL_JOBS_DB or jobs.sqlite3 inside the result cache directory."""
+    return os.environ.get(JOBS_DB_ENV_VAR) or os.path.join(
+        os.environ.get(CACHE_DIR_ENV_VAR, DEFAULT_CACHE_DIR), "jobs.sqlite3"
+    )
+
+
+def get_job_worker_count() -> int:
+    """Number of job worker processes, from the MASSQL_JOB_WORKERS env var (0 means external workers)."""
+    value = os.environ.get(JOB_WORKERS_ENV_VAR, str(DEFAULT_JOB_WORKERS)).strip()
+    try:
+        return max(0, int(value))
+    except ValueError:
+        logging.getLogger(__name__).warning(
+            f"Invalid {JOB_WORKERS_ENV_VAR}={value!r}, using {DEFAULT_JOB_WORKERS} workers"
+        )
+        return DEFAULT_JOB_WORKERS
+
+
+@dataclass
+class Job:
+    job_id: str
+    task_id: str
+    dedup_key: str
+    params: dict
+    status: str
+    stage: str
+    progress: float
+    message: str
+    error: Optional[str]
+    result_key: Optional[str]
+    attempts: int
+    created_at: float
+    started_at: Optional[float]
+    finished_at: Optional[float]
+    heartbeat_at: Optional[float]
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "Job":
+        values = dict(row)
+        values["params"] = json.loads(values["params"])
+        return cls(**values)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+
+class JobQueue:
+    """
+    Queue of analysis jobs in a local SQLite database.
+
+    Every process (Streamlit sessions, job workers) opens its own connection. Jobs with the
+    same dedup_key are only queued once while one of them is queued or running, later
+    submissions get the existing job back. Workers claim queued jobs atomically, report the
+    current stage and its progress, and send heartbeats; running jobs without a heartbeat
+    for STALE_JOB_SECONDS are queued again (or failed after MAX_ATTEMPTS).
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or default_jobs_db()
+        db_dir = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _update(self, job_id: str, **values):
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        conn = self._connect()
+        try:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*values.values(), job_id))
+        finally:
+            conn.close()
+
+    def submit(self, task_id: str, params: dict, dedup_key: str = None) -> Job:
+        """
+        Queue a job, unless a job with the same dedup_key is already queued or running.
+
+        Args:
+            task_id (str): Task the job analyses.
+            params (dict): JSON serialisable parameters passed to the job function.
+            dedup_key (str, optional): Jobs with the same key do the same work, defaults to task_id.
+
+        Returns:
+            Job: The new job, or the one already in progress.
+        """
+        dedup_key = dedup_key or task_id
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE dedup_key = ? AND status IN (?, ?) ORDER BY created_at LIMIT 1",
+                (dedup_key, QUEUED, RUNNING),
+            ).fetchone()
+            if row is None:
+                job_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO jobs (job_id, task_id, dedup_key, params, status, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (job_id, task_id, dedup_key, json.dumps(params), QUEUED, time.time()),
+                )
+                row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+                logging.getLogger(__name__).info(f"Queued job {job_id} for task {task_id}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return Job.from_row(row)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return Job.from_row(row) if row is not None else None
+
+    def jobs(self, status: str = None) -> List[Job]:
+        """All jobs (or the ones in the given state), oldest first."""
+        conn = self._connect()
+        try:
+            if status is None:
+                rows = conn.execute("SELECT * FROM jobs ORDER BY created_at").fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY created_at", (status,)).fetchall()
+        finally:
+            conn.close()
+        return [Job.from_row(row) for row in rows]
+
+    def queue_position(self, job_id: str) -> int:
+        """Number of queued jobs submitted before job_id."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < "
+                "(SELECT created_at FROM jobs WHERE job_id = ?)",
+                (QUEUED, job_id),
+            ).fetchone()
+        finally:
+            conn.close()
+        return row[0]
+
+    def claim(self) -> Optional[Job]:
+        """Mark the oldest queued job as running and return it, None if the queue is empty."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._requeue_stale(conn, now)
+            row = conn.execute(
+                "SELECT job_id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, stage = '', progress = 0, message = '', "
+                    "attempts = attempts + 1, started_at = ?, heartbeat_at = ? WHERE job_id = ?",
+                    (RUNNING, now, now, row["job_id"]),
+                )
+                row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (row["job_id"],)).fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return Job.from_row(row) if row is not None else None
+
+    @staticmethod
+    def _requeue_stale(conn: sqlite3.Connection, now: float):
+        stale_before = now - STALE_JOB_SECONDS
+        conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, error = 'The worker running this job stopped' "
+            "WHERE status = ? AND heartbeat_at < ? AND attempts >= ?",
+            (FAILED, now, RUNNING, stale_before, MAX_ATTEMPTS),
+        )
+        conn.execute(
+            "UPDATE jobs SET status = ? WHERE status = ? AND heartbeat_at < ?",
+            (QUEUED, RUNNING, stale_before),
+        )
+
+    def heartbeat(self, job_id: str):
+        self._update(job_id, heartbeat_at=time.time())
+
+    def update_progress(self, job_id: str, stage: str, progress: float, message: str = ""):
+        """Record the current stage of a running job and its progress (0 to 1) within that stage."""
+        self._update(job_id, stage=stage, progress=progress, message=message, heartbeat_at=time.time())
+
+    def complete(self, job_id: str, result_key: str):
+        self._update(job_id, status=DONE, progress=1.0, result_key=result_key, finished_at=time.time())
+
+    def fail(self, job_id: str, error: str):
+        self._update(job_id, status=FAILED, error=error, finished_at=time.time())
+
+
+def run_analysis_job(job: Job, job_queue: JobQueue) -> str:
+    """
+    Download a task, run stage 1 and the classification tree, and store the outputs.
+
+    job.params holds the "queries", the bile acid "tree" and "full_evaluation". The
+    outputs of pipeline.run_analysis (library matches, scans of the MGF and MassQL results)
+    are stored in the result cache under job.dedup_key, the app builds its tables from them.
+
+    Returns:
+        str: The result cache key of the outputs.
+    """
+    import pipeline
+
+    result_cache = ResultCache()
+    outputs = pipeline.run_analysis(
+        job.task_id,
+        job.params["queries"],
+        job.params["tree"],
+        full_evaluation=job.params.get("full_evaluation", False),
+        result_cache=result_cache,
+        progress_callback=lambda stage, fraction, message: job_queue.update_progress(
+            job.job_id, stage, fraction, message
+        ),
+    )
+    result_cache.put_pickle(JOB_RESULTS_KIND, job.dedup_key, outputs)
+    return job.dedup_key
+
+
+def _send_heartbeats(job_queue: JobQueue, job_id: str, stop: threading.Event):
+    while not stop.wait(HEARTBEAT_SECONDS):
+        job_queue.heartbeat(job_id)
+
+
+def work(job_queue: JobQueue, job_function: Callable[[Job, JobQueue], str] = run_analysis_job,
+         stop: threading.Event = None, max_jobs: int = None):
+    """
+    Worker loop, run jobs from the queue one at a time until stop is set.
+
+    Args:
+        job_queue (JobQueue): Queue to take jobs from.
+        job_function (callable): Runs a job and returns its result key.
+        stop (threading.Event, optional): Set to leave the loop after the current job.
+        max_jobs (int, optional): Leave after this many jobs, e.g. in tests.
+    """
+    logger = logging.getLogger(__name__)
+    stop = stop or threading.Event()
+    completed = 0
+    while not stop.is_set() and (max_jobs is None or completed < max_jobs):
+        job = job_queue.claim()
+        if job is None:
+            stop.wait(POLL_SECONDS)
+            continue
+
+        logger.info(f"Worker {os.getpid()} running job {job.job_id} for task {job.task_id}")
+        heartbeat_stop = threading.Event()
+        heartbeat = threading.Thread(target=_send_heartbeats, args=(job_queue, job.job_id, heartbeat_stop),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            result_key = job_function(job, job_queue)
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed: {e}\n{traceback.format_exc()}")
+            job_queue.fail(job.job_id, f"{type(e).__name__}: {e}")
+        else:
+            job_queue.complete(job.job_id, result_key)
+            logger.info(f"Job {job.job_id} finished")
+        finally:
+            heartbeat_stop.set()
+            heartbeat.join()
+        completed += 1
+
+
+class JobRunner:
+    """
+    Pool of job worker processes.
+
+    Workers are separate interpreters (python job_queue.py worker), so each can use its
+    own MassQL process pool and they survive Streamlit script reruns. At most `workers`
+    jobs run at the same time, whatever the number of open sessions.
+    """
+
+    def __init__(self, db_path: str = None, workers: int = None):
+        self.db_path = db_path or default_jobs_db()
+        self.workers = get_job_worker_count() if workers is None else workers
+        self._processes = []
+
+    def start(self) -> "JobRunner":
+        import pipeline
+
+        # No worker of this server runs yet, whatever a crashed one left behind can go
+        pipeline.reclaim_orphans()
+        script = os.path.abspath(__file__)
+        for _ in range(self.workers):
+            self._processes.append(subprocess.Popen(
+                [sys.executable, script, "worker", "--db", self.db_path],
+                cwd=os.path.dirname(script),
+            ))
+        if self._processes:
+            logging.getLogger(__name__).info(f"Started {len(self._processes)} job workers")
+        return self
+
+    def stop(self, timeout: float = 10):
+        for process in self._processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in self._processes:
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self._processes = []
+
+
+def print_cache_usage(usage: dict):
+    print(f"\nResult cache: {usage['bytes'] / 1024 ** 2:.1f} of {usage['max_bytes'] / 1024 ** 2:.1f} MB, "
+          f"{usage['entries']} entries ({usage['in_use']} in use)")
+    for group in ("kinds", "tasks"):
+        for name, counts in sorted(usage[group].items(), key=lambda item: -item[1]["bytes"]):
+            print(f"  {group[:-1]} {name or '-':<24} {counts['bytes'] / 1024 ** 2:10.1f} MB  {counts['entries']} entries")
+    print(f"  evicted {usage['evicted_entries']} entries ({usage['evicted_bytes'] / 1024 ** 2:.1f} MB), "
+          f"{usage['skipped_in_use']} skipped while in use, {usage['reclaimed_orphans']} orphans reclaimed "
+          f"({usage['reclaimed_bytes'] / 1024 ** 2:.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run MassQL analysis jobs from the job queue")
+    parser.add_argument("command", choices=["worker", "status"])
+    parser.add_argument("--db", default=None, help="Job database, defaults to MASSQL_JOBS_DB or the cache directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    job_queue = JobQueue(args.db)
+    if args.command == "status":
+        for job in job_queue.jobs():
+            print(f"{job.job_id}  {job.task_id}  {job.status:<8} {job.stage:<8} {job.progress:6.1%}  "
+                  f"{job.error or job.message}")
+        print_cache_usage(ResultCache().usage())
+        return
+
+    stop = threading.Event()
+    # Finish the current job on SIGTERM if there is time, a killed job is queued again once its heartbeat is stale
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    work(job_queue, stop=stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,518 @@
+import logging
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from massql import msql_parser
+from massql.msql_engine import _determine_mz_max
+
+from fragment_index import FragmentIndex
+from spectrum_store import SpectrumStore
+
+# Qualifiers the vectorised engine knows how to evaluate, anything else falls back to MassQL
+SUPPORTED_QUALIFIERS = {
+    "type",
+    "qualifiermztolerance",
+    "qualifierppmtolerance",
+    "qualifierintensitypercent",
+    "qualifierintensityvalue",
+    "qualifierintensitymatch",
+    "qualifierintensityreference",
+    "qualifierintensitytolpercent",
+}
+# MassQL's tolerance when a condition has no TOLERANCEMZ/TOLERANCEPPM
+DEFAULT_MZ_TOLERANCE = 0.1
+
+# X, X-358.2871, X+18.01
+VARIABLE_EXPRESSION_PATTERN = re.compile(r"^X(?:\s*([+-])\s*([0-9]*\.?[0-9]+))?$")
+# Y, Y*0.8, X*0.75 (intensity match expressions)
+MATCH_EXPRESSION_PATTERN = re.compile(r"^([A-Za-z])(?:\s*\*\s*([0-9]*\.?[0-9]+))?$")
+
+
+@dataclass
+class PeakCondition:
+    """One MS2PROD/MS2MZ or MS2PREC condition of a compiled query."""
+    precursor: bool
+    mz: float = None                  # constant m/z, None when the value depends on X
+    x_sign: float = 0.0               # value is X + x_sign * x_offset
+    x_offset: float = 0.0
+    mz_tolerance: float = None        # absolute tolerance (TOLERANCEMZ)
+    ppm_tolerance: float = None       # relative tolerance (TOLERANCEPPM)
+    intensity_filters: List[Tuple[str, str, float]] = field(default_factory=list)
+    reference_variable: str = None    # INTENSITYMATCH=Y:INTENSITYMATCHREFERENCE
+    match_variable: str = None        # INTENSITYMATCH=Y*0.8:INTENSITYMATCHPERCENT=20
+    match_factor: float = 1.0
+    match_tolerance_percent: float = None
+
+    @property
+    def uses_x(self) -> bool:
+        return self.mz is None
+
+    def values(self, x_values: np.ndarray) -> np.ndarray:
+        """Condition m/z for rows with the given X values (ignored for constant m/z)."""
+        if self.mz is not None:
+            return np.full(len(x_values), self.mz)
+        if self.x_sign < 0:
+            return x_values - self.x_offset
+        return x_values + self.x_offset
+
+    @property
+    def predicate_key(self) -> tuple:
+        """Identity of a constant condition's peak predicate, equal for conditions selecting the same peaks."""
+        if self.ppm_tolerance is not None:
+            tolerance = ("ppm", self.ppm_tolerance)
+        else:
+            tolerance = ("mz", DEFAULT_MZ_TOLERANCE if self.mz_tolerance is None else self.mz_tolerance)
+        return self.precursor, self.mz, tolerance, tuple(self.intensity_filters)
+
+    def tolerances(self, values: np.ndarray) -> np.ndarray:
+        if self.ppm_tolerance is not None:
+            return np.abs(self.ppm_tolerance * values / 1000000)
+        if self.mz_tolerance is not None:
+            return np.full(len(values), self.mz_tolerance)
+        return np.full(len(values), DEFAULT_MZ_TOLERANCE)
+
+
+@dataclass
+class CompiledQuery:
+    """A MassQL query translated into peak conditions, see compile_query."""
+    query: str
+    conditions: List[PeakCondition]
+    # Only for X queries: tolerances MassQL uses to space the candidate X values
+    variable_ppm_tolerance: float = 100000
+    variable_da_tolerance: float = 100000
+
+    @property
+    def has_variable(self) -> bool:
+        return any(condition.uses_x for condition in self.conditions)
+
+
+def _compile_condition(condition: dict) -> Optional[PeakCondition]:
+    if condition.get("conditiontype") != "where":
+        return None
+    if condition.get("type") not in ("ms2productcondition", "ms2precursorcondition"):
+        return None
+    values = condition.get("value", [])
+    if len(values) != 1:
+        return None
+    qualifiers = condition.get("qualifiers", {})
+    if not set(qualifiers) <= SUPPORTED_QUALIFIERS:
+        return None
+
+    compiled = PeakCondition(precursor=condition["type"] == "ms2precursorcondition")
+    value = values[0]
+    if isinstance(value, str):
+        variable_match = VARIABLE_EXPRESSION_PATTERN.match(value.strip())
+        if variable_match is None:
+            return None
+        sign, offset = variable_match.groups()
+        if offset is not None:
+            if compiled.precursor:
+                return None
+            compiled.x_sign = -1.0 if sign == "-" else 1.0
+            compiled.x_offset = float(offset)
+        elif not compiled.precursor:
+            # MS2PROD=X takes its candidates from every fragment, not supported here
+            return None
+    else:
+        compiled.mz = float(value)
+
+    if "qualifierppmtolerance" in qualifiers:
+        compiled.ppm_tolerance = qualifiers["qualifierppmtolerance"]["value"]
+    elif "qualifiermztolerance" in qualifiers:
+        compiled.mz_tolerance = qualifiers["qualifiermztolerance"]["value"]
+
+    for qualifier_name, column, scale in (("qualifierintensityvalue", "intensity", 1.0),
+                                          ("qualifierintensitypercent", "intensity_norm", 100.0)):
+        if qualifier_name in qualifiers:
+            if compiled.precursor:
+                return None
+            qualifier = qualifiers[qualifier_name]
+            comparator = qualifier.get("comparator", "greaterthan")
+            threshold = float(qualifier["value"]) / scale
+            if comparator == "greaterthan" and scale > 1.0:
+                threshold = min(threshold, 0.99)
+            compiled.intensity_filters.append((column, comparator, threshold))
+
+    if "qualifierintensitymatch" in qualifiers:
+        if compiled.precursor or compiled.uses_x:
+            return None
+        expression = str(qualifiers["qualifierintensitymatch"]["value"]).strip()
+        if "qualifierintensityreference" in qualifiers:
+            compiled.reference_variable = expression
+        if "qualifierintensitytolpercent" in qualifiers:
+            match_expression = MATCH_EXPRESSION_PATTERN.match(expression)
+            if match_expression is None:
+                return None
+            variable, factor = match_expression.groups()
+            compiled.match_variable = variable
+            compiled.match_factor = 1.0 if factor is None else float(factor)
+            compiled.match_tolerance_percent = float(qualifiers["qualifierintensitytolpercent"]["value"])
+    elif "qualifierintensityreference" in qualifiers or "qualifierintensitytolpercent" in qualifiers:
+        return None
+
+    return compiled
+
+
+@lru_cache(maxsize=1024)
+def compile_query(query: str) -> Optional[CompiledQuery]:
+    """
+    Translate a MassQL query into a CompiledQuery the vectorised engine can run.
+
+    Supported are scaninfo(MS2DATA) queries whose WHERE clause only has MS2PROD/MS2MZ and
+    MS2PREC conditions with TOLERANCEMZ, TOLERANCEPPM, INTENSITYPERCENT, INTENSITYVALUE and
+    INTENSITYMATCH qualifiers, plus MS2PREC=X with product conditions of the form X-c/X+c.
+
+    Returns:
+        CompiledQuery or None if the query needs the full MassQL engine.
+    """
+    try:
+        parsed = msql_parser.parse_msql(query)
+    except Exception:
+        return None
+
+    querytype = parsed.get("querytype", {})
+    if querytype.get("function") != "functionscaninfo" or querytype.get("datatype") != "datams2data":
+        return None
+
+    conditions = []
+    for condition in parsed.get("conditions", []):
+        compiled = _compile_condition(condition)
+        if compiled is None:
+            return None
+        conditions.append(compiled)
+
+    # Reference conditions fill the intensity register, MassQL evaluates them first
+    conditions.sort(key=lambda condition: condition.reference_variable is None)
+    compiled_query = CompiledQuery(query=query, conditions=conditions)
+
+    if compiled_query.has_variable:
+        if sum(condition.precursor and condition.uses_x for condition in conditions) != 1:
+            return None
+        for condition in conditions:
+            if not condition.uses_x:
+                continue
+            if condition.ppm_tolerance is not None:
+                compiled_query.variable_ppm_tolerance = min(compiled_query.variable_ppm_tolerance,
+                                                            condition.ppm_tolerance)
+            if condition.mz_tolerance is not None:
+                compiled_query.variable_da_tolerance = min(compiled_query.variable_da_tolerance,
+                                                           condition.mz_tolerance)
+    return compiled_query
+
+
+def _expand_ranges(starts: np.ndarray, stops: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """For ranges [starts[k], stops[k]) return (k, position) for every position in them."""
+    counts = np.maximum(stops - starts, 0)
+    rows = np.repeat(np.arange(len(starts)), counts)
+    range_begins = np.cumsum(counts) - counts
+    positions = starts[rows] + (np.arange(counts.sum()) - range_begins[rows])
+    return rows, positions
+
+
+def _intensity_mask(intensity: np.ndarray, intensity_norm: np.ndarray, condition: PeakCondition) -> np.ndarray:
+    """Peaks passing the intensity filters of condition, MassQL also drops zero intensities."""
+    mask = (intensity > 0) & (intensity_norm > 0)
+    for column, comparator, threshold in condition.intensity_filters:
+        values = intensity if column == "intensity" else intensity_norm
+        if comparator == "greaterthan":
+            mask &= values > threshold
+        elif comparator == "lessthan":
+            mask &= values < threshold
+        else:
+            mask &= values >= threshold
+    return mask
+
+
+class VectorisedEngine:
+    """
+    Evaluates compiled queries on a SpectrumStore with NumPy.
+
+    A condition is evaluated for every remaining spectrum at once: the peaks inside the
+    m/z window of each spectrum are found with np.searchsorted on a key that sorts peaks by
+    (spectrum, m/z), then intensity masks and per-spectrum sums are computed on the hits
+    only. The m/z bounds, the intensity thresholds and the intensity match arithmetic are
+    the ones of MassQL, so the passed scans are the same as with msql_engine.process_query.
+    """
+
+    def __init__(self, store: SpectrumStore):
+        self.store = store
+        self.peak_spectrum = store.peak_spectrum
+        # Every spectrum gets its own range [k * span, (k + 1) * span) in the key
+        self.mz_min = float(store.mz.min()) if len(store.mz) else 0.0
+        self.span = float(store.mz.max()) - self.mz_min + 1.0 if len(store.mz) else 1.0
+        self.key = self.peak_spectrum * self.span + (store.mz - self.mz_min)
+        # Float error of the key, windows are widened by this and checked exactly afterwards
+        self.key_margin = (len(store) + 1) * self.span * 1e-12 + 1e-9
+        self._variable_candidates = {}
+
+    def _window_peaks(self, spectra: np.ndarray, low: np.ndarray, high: np.ndarray):
+        """(row, peak index) of every peak with low[row] < mz < high[row] in spectra[row]."""
+        base = spectra * self.span - self.mz_min
+        starts = np.searchsorted(self.key, base + low - self.key_margin, side="left")
+        stops = np.searchsorted(self.key, base + high + self.key_margin, side="right")
+        # Windows that reach into neighbouring spectra are cut at the spectrum boundaries
+        starts = np.maximum(starts, self.store.offsets[spectra])
+        stops = np.minimum(stops, self.store.offsets[spectra + 1])
+        rows, peaks = _expand_ranges(starts, stops)
+        mz = self.store.mz[peaks]
+        inside = (mz > low[rows]) & (mz < high[rows])
+        return rows[inside], peaks[inside]
+
+    def _filter_rows(self, conditions: List[PeakCondition], spectra: np.ndarray, x_values: np.ndarray):
+        """
+        Apply conditions to rows of (spectrum, X value) and return the passing row indices.
+
+        Rows are spectra for queries without X, and (spectrum, candidate X) pairs otherwise.
+        """
+        rows = np.arange(len(spectra))
+        registers = {}
+        for condition in conditions:
+            if len(rows) == 0:
+                break
+            row_spectra = spectra[rows]
+            values = condition.values(x_values[rows])
+            tolerances = condition.tolerances(values)
+            low, high = values - tolerances, values + tolerances
+
+            if condition.precursor:
+                precmz = self.store.precmz[row_spectra]
+                rows = rows[(precmz > low) & (precmz < high)]
+                continue
+
+            hit_rows, peaks = self._window_peaks(row_spectra, low, high)
+            keep = _intensity_mask(self.store.intensity[peaks], self.store.intensity_norm[peaks], condition)
+            hit_rows, peaks = hit_rows[keep], peaks[keep]
+            hits = np.bincount(hit_rows, minlength=len(rows)) > 0
+            sums = np.bincount(hit_rows, weights=self.store.intensity[peaks], minlength=len(rows))
+
+            if condition.reference_variable is not None:
+                register = registers.setdefault(condition.reference_variable, np.full(len(spectra), np.nan))
+                register[rows[hits]] = sums[hits]
+
+            if condition.match_variable is not None:
+                register = registers.get(condition.match_variable)
+                if register is None:
+                    hits[:] = False
+                else:
+                    match_intensity = register[rows] * condition.match_factor
+                    tolerance = condition.match_tolerance_percent / 100 * match_intensity
+                    # NaN (no reference peak) fails both comparisons
+                    hits &= (sums > match_intensity - tolerance) & (sums < match_intensity + tolerance)
+
+            rows = rows[hits]
+        return rows
+
+    def _variable_candidate_values(self, query: CompiledQuery) -> np.ndarray:
+        """
+        Candidate X values, computed like MassQL does on the whole file.
+
+        The precursor m/z of the spectra passing the conditions without X are sorted and
+        thinned greedily: a value within half the tolerance of the last kept one is skipped.
+        """
+        candidates = self._variable_candidates.get(query.query)
+        if candidates is not None:
+            return candidates
+
+        fixed_conditions = [condition for condition in query.conditions if not condition.uses_x]
+        all_spectra = np.arange(len(self.store))
+        passed = all_spectra[self._filter_rows(fixed_conditions, all_spectra, np.zeros(len(all_spectra)))]
+
+        kept = []
+        running_max_mz = 0
+        for mz_value in np.unique(self.store.precmz[passed]).tolist():
+            if running_max_mz > mz_value or mz_value < 0 or mz_value > 1000000:
+                continue
+            kept.append(mz_value)
+            running_max_mz = _determine_mz_max(mz_value, query.variable_ppm_tolerance,
+                                               query.variable_da_tolerance)
+        candidates = (np.asarray(kept, dtype=np.float64), passed)
+        self._variable_candidates[query.query] = candidates
+        return candidates
+
+    def run(self, query: CompiledQuery, scans=None) -> list:
+        """
+        Evaluate query on the spectra with the given scan numbers (None means all spectra).
+
+        Returns:
+            list: Passed scans (ints), sorted by scan. For X queries sorted by X value first and
+                a scan is repeated for X values with a different integer part, like in MassQL.
+        """
+        if scans is None:
+            spectra = np.arange(len(self.store))
+        else:
+            spectra = self.store.spectrum_indices(scans)
+
+        if not query.has_variable:
+            passed = self._filter_rows(query.conditions, spectra, np.zeros(len(spectra)))
+            return np.sort(self.store.scans[spectra[passed]]).tolist()
+
+        candidates, presearch_spectra = self._variable_candidate_values(query)
+        spectra = np.intersect1d(spectra, presearch_spectra)
+        if len(candidates) == 0 or len(spectra) == 0:
+            return []
+
+        # Pair every spectrum with the X values that can satisfy MS2PREC=X
+        precursor_condition = next(c for c in query.conditions if c.precursor and c.uses_x)
+        max_tolerance = precursor_condition.tolerances(candidates[-1:])[0]
+        precmz = self.store.precmz[spectra]
+        first = np.searchsorted(candidates, precmz - max_tolerance - self.key_margin, side="left")
+        last = np.searchsorted(candidates, precmz + max_tolerance + self.key_margin, side="right")
+        pair_rows, pair_candidates = _expand_ranges(first, last)
+
+        variable_conditions = [condition for condition in query.conditions if condition.uses_x]
+        pair_spectra = spectra[pair_rows]
+        passed = self._filter_rows(variable_conditions, pair_spectra, candidates[pair_candidates])
+        if len(passed) == 0:
+            return []
+
+        # MassQL concatenates the results per X value and drops repeated (scan, int(X))
+        passed_scans = self.store.scans[pair_spectra[passed]]
+        passed_candidates = pair_candidates[passed]
+        order = np.lexsort((passed_scans, passed_candidates))
+        passed_scans, passed_candidates = passed_scans[order], passed_candidates[order]
+        truncated = candidates[passed_candidates].astype(np.int64)
+        _, first_seen = np.unique(np.stack([passed_scans, truncated], axis=1), axis=0, return_index=True)
+        return passed_scans[np.sort(first_seen)].tolist()
+
+
+@dataclass
+class QueryPlan:
+    """The constant peak conditions of a query set, decomposed into distinct predicates (see plan_queries)."""
+    predicates: Dict[tuple, PeakCondition]    # predicate key -> first condition with it
+    query_predicates: Dict[str, List[tuple]]  # query name -> predicate keys of its constant conditions
+    unsupported: List[str]                    # queries the vectorised engine can not run
+
+    @property
+    def condition_count(self) -> int:
+        return sum(len(keys) for keys in self.query_predicates.values())
+
+    @property
+    def shared_count(self) -> int:
+        """Condition evaluations saved by evaluating every distinct predicate once."""
+        return self.condition_count - len(self.predicates)
+
+    def summary(self) -> str:
+        return (f"{self.condition_count} constant peak conditions in {len(self.query_predicates)} queries, "
+                f"{len(self.predicates)} distinct predicates ({self.shared_count} evaluations shared)")
+
+
+def plan_queries(queries_dict: dict) -> QueryPlan:
+    """
+    Decompose a query set into its distinct constant peak predicates.
+
+    Args:
+        queries_dict (dict): Query name -> MassQL query string.
+
+    Returns:
+        QueryPlan: Which predicates every query uses, and how many evaluations
+            SharedPredicateEngine saves on the set.
+    """
+    plan = QueryPlan(predicates={}, query_predicates={}, unsupported=[])
+    for query_name, query_string in queries_dict.items():
+        compiled = compile_query(query_string)
+        if compiled is None:
+            plan.unsupported.append(query_name)
+            continue
+        keys = []
+        for condition in compiled.conditions:
+            if not condition.uses_x:
+                plan.predicates.setdefault(condition.predicate_key, condition)
+                keys.append(condition.predicate_key)
+        plan.query_predicates[query_name] = keys
+    return plan
+
+
+class SharedPredicateEngine(VectorisedEngine):
+    """
+    VectorisedEngine that evaluates every distinct constant peak condition once.
+
+    The first condition with a given PeakCondition.predicate_key computes, for all spectra
+    of the store, whether they have a qualifying peak and the summed intensity of those
+    peaks. Every later condition with the same predicate, in any query, reuses the two
+    arrays, so a query only combines them (AND and the INTENSITYMATCH checks) on its
+    spectra. Conditions depending on X are still evaluated per query.
+
+    With a FragmentIndex of the same spectra, a product ion predicate is computed from the
+    postings of its m/z window alone.
+    """
+
+    def __init__(self, store: SpectrumStore, fragment_index: FragmentIndex = None):
+        super().__init__(store)
+        self.fragment_index = fragment_index
+        self._predicates = {}
+        self.predicate_lookups = 0
+
+    @property
+    def predicate_evaluations(self) -> int:
+        return len(self._predicates)
+
+    def _predicate(self, condition: PeakCondition) -> Tuple[np.ndarray, np.ndarray]:
+        """(has a qualifying peak, summed intensity of the qualifying peaks) per spectrum."""
+        self.predicate_lookups += 1
+        key = condition.predicate_key
+        cached = self._predicates.get(key)
+        if cached is not None:
+            return cached
+
+        values = condition.values(np.zeros(1))
+        tolerance = condition.tolerances(values)[0]
+        low, high = values[0] - tolerance, values[0] + tolerance
+        n_spectra = len(self.store)
+        if condition.precursor:
+            hits = (self.store.precmz > low) & (self.store.precmz < high)
+            sums = np.zeros(n_spectra)
+        else:
+            if self.fragment_index is not None:
+                postings = self.fragment_index.window(low, high)
+                keep = _intensity_mask(self.fragment_index.intensity[postings],
+                                       self.fragment_index.intensity_norm[postings], condition)
+                peak_spectra = self.fragment_index.spectrum[postings[keep]]
+                intensity = self.fragment_index.intensity[postings[keep]]
+            else:
+                peak_spectra, peaks = self._window_peaks(np.arange(n_spectra), np.full(n_spectra, low),
+                                                         np.full(n_spectra, high))
+                keep = _intensity_mask(self.store.intensity[peaks], self.store.intensity_norm[peaks], condition)
+                peak_spectra, intensity = peak_spectra[keep], self.store.intensity[peaks[keep]]
+            # Peaks of a spectrum are summed in m/z order either way, like in _filter_rows
+            hits = np.bincount(peak_spectra, minlength=n_spectra) > 0
+            sums = np.bincount(peak_spectra, weights=intensity, minlength=n_spectra)
+        cached = self._predicates[key] = (hits, sums)
+        return cached
+
+    def _filter_rows(self, conditions: List[PeakCondition], spectra: np.ndarray, x_values: np.ndarray):
+        if any(condition.uses_x for condition in conditions):
+            return super()._filter_rows(conditions, spectra, x_values)
+
+        passed = np.ones(len(spectra), dtype=bool)
+        registers = {}
+        for condition in conditions:
+            hits, sums = self._predicate(condition)
+            hits, sums = hits[spectra], sums[spectra]
+
+            if condition.reference_variable is not None:
+                register = registers.setdefault(condition.reference_variable, np.full(len(spectra), np.nan))
+                register[passed & hits] = sums[passed & hits]
+
+            if condition.match_variable is not None:
+                register = registers.get(condition.match_variable)
+                if register is None:
+                    hits[:] = False
+                else:
+                    match_intensity = register * condition.match_factor
+                    tolerance = condition.match_tolerance_percent / 100 * match_intensity
+                    hits &= (sums > match_intensity - tolerance) & (sums < match_intensity + tolerance)
+
+            passed &= hits
+        return np.flatnonzero(passed)
+
+
+def run_query(engine: VectorisedEngine, query: str, scans=None) -> Optional[list]:
+    """Run query with the vectorised engine, or return None if it is not supported."""
+    compiled = compile_query(query)
+    if compiled is None:
+        return None
+    logging.getLogger(__name__).debug(f"Vectorised evaluation of {query}")
+    return engine.run(compiled, scans)
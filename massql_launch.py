@@ -1,31 +1,758 @@
+import contextlib
+import fcntl
+import glob
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Dict, Optional, Union
+
+import numpy as np
 import pandas as pd
 import yaml
-from massql import msql_engine
+from massql import msql_engine, msql_fileloading
 import logging
 
+import compression
+from fragment_index import FragmentIndex, FragmentIndexWriter
+from massql_fastpath import (SharedPredicateEngine, VectorisedEngine, compile_query, plan_queries,
+                             run_query as run_vectorised_query)
+from mgf_processing import (DEFAULT_CHUNK_SIZE, block_bytes, clean_mgf, copy_indexed_scans, load_scan_index,
+                            parse_spectra, scan_index_path)
+from result_cache import STALE_TMP_SECONDS, ResultCache, file_digest, text_digest
+from spectrum_store import SpectrumStore
 
+# MassQL cache format used for files loaded in batch mode (removed by remove_feather_cache)
+MASSQL_CACHE = "feather"
+# Environment variable with the number of worker processes used to run queries
+WORKERS_ENV_VAR = "MASSQL_WORKERS"
+# MassQL feather caches are always written here, even for MGFs stored in the result cache
+FEATHER_DIR = "temp_mgf"
+# Lock file of FEATHER_DIR, held shared by every process writing there (see use_feather_dir)
+FEATHER_DIR_LOCK_FILE = ".in-use"
+# Files kept in FEATHER_DIR by reclaim_feather_dir
+FEATHER_DIR_KEEP = (".gitkeep", FEATHER_DIR_LOCK_FILE)
+# Environment variable to turn the vectorised engine off ("0"), e.g. to compare results
+FASTPATH_ENV_VAR = "MASSQL_FASTPATH"
 
-def run_massql(mgf_path: str, queries_dict: dict):
-    logger = logging.getLogger(__name__)
-    executed_queries = []
-    all_query_results_list = []
-    for query_name, query_string in queries_dict.items():
-        logger.info(f"Running query: {query_name}")
-        executed_queries.append(query_name)
+# How the scan list of a query was obtained in a run, see QueryRunReport
+COMPUTED = "computed"
+REUSED = "reused"
+SKIPPED = "skipped"
+
+
+@dataclass
+class QueryRunReport:
+    """
+    Which queries of a run were evaluated and which were reused from the result cache.
+
+    Scan lists are cached per query text, input spectra and parent scans, so after an edit
+    of massql_queries.yaml only new or changed queries (and the ones below them in the tree
+    whose parent scans changed) are computed again. predicate_lookups and
+    predicate_evaluations count the constant peak conditions queries evaluated in this
+    process and the distinct ones actually computed (see SharedPredicateEngine).
+    """
+    statuses: Dict[str, str] = field(default_factory=dict)
+    seconds: Dict[str, float] = field(default_factory=dict)
+    predicate_lookups: int = 0
+    predicate_evaluations: int = 0
+
+    def record(self, query_name: str, status: str, seconds: float = 0.0):
+        """Record a query, a query evaluated in several steps (stage 1, tree) counts as computed if any step was."""
+        if self.statuses.get(query_name) != COMPUTED:
+            self.statuses[query_name] = status
+        self.seconds[query_name] = self.seconds.get(query_name, 0.0) + seconds
+
+    def record_predicates(self, engine: SharedPredicateEngine):
+        self.predicate_lookups += engine.predicate_lookups
+        self.predicate_evaluations += engine.predicate_evaluations
+
+    def queries(self, status: str) -> list:
+        return [query_name for query_name, query_status in self.statuses.items() if query_status == status]
+
+    @property
+    def computed(self) -> list:
+        return self.queries(COMPUTED)
+
+    @property
+    def reused(self) -> list:
+        return self.queries(REUSED)
+
+    @property
+    def computed_seconds(self) -> float:
+        return sum(self.seconds[query_name] for query_name in self.computed)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            "query": list(self.statuses),
+            "status": list(self.statuses.values()),
+            "seconds": [round(self.seconds[query_name], 3) for query_name in self.statuses],
+        })
+
+    def summary(self) -> str:
+        text = (f"Recomputed {len(self.computed)} of {len(self.statuses)} queries in "
+                f"{self.computed_seconds:.2f} s, reused {len(self.reused)} cached results")
+        if self.queries(SKIPPED):
+            text += f", skipped {len(self.queries(SKIPPED))} (parent query matched no scans)"
+        if self.predicate_lookups:
+            text += (f", {self.predicate_lookups - self.predicate_evaluations} of {self.predicate_lookups} "
+                     f"peak condition evaluations shared")
+        if self.computed and len(self.computed) < len(self.statuses):
+            text += f" (recomputed: {', '.join(self.computed)})"
+        return text
+
+
+def _feather_cache_file(mgf_path: str) -> str:
+    """Prefix of the feather cache files MassQL writes for mgf_path."""
+    name = os.path.splitext(os.path.basename(mgf_path))[0]
+    # Size and mtime are part of the name, a rewritten file never picks up a stale cache
+    stat = os.stat(mgf_path)
+    file_id = f"{os.path.abspath(mgf_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return os.path.join(FEATHER_DIR, f"{text_digest(file_id)[:16]}_{name}")
+
+
+_feather_dir_lock = None
+
+
+def use_feather_dir():
+    """
+    Mark FEATHER_DIR as used by this process (and its children) until it exits.
+
+    Called before writing there, so reclaim_feather_dir only removes everything when no
+    live process can still need the files.
+    """
+    global _feather_dir_lock
+    if _feather_dir_lock is None:
+        os.makedirs(FEATHER_DIR, exist_ok=True)
+        lock_file = open(os.path.join(FEATHER_DIR, FEATHER_DIR_LOCK_FILE), "a")
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        _feather_dir_lock = lock_file
+
+
+def reclaim_feather_dir(max_age: float = STALE_TMP_SECONDS) -> (int, int):
+    """
+    Remove the files crashed runs left in FEATHER_DIR (feather caches, stage 1 passed MGFs).
+
+    Everything goes when no other process uses the directory (see use_feather_dir), e.g.
+    when the server starts, otherwise only files older than max_age.
+
+    Returns:
+        tuple: (files removed, bytes freed)
+    """
+    if not os.path.isdir(FEATHER_DIR):
+        return 0, 0
+    with open(os.path.join(FEATHER_DIR, FEATHER_DIR_LOCK_FILE), "a") as lock_file:
         try:
-            results_df = msql_engine.process_query(query_string, mgf_path, parallel=True)
-        except KeyError:
-            logger.error(f"KeyError encountered for query: {query_name}")
-            results_df = pd.DataFrame()
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            min_age = 0
+        except BlockingIOError:
+            min_age = max_age
+        removed = freed = 0
+        now = time.time()
+        for name in os.listdir(FEATHER_DIR):
+            path = os.path.join(FEATHER_DIR, name)
+            try:
+                stat = os.stat(path)
+                if name in FEATHER_DIR_KEEP or not os.path.isfile(path) or now - stat.st_mtime < min_age:
+                    continue
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            freed += stat.st_size
+    if removed:
+        logging.getLogger(__name__).info(f"Removed {removed} orphaned files ({freed} bytes) from {FEATHER_DIR}")
+    return removed, freed
+
+
+def remove_feather_cache(mgf_path: str):
+    """Remove the feather cache files of mgf_path, leaving the ones of other MGFs alone."""
+    for feather_file in glob.glob(f"{_feather_cache_file(mgf_path)}*.feather"):
+        try:
+            os.remove(feather_file)
+        except OSError as e:
+            logging.getLogger(__name__).warning(f"Could not delete {feather_file}: {e}")
+
+
+def load_spectra(mgf_path: str):
+    """
+    Parse an MGF file once into the MassQL in-memory representation.
+
+    A feather cache is written to FEATHER_DIR, MassQL re-reads the file from disk for the
+    pre-search of variable (X) queries and picks the cache up instead of parsing the MGF again.
+    MassQL only parses plain MGFs, a compressed one is decompressed to a temporary file
+    for the first load; the later ones, and MassQL itself, read the cache.
+
+    Returns:
+        tuple: (ms1_df, ms2_df) as produced by msql_fileloading.load_data
+    """
+    use_feather_dir()
+    cache_file = _feather_cache_file(mgf_path)
+    if compression.codec_of(mgf_path) == "none" or glob.glob(f"{cache_file}*.feather"):
+        return msql_fileloading.load_data(mgf_path, cache=MASSQL_CACHE, cache_file=cache_file)
+    plain_mgf_path = f"{cache_file}.plain.mgf"
+    compression.decompress_file(mgf_path, plain_mgf_path)
+    try:
+        return msql_fileloading.load_data(plain_mgf_path, cache=MASSQL_CACHE, cache_file=cache_file)
+    finally:
+        os.remove(plain_mgf_path)
+
+
+def get_worker_count() -> int:
+    """
+    Number of worker processes used to run queries, from the MASSQL_WORKERS env var.
+
+    Defaults to 1 (queries run in the calling process). "auto" or 0 uses every CPU.
+    """
+    value = os.environ.get(WORKERS_ENV_VAR, "1").strip().lower()
+    if value in ("auto", "0"):
+        return os.cpu_count() or 1
+    try:
+        return max(1, int(value))
+    except ValueError:
+        logging.getLogger(__name__).warning(f"Invalid {WORKERS_ENV_VAR}={value!r}, using 1 worker")
+        return 1
+
+
+def use_fast_path() -> bool:
+    """Whether supported queries run on the vectorised engine (MASSQL_FASTPATH, default on)."""
+    return os.environ.get(FASTPATH_ENV_VAR, "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def runs_on_store(queries_dict: dict) -> bool:
+    """Whether every query of queries_dict can run on a SpectrumStore, without MassQL or an MGF file."""
+    return use_fast_path() and all(compile_query(query) is not None for query in queries_dict.values())
+
+
+def _build_engine(ms2_df):
+    """Vectorised engine over ms2_df, or None when the fast path is turned off."""
+    if not use_fast_path():
+        return None
+    return SharedPredicateEngine(SpectrumStore.from_ms2_df(ms2_df))
+
+
+# Spectra of the MGF a worker process was started for, set by _init_worker
+_worker_spectra = {}
+
+
+def _init_worker(mgf_path: str, store_source: str = None):
+    _worker_spectra["mgf_path"] = mgf_path
+    _worker_spectra["ms1_df"] = _worker_spectra["ms2_df"] = None
+    if store_source is not None and use_fast_path():
+        # Every worker maps the same saved store, the peaks are in memory once for all of them
+        _worker_spectra["engine"] = SharedPredicateEngine(SpectrumStore.load(store_source))
+    else:
+        _load_worker_dataframes()
+        _worker_spectra["engine"] = _build_engine(_worker_spectra["ms2_df"])
+
+
+def _load_worker_dataframes():
+    # Workers read the feather cache written by the parent, not the MGF itself
+    _worker_spectra["ms1_df"], _worker_spectra["ms2_df"] = load_spectra(_worker_spectra["mgf_path"])
+
+
+def _run_query_on_subset(query_name, query_string, mgf_path, ms1_df, ms2_df, parent_scans, engine=None):
+    """
+    Run a query restricted to parent_scans (None means every scan).
+
+    Queries the vectorised engine supports are evaluated there, the others with MassQL.
+    """
+    if parent_scans is not None and len(parent_scans) == 0:
+        logging.getLogger(__name__).info(f"Skipping query: {query_name} (parent query matched no scans)")
+        return []
+
+    if engine is not None:
+        passed = run_vectorised_query(engine, query_string, parent_scans)
+        if passed is not None:
+            logging.getLogger(__name__).info(f"Ran query: {query_name} (vectorised)")
+            return passed
+
+    if parent_scans is None:
+        return _run_query(query_name, query_string, mgf_path, ms1_df, ms2_df, MASSQL_CACHE)
+
+    subset_df = ms2_df[ms2_df["scan"].astype(int).isin(parent_scans)]
+    passed = _run_query(query_name, query_string, mgf_path, ms1_df, subset_df, MASSQL_CACHE)
+    # The pre-search of X queries re-reads the whole file, keep the results inside the subset
+    return [scan for scan in passed if scan in parent_scans]
+
+
+def _run_query_in_worker(query_name, query_string, parent_scans):
+    """Run a query on the spectra of the worker, returns (passed scans, seconds)."""
+    start = time.perf_counter()
+    if _worker_spectra["ms2_df"] is None and (_worker_spectra["engine"] is None or compile_query(query_string) is None):
+        # Only queries MassQL evaluates need the dataframes
+        _load_worker_dataframes()
+    passed = _run_query_on_subset(
+        query_name, query_string, _worker_spectra["mgf_path"],
+        _worker_spectra["ms1_df"], _worker_spectra["ms2_df"], parent_scans, _worker_spectra["engine"],
+    )
+    return passed, time.perf_counter() - start
+
+
+class QueryExecutor:
+    """
+    Runs queries against one MGF file, in this process or in a process pool.
+
+    Use it as a context manager. submit() always returns a Future, so callers handle the
+    sequential and the parallel mode the same way and decide themselves in which order
+    the results are collected. With a result_cache, scan lists are stored under
+    task_id + query text digest + MGF digest (+ scan subset digest) and reused.
+
+    When a store is given and every query runs on it (runs_on_store), the queries are
+    evaluated on slices of the store and mgf_path is not read, it may be None (the store
+    digest then replaces the MGF digest). Otherwise MassQL parses mgf_path; worker
+    processes evaluate the vectorised queries on the store memory-mapped from
+    store.source when it was loaded from disk.
+    progress_callback(finished, total) is called every time a submitted query finishes, and
+    a run_report records whether each query was computed or reused, and how long it took.
+    """
 
-        if len(results_df) == 0:
-            all_query_results_list.append({"query": query_name, "scan_list": []})
+    def __init__(self, mgf_path: str, queries_dict: dict, workers: int = None,
+                 result_cache: ResultCache = None, task_id: str = "", store: SpectrumStore = None,
+                 progress_callback: Callable[[int, int], None] = None, run_report: QueryRunReport = None):
+        self.mgf_path = mgf_path
+        self.run_report = run_report
+        self.progress_callback = progress_callback
+        self._finished = 0
+        self._progress_lock = threading.Lock()
+        self.store = store
+        self.queries_dict = queries_dict
+        self.workers = get_worker_count() if workers is None else workers
+        self.result_cache = result_cache
+        self.task_id = task_id
+        self._mgf_digest = None
+        self._pool = None
+        self._ms1_df = None
+        self._ms2_df = None
+        self._engine = None
+
+    def __enter__(self):
+        logger = logging.getLogger(__name__)
+        if self.result_cache is not None:
+            self._mgf_digest = file_digest(self.mgf_path) if self.mgf_path is not None else self.store.digest()
+        if use_fast_path():
+            logger.info(plan_queries(self.queries_dict).summary())
+        if self.store is not None and runs_on_store(self.queries_dict):
+            # Every query runs on the spectra already in memory, MassQL never has to parse the MGF
+            logger.info(f"Running queries on {len(self.store)} spectra in memory")
+            self._engine = SharedPredicateEngine(self.store)
+            return self
+        if self.mgf_path is None:
+            raise ValueError("Some queries need MassQL, which needs an MGF file")
+        logger.info(f"Loading spectra from {self.mgf_path}")
+        # Also writes the feather cache the workers load from
+        ms1_df, ms2_df = load_spectra(self.mgf_path)
+        if self.workers > 1 and len(self.queries_dict) > 1:
+            logger.info(f"Running queries with {self.workers} worker processes")
+            store_source = self.store.source if self.store is not None else None
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker, initargs=(self.mgf_path, store_source)
+            )
+        else:
+            self._ms1_df, self._ms2_df = ms1_df, ms2_df
+            self._engine = _build_engine(ms2_df) if self.store is None or not use_fast_path() \
+                else SharedPredicateEngine(self.store)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=exc_type is not None)
+            self._pool = None
+        if self.run_report is not None and isinstance(self._engine, SharedPredicateEngine):
+            self.run_report.record_predicates(self._engine)
+        self._ms1_df, self._ms2_df, self._engine = None, None, None
+        return False
+
+    def submit(self, query_name: str, parent_scans=None) -> Future:
+        """Schedule query_name on the scans in parent_scans (None means every scan)."""
+        future = self._submit_cached(query_name, parent_scans)
+        if self.progress_callback is not None:
+            future.add_done_callback(self._report_progress)
+        return future
+
+    def _report_progress(self, _):
+        with self._progress_lock:
+            self._finished += 1
+            self.progress_callback(self._finished, len(self.queries_dict))
+
+    def _submit_cached(self, query_name: str, parent_scans) -> Future:
+        query_string = self.queries_dict[query_name]
+        if self.result_cache is None:
+            return self._submit(query_name, query_string, parent_scans)
+
+        if parent_scans is None:
+            subset_digest = "all"
+        else:
+            subset_digest = text_digest(",".join(str(scan) for scan in sorted(parent_scans)))
+        cache_key = self.result_cache.key(self.task_id, text_digest(query_string), self._mgf_digest, subset_digest)
+        cached_scans = self.result_cache.get_json("scan_list", cache_key)
+        if cached_scans is not None:
+            logging.getLogger(__name__).info(f"Using cached results for query: {query_name}")
+            if self.run_report is not None:
+                self.run_report.record(query_name, REUSED)
+            future = Future()
+            future.set_result(cached_scans)
+            return future
+
+        future = self._submit(query_name, query_string, parent_scans)
+        # Pool callbacks run on another thread, the entry still belongs to the caller's use() block
+        use_block = self.result_cache.current_use()
+
+        def store(done):
+            if done.exception() is None:
+                with self.result_cache.join_use(use_block):
+                    self.result_cache.put_json("scan_list", cache_key, done.result())
+
+        future.add_done_callback(store)
+        return future
+
+    def _submit(self, query_name: str, query_string: str, parent_scans) -> Future:
+        future = Future()
+        if self._pool is not None:
+            def unpack(done):
+                if done.cancelled():
+                    future.cancel()
+                elif done.exception() is not None:
+                    future.set_exception(done.exception())
+                else:
+                    passed, seconds = done.result()
+                    self._record(query_name, parent_scans, seconds)
+                    future.set_result(passed)
+
+            self._pool.submit(_run_query_in_worker, query_name, query_string, parent_scans).add_done_callback(unpack)
+            return future
+
+        start = time.perf_counter()
+        try:
+            passed = _run_query_on_subset(
+                query_name, query_string, self.mgf_path, self._ms1_df, self._ms2_df, parent_scans, self._engine
+            )
+        except Exception as e:
+            future.set_exception(e)
         else:
-            passed_scan_ls = results_df["scan"].values.tolist()
-            passed_scan_ls = [int(x) for x in passed_scan_ls]
-            all_query_results_list.append({"query": query_name, "scan_list": passed_scan_ls})
+            self._record(query_name, parent_scans, time.perf_counter() - start)
+            future.set_result(passed)
+        return future
+
+    def _record(self, query_name: str, parent_scans, seconds: float):
+        if self.run_report is not None:
+            skipped = parent_scans is not None and len(parent_scans) == 0
+            self.run_report.record(query_name, SKIPPED if skipped else COMPUTED, seconds)
+
+
+def run_massql(mgf_path: str, queries_dict: dict, batch: bool = True, workers: int = None,
+               result_cache: ResultCache = None, task_id: str = "", store: SpectrumStore = None,
+               progress_callback: Callable[[int, int], None] = None, run_report: QueryRunReport = None):
+    """
+    Run every query of queries_dict against mgf_path.
+
+    Args:
+        mgf_path (str or None): MGF file to query, None if store is given and every query
+            runs on it (see runs_on_store).
+        queries_dict (dict): Query name -> MassQL query string.
+        batch (bool): Parse the MGF once and evaluate all queries on the same
+            in-memory data. If False, each query loads the file on its own.
+        workers (int, optional): Number of worker processes, defaults to get_worker_count().
+            Only used in batch mode.
+        result_cache (ResultCache, optional): Persistent cache for the scan lists (batch mode only).
+        task_id (str): Task the MGF belongs to, part of the cache keys.
+        store (SpectrumStore, optional): Spectra of mgf_path already in memory, e.g. from
+            run_stage1_inline. If every query is supported by the vectorised engine the
+            MGF is not parsed again.
+        progress_callback (callable, optional): Called with (finished, total) queries as
+            they finish (batch mode only).
+        run_report (QueryRunReport, optional): Filled with the computed and reused queries
+            (batch mode only).
+
+    Returns:
+        list: [{"query": query_name, "scan_list": [scan, ...]}, ...] in queries_dict order
+    """
+    if not batch:
+        return [
+            {"query": query_name,
+             "scan_list": _run_query(query_name, query_string, mgf_path, None, None, None)}
+            for query_name, query_string in queries_dict.items()
+        ]
+
+    with QueryExecutor(mgf_path, queries_dict, workers, result_cache, task_id, store,
+                       progress_callback, run_report) as executor:
+        futures = {query_name: executor.submit(query_name) for query_name in queries_dict}
+        return [
+            {"query": query_name, "scan_list": future.result()}
+            for query_name, future in futures.items()
+        ]
+
+
+def _run_query(query_name: str, query_string: str, mgf_path: str, ms1_df, ms2_df, cache) -> list:
+    """Run a single query and return the list of passed scans (as ints)."""
+    logger = logging.getLogger(__name__)
+    logger.info(f"Running query: {query_name}")
+    use_feather_dir()
+    try:
+        results_df = msql_engine.process_query(
+            query_string, mgf_path, cache=cache, parallel=True, ms1_df=ms1_df, ms2_df=ms2_df,
+            cache_file=_feather_cache_file(mgf_path) if cache is not None else None,
+        )
+    except KeyError:
+        logger.error(f"KeyError encountered for query: {query_name}")
+        results_df = pd.DataFrame()
+
+    if len(results_df) == 0:
+        return []
+    return [int(x) for x in results_df["scan"].values.tolist()]
+
+
+def run_massql_tree(mgf_path: str, queries_dict: dict, classification_tree: dict,
+                    full_evaluation: bool = False, workers: int = None,
+                    result_cache: ResultCache = None, task_id: str = "", store: SpectrumStore = None,
+                    progress_callback: Callable[[int, int], None] = None, run_report: QueryRunReport = None):
+    """
+    Run the queries following the classification tree, top-down.
+
+    Each query of the tree is only evaluated on the scans that passed its parent query,
+    the bile acid categories at the root (Monohydroxy, Dihydroxy, ...) are independent
+    branches evaluated on every scan. Queries that are not part of the tree are evaluated
+    on every scan. The tree is processed level by level, so with several workers all the
+    queries of a level run at the same time.
+
+    Args:
+        mgf_path (str or None): MGF file to query, None if store is given and every query
+            runs on it (see runs_on_store).
+        queries_dict (dict): Query name -> MassQL query string.
+        classification_tree (dict): Tree from bile_acid_tree.yaml.
+        full_evaluation (bool): Debug switch, evaluate every query on every scan
+            (same as run_massql).
+        workers (int, optional): Number of worker processes, defaults to get_worker_count().
+        result_cache (ResultCache, optional): Persistent cache for the scan lists.
+        task_id (str): Task the MGF belongs to, part of the cache keys.
+        store (SpectrumStore, optional): Spectra of mgf_path already in memory (see run_massql).
+        progress_callback (callable, optional): Called with (finished, total) queries as
+            they finish.
+        run_report (QueryRunReport, optional): Filled with the computed and reused queries.
+
+    Returns:
+        list: [{"query": query_name, "scan_list": [scan, ...]}, ...] in queries_dict order,
+            the structure process_results consumes.
+    """
+    if full_evaluation:
+        return run_massql(mgf_path, queries_dict, workers=workers, result_cache=result_cache,
+                          task_id=task_id, store=store, progress_callback=progress_callback,
+                          run_report=run_report)
+
+    scan_lists = {}
+    with QueryExecutor(mgf_path, queries_dict, workers, result_cache, task_id, store,
+                       progress_callback, run_report) as executor:
+        # Queries outside the tree do not depend on anything, start them right away
+        tree_queries = set(_iter_tree_nodes(classification_tree))
+        pending = {
+            query_name: executor.submit(query_name)
+            for query_name in queries_dict if query_name not in tree_queries
+        }
+
+        level = [(node_name, children, None) for node_name, children in classification_tree.items()]
+        while level:
+            next_level = []
+            submitted = []
+            for node_name, children, parent_scans in level:
+                if node_name in queries_dict:
+                    submitted.append((node_name, children, executor.submit(node_name, parent_scans)))
+                elif isinstance(children, dict):
+                    # Category node without a query, its children see the same scans
+                    next_level.extend((child, grandchildren, parent_scans)
+                                      for child, grandchildren in children.items())
+            for node_name, children, future in submitted:
+                scan_lists[node_name] = future.result()
+                if isinstance(children, dict):
+                    node_scans = set(scan_lists[node_name])
+                    next_level.extend((child, grandchildren, node_scans)
+                                      for child, grandchildren in children.items())
+            level = next_level
+
+        for query_name, future in pending.items():
+            scan_lists[query_name] = future.result()
+
+    return [{"query": query_name, "scan_list": scan_lists[query_name]} for query_name in queries_dict]
+
+
+def can_run_inline(queries_dict: dict) -> bool:
+    """
+    Whether run_stage1_inline can evaluate queries_dict.
+
+    The queries are evaluated chunk by chunk while the MGF is streamed, so every query must
+    be supported by the vectorised engine and must not use X (its candidate values depend
+    on the whole file).
+    """
+    if not use_fast_path():
+        return False
+    for query_string in queries_dict.values():
+        compiled = compile_query(query_string)
+        if compiled is None or compiled.has_variable:
+            return False
+    return True
+
+
+class _InlineQueryFilter:
+    """
+    Block consumer for clean_mgf that evaluates queries on every chunk of kept blocks.
+
+    Blocks of spectra passing any query are written to passed_file (when given) as they
+    are, so the file is the same as copy_indexed_scans would write from the cleaned MGF.
+    The spectra of every chunk also go to index_writer when one is given.
+    """
+
+    def __init__(self, queries_dict: dict, passed_file, index_writer: FragmentIndexWriter = None):
+        self.compiled = {query_name: compile_query(query_string) for query_name, query_string in queries_dict.items()}
+        self.passed_file = passed_file
+        self.scan_lists = {query_name: [] for query_name in queries_dict}
+        self.query_seconds = {query_name: 0.0 for query_name in queries_dict}
+        self.passed_stores = []
+        self.index_writer = index_writer
+        self.total_blocks = 0
+        self.passed_blocks = 0
+
+    def __call__(self, buffer: bytes, blocks: list):
+        store = parse_spectra(buffer, blocks, self.total_blocks)
+        self.total_blocks += len(blocks)
+        if self.index_writer is not None:
+            self.index_writer.add(store)
+        # A chunk is evaluated once per query set, there is nothing to share between calls
+        engine = VectorisedEngine(store)
+        passed = np.zeros(len(store), dtype=bool)
+        for query_name, compiled in self.compiled.items():
+            start = time.perf_counter()
+            query_scans = engine.run(compiled)
+            self.query_seconds[query_name] += time.perf_counter() - start
+            self.scan_lists[query_name].extend(query_scans)
+            passed |= np.isin(store.scans, query_scans)
+        if not passed.any():
+            return
+
+        self.passed_stores.append(store.take(np.flatnonzero(passed)))
+        if self.passed_file is None:
+            self.passed_blocks += int(passed.sum())
+            return
+        passed_scans = set(store.scans[passed].tolist())
+        for start, _, block_end, scan in blocks:
+            # Like the scan index, blocks without SCANS= are never copied
+            if scan is not None and int(scan) in passed_scans:
+                self.passed_file.write(block_bytes(buffer, start, block_end, scan))
+                self.passed_blocks += 1
+
+
+def run_stage1_inline(input_mgf_path: Union[str, BinaryIO], cleaned_mgf_path: str, queries_dict: dict, passed_mgf_path: Optional[str],
+                      index_path: str = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                      run_report: QueryRunReport = None, fragment_index_path: str = None):
+    """
+    Clean, index and pre-filter an MGF in a single streaming pass.
+
+    Replaces clean_mgf + run_massql(stage 1 queries) + copy_indexed_scans: peakless blocks
+    are dropped, the stage 1 queries are evaluated on every chunk with the vectorised engine
+    and the blocks that pass any of them are written to passed_mgf_path. Only use it when
+    can_run_inline(queries_dict) is True.
+
+    Args:
+        input_mgf_path (str or file): Raw MGF file, or a binary file object it is read from,
+            e.g. a downloads.ResumableDownload (see clean_mgf).
+        cleaned_mgf_path (str): Where the cleaned MGF is written.
+        queries_dict (dict): Query name -> MassQL query string of the stage 1 queries.
+        passed_mgf_path (str or None): Where the blocks of the scans passing stage 1 are
+            written, None when only passed_store is needed.
+        index_path (str, optional): Scan index of the cleaned MGF, see clean_mgf.
+        chunk_size (int): Number of bytes read per chunk.
+        run_report (QueryRunReport, optional): Filled with the evaluation time of every query.
+        fragment_index_path (str, optional): Directory the FragmentIndex of all spectra of
+            the cleaned MGF is written to, for run_stage1_indexed. It is built on disk
+            chunk by chunk, memory use stays bounded.
+
+    Returns:
+        tuple: (scans_list, stage1_results, passed_store) with the SCANS= values of the
+            cleaned MGF, [{"query": query_name, "scan_list": [scan, ...]}, ...] in
+            queries_dict order and a SpectrumStore of the spectra passing stage 1.
+    """
+    if not can_run_inline(queries_dict):
+        raise ValueError("Queries can not be evaluated inline, use run_massql")
+
+    index_writer = FragmentIndexWriter(fragment_index_path) if fragment_index_path is not None else None
+    with contextlib.ExitStack() as stack:
+        passed_file = (stack.enter_context(compression.open_write(passed_mgf_path))
+                       if passed_mgf_path is not None else None)
+        inline_filter = _InlineQueryFilter(queries_dict, passed_file, index_writer)
+        scans_list = clean_mgf(input_mgf_path, cleaned_mgf_path, chunk_size=chunk_size,
+                               index_path=index_path, block_consumer=inline_filter)
+
+    logging.getLogger(__name__).info(
+        f"Total Scans: {inline_filter.total_blocks} ** Kept: {inline_filter.passed_blocks} scans ** "
+        f"Excluded: {inline_filter.total_blocks - inline_filter.passed_blocks}"
+    )
+    if index_writer is not None:
+        index_writer.finish()
+    if run_report is not None:
+        for query_name, seconds in inline_filter.query_seconds.items():
+            run_report.record(query_name, COMPUTED, seconds)
+    stage1_results = [
+        {"query": query_name, "scan_list": sorted(scan_list)}
+        for query_name, scan_list in inline_filter.scan_lists.items()
+    ]
+    return scans_list, stage1_results, SpectrumStore.concatenate(inline_filter.passed_stores)
+
+
+def run_stage1_indexed(cleaned_mgf_path: str, fragment_index_path: str, queries_dict: dict,
+                       passed_mgf_path: Optional[str], run_report: QueryRunReport = None):
+    """
+    Pre-filter an MGF already cleaned by run_stage1_inline, from its saved fragment index.
+
+    The spectra come from the memory-mapped index instead of parsing the MGF again. The
+    product ion conditions are answered from the postings of their m/z windows (there is
+    no X, see can_run_inline), so only the peaks of the passed spectra are loaded. With a
+    passed_mgf_path, the blocks of the passed scans are copied from the cleaned MGF with
+    its scan index.
+
+    Args:
+        cleaned_mgf_path (str): Cleaned MGF written by run_stage1_inline.
+        fragment_index_path (str): FragmentIndex directory written by run_stage1_inline.
+        queries_dict (dict): Query name -> MassQL query string of the stage 1 queries.
+        passed_mgf_path (str or None): Where the blocks of the scans passing stage 1 are
+            written, None when only passed_store is needed.
+        run_report (QueryRunReport, optional): Filled with the evaluation time of every query.
+
+    Returns:
+        tuple: (stage1_results, passed_store), as returned by run_stage1_inline.
+    """
+    if not can_run_inline(queries_dict):
+        raise ValueError("Queries can not be evaluated inline, use run_massql")
+
+    fragment_index = FragmentIndex.load(fragment_index_path)
+    store = fragment_index.header_store()
+    engine = SharedPredicateEngine(store, fragment_index)
+    stage1_results = []
+    passed = np.zeros(len(store), dtype=bool)
+    for query_name, query_string in queries_dict.items():
+        start = time.perf_counter()
+        query_scans = engine.run(compile_query(query_string))
+        if run_report is not None:
+            run_report.record(query_name, COMPUTED, time.perf_counter() - start)
+        stage1_results.append({"query": query_name, "scan_list": query_scans})
+        passed |= np.isin(store.scans, query_scans)
+
+    if run_report is not None:
+        run_report.record_predicates(engine)
+    passed_blocks = int(passed.sum())
+    if passed_mgf_path is not None:
+        passed_blocks = copy_indexed_scans(cleaned_mgf_path, passed_mgf_path, store.scans[passed],
+                                           load_scan_index(scan_index_path(cleaned_mgf_path)))
+    logging.getLogger(__name__).info(
+        f"Total Scans: {len(store)} ** Kept: {passed_blocks} scans ** Excluded: {len(store) - passed_blocks}"
+    )
+    return stage1_results, fragment_index.take(np.flatnonzero(passed))
+
 
-    return all_query_results_list
+def _iter_tree_nodes(tree):
+    """Yield every node name of a classification tree."""
+    for node_name, children in tree.items():
+        yield node_name
+        if isinstance(children, dict):
+            yield from _iter_tree_nodes(children)
 
 
 ### In case we want to redirect the stdout to streamlit
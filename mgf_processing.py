@@ -0,0 +1,341 @@
+import contextlib
+import logging
+import os
+import re
+from typing import BinaryIO, Callable, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+import compression
+from spectrum_store import SpectrumStore
+
+# Size of the read/write buffers used when streaming MGF files
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Headers (PEPMASS=, SCANS=, ...) start with a letter, so a line starting with a digit is a peak
+PEAK_LINE_PATTERN = re.compile(rb"^[0-9]", re.M)
+SCANS_PATTERN = re.compile(rb"^SCANS=([^\r\n]*)", re.M)
+PEPMASS_PATTERN = re.compile(rb"^PEPMASS=([^\r\n]*)", re.M)
+# Peak values as the MGF readers accept them, including signs and a leading dot
+PEAK_VALUE_LINE_PATTERN = re.compile(rb"^[-+.0-9]", re.M)
+
+# Extension of the sidecar file that maps SCANS= values to byte ranges of the cleaned MGF
+SCAN_INDEX_SUFFIX = ".scanidx.npy"
+
+
+def scan_index_path(mgf_path: str) -> str:
+    """Path of the scan index written next to a cleaned MGF file."""
+    return mgf_path + SCAN_INDEX_SUFFIX
+
+
+def _find_block_start(buffer: bytes, position: int) -> int:
+    """Offset of the next BEGIN IONS at the start of a line, or -1."""
+    start = buffer.find(b"BEGIN IONS", position)
+    while start > 0 and buffer[start - 1] != 0x0A:
+        start = buffer.find(b"BEGIN IONS", start + 1)
+    return start
+
+
+# A kept block handed to a block consumer: (start, end, block_end, scan) where buffer[start:block_end]
+# is the whole block, end is the offset of the newline before END IONS and scan the SCANS= value
+# written to the cleaned MGF or None (see block_bytes)
+KeptBlock = Tuple[int, int, int, Optional[str]]
+
+
+def _open_binary(source: Union[str, BinaryIO]):
+    """
+    Context manager reading source, a path (opened and closed, decompressed if its suffix
+    says so) or a file object (left open).
+    """
+    if hasattr(source, "read"):
+        return contextlib.nullcontext(source)
+    return compression.open_read(source)
+
+
+# MassQL, the scan index and SpectrumStore need integer scans. SCANS= values that are not
+# integers (e.g. F1:1) are replaced in the cleaned MGF by minus their 1-based position in
+# the scans list of clean_mgf, renamed_scans maps them back.
+def is_scan_number(scan: str) -> bool:
+    """Whether a SCANS= value is an integer and kept as is in the cleaned MGF."""
+    try:
+        int(scan)
+    except ValueError:
+        return False
+    return True
+
+
+def renamed_scans(scans_list: List[str]) -> dict:
+    """
+    SCANS= values clean_mgf replaced in the cleaned MGF, {scan in the cleaned MGF: SCANS= value}.
+
+    Args:
+        scans_list (list): SCANS= values returned by clean_mgf.
+    """
+    return {-position: scan for position, scan in enumerate(scans_list, 1) if not is_scan_number(scan)}
+
+
+def block_bytes(buffer: bytes, start: int, block_end: int, scan: Optional[str]) -> bytes:
+    """A block handed to a block consumer as clean_mgf writes it, with its SCANS= value replaced if it was."""
+    # Replaced values are negative, a negative SCANS= value can also be in the file as it is
+    if scan is None or not scan.startswith("-"):
+        return buffer[start:block_end]
+    scan_match = SCANS_PATTERN.search(buffer, start, block_end)
+    if scan_match.group(1).strip().decode() == scan:
+        return buffer[start:block_end]
+    return buffer[start:scan_match.start(1)] + scan.encode() + buffer[scan_match.end(1):block_end]
+
+
+def clean_mgf(input_mgf_path: Union[str, BinaryIO], output_mgf_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+              index_path: Optional[str] = None,
+              block_consumer: Optional[Callable[[bytes, List[KeptBlock]], None]] = None) -> List[str]:
+    """
+    Stream an MGF file and drop every BEGIN IONS/END IONS block without peaks.
+
+    The input is read in chunks of chunk_size bytes and every complete block in the
+    current chunk is written straight to the output if it has at least one peak line.
+    Only the unfinished block at the end of a chunk is carried over to the next one, so
+    peak memory is bounded by the chunk size and not by the size of the file. SCANS=
+    values that are not integers are replaced by negative numbers (see renamed_scans).
+
+    Args:
+        input_mgf_path (str or file): Path to the raw MGF file, or a binary file object it
+            is read from (e.g. a downloads.ResumableDownload, cleaned while it arrives).
+        output_mgf_path (str): Path where the cleaned MGF file is written.
+        chunk_size (int): Number of bytes read per chunk.
+        index_path (str, optional): If given, a scan index of the cleaned file is saved
+            there (see load_scan_index).
+        block_consumer (callable, optional): Called once per chunk with the chunk buffer and
+            the blocks kept from it, in file order. Lets other stages look at the spectra
+            during the same pass (see parse_spectra).
+
+    Returns:
+        list: SCANS= values (as strings) of the kept blocks in the input, in file order.
+    """
+    scans_list = []
+    scan_numbers = []
+    block_offsets = []
+    block_lengths = []
+    total_blocks = 0
+    written = 0
+    leftover = b""
+
+    with _open_binary(input_mgf_path) as infile, compression.open_write(output_mgf_path, chunk_size) as outfile:
+        while True:
+            chunk = infile.read(chunk_size)
+            buffer = leftover + chunk
+            view = memoryview(buffer)
+
+            position = 0
+            kept_blocks = []
+            while True:
+                start = _find_block_start(buffer, position)
+                if start < 0:
+                    break
+                end = buffer.find(b"\nEND IONS", start)
+                if end < 0:
+                    break
+                block_end = buffer.find(b"\n", end + 1)
+                if block_end >= 0:
+                    block_end += 1
+                elif chunk:
+                    # END IONS line is not complete yet, wait for the next chunk
+                    break
+                else:
+                    block_end = len(buffer)
+
+                # Anything between blocks is kept as is
+                outfile.write(view[position:start])
+                written += start - position
+                position = block_end
+                total_blocks += 1
+
+                if PEAK_LINE_PATTERN.search(buffer, start, end + 1) is None:
+                    continue
+                scan_match = SCANS_PATTERN.search(buffer, start, end + 1)
+                scan = None
+                block = view[start:block_end]
+                if scan_match is not None:
+                    scan = scan_match.group(1).strip().decode()
+                    scans_list.append(scan)
+                    if not is_scan_number(scan):
+                        scan = str(-len(scans_list))
+                        block = block_bytes(buffer, start, block_end, scan)
+                    scan_numbers.append(int(scan))
+                    block_offsets.append(written)
+                    block_lengths.append(len(block))
+                outfile.write(block)
+                written += len(block)
+                kept_blocks.append((start, end, block_end, scan))
+
+            view.release()
+            if block_consumer is not None and kept_blocks:
+                block_consumer(buffer, kept_blocks)
+            leftover = buffer[position:]
+            if not chunk:
+                break
+
+        # A trailing block without END IONS is incomplete and dropped
+        unfinished_block = _find_block_start(leftover, 0)
+        outfile.write(leftover if unfinished_block < 0 else leftover[:unfinished_block])
+
+    logging.info(f"Total blocks: {total_blocks} ** Kept: {len(block_offsets)} ** "
+                 f"Removed (no peaks): {total_blocks - len(block_offsets)}")
+
+    if index_path is not None:
+        save_scan_index(index_path, scan_numbers, block_offsets, block_lengths)
+
+    return scans_list
+
+
+def _parse_peak_lines(region: bytes) -> List[bytes]:
+    """m/z and intensity tokens of the peak lines of a block, for lines that are not plain pairs."""
+    tokens = []
+    for line in region.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and PEAK_VALUE_LINE_PATTERN.match(line):
+            tokens.extend(parts[:2])
+    return tokens
+
+
+def parse_spectra(buffer: bytes, blocks: List[KeptBlock], first_ordinal: int = 0) -> SpectrumStore:
+    """
+    Parse blocks of an MGF buffer into a SpectrumStore, the way MassQL loads MGF files.
+
+    Zero intensity peaks are dropped, intensities are normalised to the maximum of the
+    spectrum, the precursor m/z is the first PEPMASS= value and spectra without SCANS= get
+    their 1-based position in the file (first_ordinal + position in blocks + 1).
+    Spectra left without peaks are not part of the store.
+
+    Args:
+        buffer (bytes): Chunk buffer the block offsets refer to.
+        blocks (list): Blocks as passed to the block_consumer of clean_mgf.
+        first_ordinal (int): Number of blocks that came before blocks in the file.
+
+    Returns:
+        SpectrumStore: One spectrum per block with peaks, in block order.
+    """
+    scans = np.empty(len(blocks), dtype=np.int64)
+    precmz = np.zeros(len(blocks), dtype=np.float64)
+    peak_counts = np.zeros(len(blocks), dtype=np.int64)
+    tokens = []
+    for position, (start, end, _, scan) in enumerate(blocks):
+        scans[position] = int(scan) if scan is not None else first_ordinal + position + 1
+        pepmass_match = PEPMASS_PATTERN.search(buffer, start, end + 1)
+        if pepmass_match is not None:
+            pepmass = pepmass_match.group(1).split()
+            if pepmass:
+                precmz[position] = float(pepmass[0])
+
+        first_peak = PEAK_VALUE_LINE_PATTERN.search(buffer, start, end + 1)
+        if first_peak is None:
+            continue
+        region = buffer[first_peak.start():end + 1]
+        block_tokens = region.split()
+        # Fast path for plain "m/z intensity" lines, anything else is parsed line by line
+        if len(block_tokens) != 2 * (region.count(b"\n") or 1):
+            block_tokens = _parse_peak_lines(region)
+        peak_counts[position] = len(block_tokens) // 2
+        tokens.extend(block_tokens)
+
+    values = np.fromiter(map(float, tokens), dtype=np.float64, count=len(tokens))
+    mz, intensity = values[0::2], values[1::2]
+    peak_block = np.repeat(np.arange(len(blocks)), peak_counts)
+
+    # MassQL normalises by the maximum over all peaks, then skips the zero intensity ones
+    block_max = np.full(len(blocks), -np.inf)
+    np.maximum.at(block_max, peak_block, intensity)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        intensity_norm = intensity / block_max[peak_block]
+    nonzero = intensity != 0
+    mz, intensity, intensity_norm, peak_block = mz[nonzero], intensity[nonzero], intensity_norm[nonzero], peak_block[nonzero]
+
+    counts = np.bincount(peak_block, minlength=len(blocks))
+    has_peaks = counts > 0
+    # Peaks sorted by m/z inside every spectrum
+    order = np.lexsort((mz, peak_block))
+    offsets = np.zeros(int(has_peaks.sum()) + 1, dtype=np.int64)
+    np.cumsum(counts[has_peaks], out=offsets[1:])
+    return SpectrumStore(
+        scans=scans[has_peaks],
+        precmz=precmz[has_peaks],
+        offsets=offsets,
+        mz=mz[order],
+        intensity=intensity[order],
+        intensity_norm=intensity_norm[order],
+    )
+
+
+def save_scan_index(index_path: str, scans: List[int], offsets: List[int], lengths: List[int]):
+    """Save a (n, 3) int64 array of [scan, byte offset, byte length] rows, scans as in the cleaned MGF."""
+    index = np.empty((len(scans), 3), dtype=np.int64)
+    index[:, 0] = scans
+    index[:, 1] = offsets
+    index[:, 2] = lengths
+    np.save(index_path, index)
+
+
+def load_scan_index(index_path: str) -> np.ndarray:
+    """Load a scan index saved by save_scan_index, rows are in file order."""
+    return np.load(index_path)
+
+
+def _copy_file_range(infile, outfile, offset: int, length: int, buffer: bytearray, use_sendfile: bool = True):
+    """Copy length bytes starting at offset, with sendfile when allowed and the platform has it."""
+    if use_sendfile and hasattr(os, "sendfile"):
+        out_fd, in_fd = outfile.fileno(), infile.fileno()
+        while length > 0:
+            sent = os.sendfile(out_fd, in_fd, offset, length)
+            if sent == 0:
+                raise EOFError(f"Unexpected end of file while copying offset {offset}")
+            offset += sent
+            length -= sent
+        return
+
+    view = memoryview(buffer)
+    infile.seek(offset)
+    while length > 0:
+        read = infile.readinto(view[:min(length, len(buffer))])
+        if read == 0:
+            raise EOFError(f"Unexpected end of file while copying offset {offset}")
+        outfile.write(view[:read])
+        length -= read
+
+
+def copy_indexed_scans(input_mgf_path: str, output_mgf_path: str, scans_to_keep: Iterable,
+                       index: np.ndarray, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Write the blocks of the scans in scans_to_keep to a new MGF using a scan index.
+
+    Only the kept byte ranges are read, adjacent blocks are merged into a single copy.
+
+    Args:
+        input_mgf_path (str): Cleaned MGF the index was built for, compressed or not.
+        output_mgf_path (str): Path of the filtered MGF file, compressed if its suffix says so.
+        scans_to_keep: Scan numbers (as strings or ints) to keep.
+        index (np.ndarray): Scan index from load_scan_index.
+        chunk_size (int): Copy buffer size when sendfile is not available.
+
+    Returns:
+        int: Number of blocks written.
+    """
+    keep = np.fromiter((int(scan) for scan in scans_to_keep), dtype=np.int64)
+    kept_rows = index[np.isin(index[:, 0], keep)]
+    kept_rows = kept_rows[np.argsort(kept_rows[:, 1], kind="stable")]
+
+    # Merge blocks that directly follow each other into one range
+    starts = kept_rows[:, 1]
+    ends = starts + kept_rows[:, 2]
+    new_range = np.ones(len(kept_rows), dtype=bool)
+    new_range[1:] = starts[1:] != ends[:-1]
+    range_starts = starts[new_range]
+    range_ends = np.maximum.reduceat(ends, np.flatnonzero(new_range)) if len(kept_rows) else ends
+
+    copy_buffer = bytearray(chunk_size)
+    # sendfile only copies between plain files, a compressed input is read front to back
+    # (the ranges are in file order, every seek is forward)
+    plain = compression.codec_of(input_mgf_path) == compression.codec_of(output_mgf_path) == "none"
+    with compression.open_read(input_mgf_path) as infile, compression.open_write(output_mgf_path) as outfile:
+        for range_start, range_end in zip(range_starts.tolist(), range_ends.tolist()):
+            _copy_file_range(infile, outfile, range_start, range_end - range_start, copy_buffer, plain)
+
+    return len(kept_rows)
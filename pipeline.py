@@ -0,0 +1,560 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import compression
+import downloads
+import massql_launch
+from fragment_index import FRAGMENT_INDEX_DIR, FRAGMENT_INDEX_VERSION
+from mgf_processing import clean_mgf, copy_indexed_scans, load_scan_index, renamed_scans, scan_index_path
+from query_matrix import QueryHitMatrix, normalize_massql_results
+from result_cache import ResultCache, file_digest
+from spectrum_compaction import compact_mgf, compact_store, compaction_windows, use_compaction
+from spectrum_store import SpectrumStore
+from tree_classifier import check_classification_paths, compile_tree
+
+# Everything the analysis needs outside of the UI, without importing Streamlit. Used by the
+# job workers (job_queue.py) and the batch command line (batch_annotate.py).
+
+# Spectra passing stage 1 as a SpectrumStore (see SpectrumStore.save), in the stage 1 entry,
+# and the same spectra compacted for stage 2
+STAGE1_STORE_DIR = "stage1_passed.spectra"
+COMPACT_STORE_DIR = "stage2_compact.spectra"
+# Bump when the files of the "mgf_stage1" entries change
+STAGE1_FORMAT_VERSION = 2
+# Bump when the files of the "mgf_cleaned" entries change
+CLEANED_FORMAT_VERSION = 2
+
+# Columns of an empty library match table, e.g. for local MGF files
+LIBRARY_MATCH_COLUMNS = ["#Scan#", "Compound_Name"]
+# First columns of the result views (see derive_result_views)
+RESULT_VIEW_COLUMNS = ["#Scan#", "Compound_Name", "classification"]
+
+
+def stage1_queries(queries_dict: dict) -> dict:
+    """Stage 1 queries of queries_dict, the ones with "stage1" in their name."""
+    return {key: value for key, value in queries_dict.items() if "stage1" in key.lower()}
+
+
+def download_mgf(task_id: str, result_cache: ResultCache) -> (str, str):
+    """Raw MGF of a task from the result cache, downloaded on a miss. Returns (path, sha256 digest)."""
+    mgf_key = result_cache.key(task_id)
+    mgf_entry = result_cache.get("mgf_all", mgf_key)
+    if mgf_entry is None:
+        with result_cache.partial_dir("mgf_all", mgf_key) as partial_dir:
+            if partial_dir is not None:
+                logging.info("Downloading mgf...")
+                mgf_file_path = os.path.join(partial_dir, "all.mgf")
+                with compression.open_write(compression.compressed_path(mgf_file_path)) as mgf_file:
+                    mgf_digest = downloads.download_file(downloads.task_file_url(task_id, downloads.FBMN_MGF_FILE),
+                                                         mgf_file_path, copy_to=mgf_file, keep_file=False)
+                with open(os.path.join(partial_dir, "digest.txt"), "w") as f:
+                    f.write(mgf_digest)
+                result_cache.adopt("mgf_all", mgf_key, partial_dir)
+        mgf_entry = result_cache.get("mgf_all", mgf_key)
+    mgf_file_path = compression.find_file(os.path.join(mgf_entry, "all.mgf"))
+    with open(os.path.join(mgf_entry, "digest.txt"), "r") as f:
+        mgf_digest = f.read().strip()
+    logging.info(f"MGF available at {mgf_file_path}")
+    return mgf_file_path, mgf_digest
+
+
+def download_library_matches(task_id: str, result_cache: ResultCache) -> pd.DataFrame:
+    """Library matches of a GNPS FBMN task, from the result cache or downloaded on a miss."""
+    library_key = result_cache.key(task_id)
+    library_entry = result_cache.get("library_matches", library_key)
+    if library_entry is None:
+        with result_cache.partial_dir("library_matches", library_key) as partial_dir:
+            if partial_dir is not None:
+                downloads.download_file(downloads.task_file_url(task_id, downloads.FBMN_LIBRARY_MATCHES_FILE),
+                                        os.path.join(partial_dir, "library_matches.tsv"))
+                result_cache.adopt("library_matches", library_key, partial_dir)
+        library_entry = result_cache.get("library_matches", library_key)
+    return pd.read_csv(os.path.join(library_entry, "library_matches.tsv"), sep="\t")
+
+
+def clean_and_index_mgf(mgf_file_path: str, mgf_digest: str, result_cache: ResultCache,
+                        task_id: str = "") -> (str, list):
+    """Cleaned copy of an MGF (scans without peaks removed) and its scan list, from the result cache."""
+    def clean(entry_dir):
+        logging.info("Starting MGF filtering...")
+        # Remove scans without peaks, collect the scan numbers and index the kept blocks in a single streaming pass
+        cleaned_mgf = compression.compressed_path(os.path.join(entry_dir, "cleaned.mgf"))
+        scans_list = clean_mgf(mgf_file_path, cleaned_mgf, index_path=scan_index_path(cleaned_mgf))
+        with open(os.path.join(entry_dir, "scans.json"), "w") as f:
+            json.dump(scans_list, f)
+
+    cleaned_key = result_cache.key(task_id, mgf_digest, CLEANED_FORMAT_VERSION)
+    cleaned_entry = result_cache.get("mgf_cleaned", cleaned_key) or result_cache.put("mgf_cleaned", cleaned_key, clean)
+    cleaned_mgf = compression.find_file(os.path.join(cleaned_entry, "cleaned.mgf"))
+    with open(os.path.join(cleaned_entry, "scans.json"), "r") as f:
+        scans_list = json.load(f)
+    logging.info(f"Cleaned MGF available at {cleaned_mgf}")
+    return cleaned_mgf, scans_list
+
+
+def prefilter_mgf(mgf_file_path: str, mgf_digest: str, stage1: dict, result_cache: ResultCache,
+                  task_id: str = "", run_report: massql_launch.QueryRunReport = None):
+    """
+    Clean an MGF and apply the stage 1 queries in a single pass.
+
+    Uses massql_launch.run_stage1_inline, the raw MGF is streamed once instead of being
+    cleaned, parsed by MassQL, filtered and parsed again. Falls back to the separate steps
+    when the stage 1 queries can not be evaluated inline.
+
+    The cleaned MGF is cached with its scan index and a FragmentIndex of its spectra
+    ("mgf_indexed"), separately from the stage 1 outputs ("mgf_stage1"). When only the
+    stage 1 queries changed, they are evaluated on the saved index with
+    massql_launch.run_stage1_indexed and the raw MGF is not read again.
+
+    The spectra passing stage 1 are saved as a SpectrumStore and loaded memory-mapped,
+    stage 2 runs on slices of it. No MGF of them is written, write_stage1_passed_mgf
+    writes one when some stage 2 query needs MassQL.
+
+    Args:
+        mgf_file_path (str): Raw MGF file.
+        mgf_digest (str): sha256 digest of mgf_file_path, part of the cache keys.
+        stage1 (dict): Stage 1 query name -> MassQL query string.
+        result_cache (ResultCache): Cache the outputs are stored in.
+        task_id (str): Task the MGF belongs to, empty for local files.
+        run_report (QueryRunReport, optional): Filled with the computed or reused stage 1 queries.
+
+    Returns:
+        tuple: (cleaned_mgf, scans_list, stage1_results, stage1_passed_mgf, stage1_store).
+            Either stage1_store holds the spectra passing stage 1 (stage1_passed_mgf is
+            None), or for the fallback stage1_passed_mgf is an MGF of them (stage1_store
+            is None).
+    """
+    if not massql_launch.can_run_inline(stage1):
+        cleaned_mgf, scans_list = clean_and_index_mgf(mgf_file_path, mgf_digest, result_cache, task_id)
+        stage1_results = massql_launch.run_massql(cleaned_mgf, stage1, result_cache=result_cache, task_id=task_id,
+                                                  run_report=run_report)
+        scans_to_keep = set(scan for result in stage1_results for scan in result["scan_list"])
+        massql_launch.use_feather_dir()
+        stage1_passed_mgf = compression.compressed_path(
+            os.path.join(massql_launch.FEATHER_DIR, f"{task_id or mgf_digest[:16]}_stg1_passed.mgf")
+        )
+        copy_indexed_scans(cleaned_mgf, stage1_passed_mgf, scans_to_keep,
+                           load_scan_index(scan_index_path(cleaned_mgf)))
+        return cleaned_mgf, scans_list, stage1_results, stage1_passed_mgf, None
+
+    indexed_key, stage1_key = _prefilter_keys(result_cache, task_id, mgf_digest, stage1)
+    indexed_entry = result_cache.get("mgf_indexed", indexed_key)
+    stage1_entry = result_cache.get("mgf_stage1", stage1_key)
+
+    def clean_and_prefilter(indexed_dir):
+        nonlocal stage1_entry
+        stage1_entry = result_cache.put("mgf_stage1", stage1_key, lambda stage1_dir: _clean_and_prefilter_into(
+            mgf_file_path, indexed_dir, stage1_dir, stage1, run_report
+        ))
+
+    def prefilter_indexed(entry_dir):
+        logging.info("Running Stage 1 queries on the fragment index...")
+        stage1_results, stage1_store = massql_launch.run_stage1_indexed(
+            compression.find_file(os.path.join(indexed_entry, "cleaned.mgf")),
+            os.path.join(indexed_entry, FRAGMENT_INDEX_DIR),
+            stage1, None, run_report=run_report,
+        )
+        _write_stage1(entry_dir, stage1_results, stage1_store)
+
+    if indexed_entry is None:
+        # One streaming pass writes both entries
+        indexed_entry = result_cache.put("mgf_indexed", indexed_key, clean_and_prefilter)
+    elif stage1_entry is None:
+        stage1_entry = result_cache.put("mgf_stage1", stage1_key, prefilter_indexed)
+    elif run_report is not None:
+        for query_name in stage1:
+            run_report.record(query_name, massql_launch.REUSED)
+    return _read_prefilter_entries(indexed_entry, stage1_entry)
+
+
+def _prefilter_keys(result_cache: ResultCache, task_id: str, mgf_digest: str, stage1: dict) -> (str, str):
+    """Keys of the "mgf_indexed" and "mgf_stage1" entries of prefilter_mgf."""
+    return (result_cache.key(task_id, mgf_digest, "fragments", FRAGMENT_INDEX_VERSION),
+            result_cache.key(task_id, mgf_digest, json.dumps(stage1, sort_keys=True), STAGE1_FORMAT_VERSION))
+
+
+def _write_stage1(stage1_dir: str, stage1_results: list, stage1_store: SpectrumStore):
+    with open(os.path.join(stage1_dir, "stage1.json"), "w") as f:
+        json.dump(stage1_results, f)
+    stage1_store.save(os.path.join(stage1_dir, STAGE1_STORE_DIR))
+
+
+def _clean_and_prefilter_into(mgf_source, indexed_dir: str, stage1_dir: str, stage1: dict,
+                              run_report: massql_launch.QueryRunReport = None):
+    """Fill the "mgf_indexed" and "mgf_stage1" entry directories from a raw MGF path or stream."""
+    logging.info("Cleaning MGF and running Stage 1 queries...")
+    cleaned_mgf = compression.compressed_path(os.path.join(indexed_dir, "cleaned.mgf"))
+    scans_list, stage1_results, stage1_store = massql_launch.run_stage1_inline(
+        mgf_source, cleaned_mgf, stage1, None, index_path=scan_index_path(cleaned_mgf), run_report=run_report,
+        fragment_index_path=os.path.join(indexed_dir, FRAGMENT_INDEX_DIR),
+    )
+    _write_stage1(stage1_dir, stage1_results, stage1_store)
+    with open(os.path.join(indexed_dir, "scans.json"), "w") as f:
+        json.dump(scans_list, f)
+
+
+def _read_prefilter_entries(indexed_entry: str, stage1_entry: str):
+    """Outputs of prefilter_mgf from its two entries."""
+    with open(os.path.join(indexed_entry, "scans.json"), "r") as f:
+        scans_list = json.load(f)
+    with open(os.path.join(stage1_entry, "stage1.json"), "r") as f:
+        stage1_results = json.load(f)
+    stage1_store = SpectrumStore.load(os.path.join(stage1_entry, STAGE1_STORE_DIR))
+    cleaned_mgf = compression.find_file(os.path.join(indexed_entry, "cleaned.mgf"))
+    return cleaned_mgf, scans_list, stage1_results, None, stage1_store
+
+
+def download_and_prefilter_mgf(task_id: str, stage1: dict, result_cache: ResultCache,
+                               run_report: massql_launch.QueryRunReport = None):
+    """
+    prefilter_mgf for the MGF of a GNPS task, cleaned and pre-filtered while it downloads.
+
+    The raw MGF goes through a downloads.ResumableDownload straight into
+    massql_launch.run_stage1_inline, it is written to the cache at the same time but never
+    read back. The entries are stored once the download is complete and verified (their
+    keys need the digest of the MGF). Falls back to download_mgf + prefilter_mgf when the
+    MGF is already cached or the stage 1 queries can not be evaluated inline.
+
+    Returns:
+        tuple: (mgf_file_path, mgf_digest) followed by the outputs of prefilter_mgf.
+    """
+    mgf_key = result_cache.key(task_id)
+    if result_cache.get("mgf_all", mgf_key) is None and massql_launch.can_run_inline(stage1):
+        with result_cache.partial_dir("mgf_all", mgf_key) as partial_dir:
+            if partial_dir is not None:
+                outputs = _stream_and_prefilter(task_id, stage1, result_cache, partial_dir, run_report)
+                result_cache.adopt("mgf_all", mgf_key, partial_dir)
+                return outputs
+    mgf_file_path, mgf_digest = download_mgf(task_id, result_cache)
+    return (mgf_file_path, mgf_digest) + prefilter_mgf(mgf_file_path, mgf_digest, stage1, result_cache, task_id,
+                                                       run_report)
+
+
+def _stream_and_prefilter(task_id: str, stage1: dict, result_cache: ResultCache, partial_dir: str,
+                          run_report: massql_launch.QueryRunReport = None):
+    """Download the MGF of a task into partial_dir while filling the prefilter_mgf entries from it."""
+    indexed_dir = result_cache.scratch_dir()
+    stage1_dir = result_cache.scratch_dir()
+    try:
+        mgf_url = downloads.task_file_url(task_id, downloads.FBMN_MGF_FILE)
+        mgf_file_path = os.path.join(partial_dir, "all.mgf")
+        with compression.open_write(compression.compressed_path(mgf_file_path)) as mgf_file, \
+                downloads.ResumableDownload(mgf_url, mgf_file_path, copy_to=mgf_file, keep_file=False) as download:
+            logging.info("Downloading mgf, cleaning it and running Stage 1 queries on the way...")
+            _clean_and_prefilter_into(download, indexed_dir, stage1_dir, stage1, run_report)
+        mgf_digest = download.hexdigest()
+        with open(os.path.join(partial_dir, "digest.txt"), "w") as f:
+            f.write(mgf_digest)
+        indexed_key, stage1_key = _prefilter_keys(result_cache, task_id, mgf_digest, stage1)
+        indexed_entry = result_cache.adopt("mgf_indexed", indexed_key, indexed_dir)
+        stage1_entry = result_cache.adopt("mgf_stage1", stage1_key, stage1_dir)
+    finally:
+        for directory in (indexed_dir, stage1_dir):
+            shutil.rmtree(directory, ignore_errors=True)
+    mgf_entry = result_cache.entry_path("mgf_all", result_cache.key(task_id))
+    mgf_file_path = compression.find_file(os.path.join(mgf_entry, "all.mgf"))
+    return (mgf_file_path, mgf_digest) + _read_prefilter_entries(indexed_entry, stage1_entry)
+
+
+def write_stage1_passed_mgf(cleaned_mgf: str, stage1_store: SpectrumStore, stage1: dict, mgf_digest: str,
+                            result_cache: ResultCache, task_id: str = "") -> str:
+    """
+    MGF of the spectra of stage1_store, copied from the cleaned MGF with its scan index.
+
+    Only needed when MassQL evaluates some stage 2 queries, cached like the stage 1 entry.
+    """
+    def copy_passed(entry_dir):
+        copy_indexed_scans(cleaned_mgf, compression.compressed_path(os.path.join(entry_dir, "stage1_passed.mgf")),
+                           stage1_store.scans, load_scan_index(scan_index_path(cleaned_mgf)))
+
+    passed_key = result_cache.key(task_id, mgf_digest, json.dumps(stage1, sort_keys=True), STAGE1_FORMAT_VERSION)
+    passed_entry = (result_cache.get("mgf_stage1_passed", passed_key)
+                    or result_cache.put("mgf_stage1_passed", passed_key, copy_passed))
+    return compression.find_file(os.path.join(passed_entry, "stage1_passed.mgf"))
+
+
+def compact_stage2_input(stage1_passed_mgf: Optional[str], stage1_store: Optional[SpectrumStore],
+                         queries_dict: dict, stage1: dict, mgf_digest: str, result_cache: ResultCache,
+                         task_id: str = ""):
+    """
+    Strip the peaks none of the queries can use from the stage 2 input (see spectrum_compaction).
+
+    The compacted MGF and store (whichever of stage1_passed_mgf and stage1_store are given)
+    are cached per input MGF, stage 1 queries and query set. Queries the vectorised engine
+    does not support leave the input as it is.
+
+    Returns:
+        tuple: (stage2_mgf, stage2_store), each None if its input is.
+    """
+    windows = compaction_windows(queries_dict)
+    if windows is None:
+        logging.info("Not compacting the stage 2 input, some queries need the full spectra")
+        return stage1_passed_mgf, stage1_store
+
+    def compact(entry_dir):
+        if stage1_passed_mgf is not None:
+            compact_mgf(stage1_passed_mgf, compression.compressed_path(os.path.join(entry_dir, "stage2_compact.mgf")),
+                        windows)
+        if stage1_store is not None:
+            compact_store(stage1_store, windows).save(os.path.join(entry_dir, COMPACT_STORE_DIR))
+
+    compact_key = result_cache.key(task_id, mgf_digest, json.dumps(stage1, sort_keys=True),
+                                   json.dumps(queries_dict, sort_keys=True), STAGE1_FORMAT_VERSION,
+                                   stage1_passed_mgf is not None, stage1_store is not None)
+    compact_entry = result_cache.get("mgf_compact", compact_key) or result_cache.put("mgf_compact", compact_key, compact)
+    stage2_mgf = (compression.find_file(os.path.join(compact_entry, "stage2_compact.mgf"))
+                  if stage1_passed_mgf is not None else None)
+    stage2_store = SpectrumStore.load(os.path.join(compact_entry, COMPACT_STORE_DIR)) if stage1_store is not None else None
+    return stage2_mgf, stage2_store
+
+
+def reclaim_orphans(result_cache: ResultCache = None) -> dict:
+    """
+    Remove what crashed runs left in the result cache and FEATHER_DIR, and evict the cache
+    down to its byte budget. Called when the job workers or a batch start.
+
+    Returns:
+        dict: ResultCache.usage() afterwards, the feather files count as reclaimed orphans.
+    """
+    result_cache = result_cache or ResultCache()
+    files, freed = massql_launch.reclaim_feather_dir()
+    if files:
+        result_cache.add_stats(reclaimed_orphans=files, reclaimed_bytes=freed)
+    usage = result_cache.reclaim_orphans()
+    logging.info(f"Result cache: {usage['bytes']} of {usage['max_bytes']} bytes in {usage['entries']} entries, "
+                 f"{usage['reclaimed_orphans']} orphans reclaimed and {usage['evicted_entries']} entries evicted so far")
+    return usage
+
+
+def run_analysis(task_id: str, queries_dict: dict, classification_tree: dict, full_evaluation: bool = False,
+                 result_cache: ResultCache = None, workers: int = None, mgf_path: str = None,
+                 library_matches: pd.DataFrame = None,
+                 progress_callback: Callable[[str, float, str], None] = None, compact: bool = None) -> dict:
+    """
+    Stage 1 and the classification tree queries for a GNPS task or a local MGF file.
+
+    Args:
+        task_id (str): FBMN task id. For a local file, a name for it (part of the cache keys).
+        queries_dict (dict): Query name -> MassQL query string.
+        classification_tree (dict): Tree from bile_acid_tree.yaml.
+        full_evaluation (bool): Evaluate every query on every scan (see run_massql_tree).
+        result_cache (ResultCache, optional): Defaults to a ResultCache in the default directory.
+        workers (int, optional): MassQL worker processes, defaults to get_worker_count().
+        mgf_path (str, optional): Local MGF file, analysed instead of downloading the task.
+        library_matches (pd.DataFrame, optional): Library matches, downloaded for GNPS tasks
+            and empty for local files when omitted.
+        progress_callback (callable, optional): Called with (stage, fraction, message),
+            stage being "download", "stage1" or "stage2".
+        compact (bool, optional): Strip the peaks no query can use before stage 2, defaults
+            to use_compaction(). The results are the same either way.
+
+    Returns:
+        dict: {"library_matches", "all_scans", "massql_results"}, the inputs of process_results,
+            and "query_report", the QueryRunReport of the run.
+    """
+    result_cache = result_cache or ResultCache()
+    query_report = massql_launch.QueryRunReport()
+    report = progress_callback or (lambda stage, fraction, message: None)
+
+    def fetch_library_matches():
+        with result_cache.use(task_id):
+            return download_library_matches(task_id, result_cache)
+
+    # Pins the cache entries of this run, eviction by other runs cannot remove them meanwhile
+    with result_cache.use(task_id):
+        if mgf_path is None:
+            report("download", 0.0, "Downloading the MGF and library matches")
+            # The library matches download alongside the MGF, which is pre-filtered as it arrives
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                library_future = None
+                if library_matches is None:
+                    library_future = executor.submit(fetch_library_matches)
+                report("stage1", 0.0, "Downloading files and running Stage 1 queries")
+                mgf_path, mgf_digest, cleaned_mgf, all_mgf_scans, _, stage1_passed_mgf, stage1_store = \
+                    download_and_prefilter_mgf(task_id, stage1_queries(queries_dict), result_cache, query_report)
+                if library_future is not None:
+                    library_matches = library_future.result()
+        else:
+            if library_matches is None:
+                library_matches = pd.DataFrame(columns=LIBRARY_MATCH_COLUMNS)
+            report("stage1", 0.0, "Running Stage 1 queries")
+            mgf_digest = file_digest(mgf_path)
+            cleaned_mgf, all_mgf_scans, _, stage1_passed_mgf, stage1_store = prefilter_mgf(
+                mgf_path, mgf_digest, stage1_queries(queries_dict), result_cache, task_id, query_report
+            )
+        if stage1_passed_mgf is None and not massql_launch.runs_on_store(queries_dict):
+            # Stage 2 runs on the store unless MassQL has to parse an MGF for some query
+            stage1_passed_mgf = write_stage1_passed_mgf(cleaned_mgf, stage1_store, stage1_queries(queries_dict),
+                                                        mgf_digest, result_cache, task_id)
+        if use_compaction() if compact is None else compact:
+            stage1_passed_mgf, stage1_store = compact_stage2_input(
+                stage1_passed_mgf, stage1_store, queries_dict, stage1_queries(queries_dict), mgf_digest,
+                result_cache, task_id,
+            )
+
+        report("stage2", 0.0, "Running MassQL for filtered scans")
+        try:
+            massql_results = massql_launch.run_massql_tree(
+                stage1_passed_mgf,
+                queries_dict,
+                classification_tree,
+                full_evaluation=full_evaluation,
+                workers=workers,
+                result_cache=result_cache,
+                task_id=task_id,
+                store=stage1_store,
+                progress_callback=lambda finished, total: report(
+                    "stage2", finished / max(total, 1), f"{finished} of {total} queries evaluated"
+                ),
+                run_report=query_report,
+            )
+        finally:
+            if stage1_passed_mgf is not None and os.path.exists(stage1_passed_mgf):
+                massql_launch.remove_feather_cache(stage1_passed_mgf)
+
+    logging.info(f"Task {task_id}: {query_report.summary()}")
+
+    # Scans the cleaned MGF gives a number to are reported with their SCANS= value, like all_scans
+    renamed = renamed_scans(all_mgf_scans)
+    if renamed:
+        massql_results = [
+            {"query": result["query"], "scan_list": [renamed.get(scan, scan) for scan in result["scan_list"]]}
+            for result in massql_results
+        ]
+
+    return {
+        "library_matches": library_matches,
+        "all_scans": all_mgf_scans,
+        "massql_results": massql_results,
+        "query_report": query_report,
+    }
+
+
+def process_results(
+    massql_results_df: List, library_matches: pd.DataFrame, all_scans: List[str]
+):
+    """
+    Process results and include scans without library matches in full_table output.
+
+    The hits are kept as a scans x queries boolean matrix (QueryHitMatrix), the library
+    join and the query_validation column are derived from it without exploding and
+    regrouping one row per hit.
+
+    Args:
+        massql_results_df: List of MassQL results
+        library_matches: DataFrame with library matches
+        all_scans: List of all scan numbers as strings
+
+    Returns:
+        tuple: (library_matches_only, full_table, query_hit_matrix). One row per hit is
+            query_hit_matrix.long_format, when needed.
+    """
+    massql_results = normalize_massql_results(massql_results_df)
+
+    library_matches["#Scan#"] = library_matches["#Scan#"].astype(str)
+    all_scans = [str(scan) for scan in all_scans]
+    query_hit_matrix = QueryHitMatrix.from_massql_results(
+        massql_results, all_scans + library_matches["#Scan#"].tolist()
+    )
+
+    # Library matches only, one row per library match and matched query
+    positions, query_names = query_hit_matrix.long_format(
+        query_hit_matrix.rows(library_matches["#Scan#"])
+    )
+    library_matches_only = library_matches.iloc[positions].reset_index(drop=True)
+    library_matches_only["query_validation"] = query_names
+
+    # One row per scan of the MGF, sorted by scan like the former groupby
+    full_scans = np.unique(np.asarray(all_scans, dtype=str))
+    full_table = pd.DataFrame({
+        "#Scan#": full_scans,
+        "query_validation": query_hit_matrix.query_validation(query_hit_matrix.rows(full_scans)),
+    })
+    # First non-empty value of every library column per scan
+    library_by_scan = library_matches.groupby("#Scan#", sort=False).first()
+    full_table = full_table.merge(library_by_scan, left_on="#Scan#", right_index=True, how="left")
+    full_table = full_table[
+        ["#Scan#", "query_validation", "Compound_Name"]
+        + [col for col in full_table.columns if col not in ["#Scan#", "query_validation", "Compound_Name"]]
+    ].reset_index(drop=True)
+
+    return library_matches_only, full_table, query_hit_matrix
+
+
+def get_bile_acids_classifications(results_df, exclude_string: str, classification_tree: dict,
+                                   query_hit_matrix: QueryHitMatrix = None):
+    passed_queries = results_df[
+        ~results_df["query_validation"].str.contains(exclude_string, case=False)
+    ].copy()
+    rows = query_hit_matrix.rows(passed_queries["#Scan#"]) if query_hit_matrix is not None else None
+    if rows is not None and (rows >= 0).all():
+        # All scans at once from the hit matrix, one tree walk per distinct hit pattern
+        classifications = compile_tree(classification_tree).classify_batch(
+            query_hit_matrix.hits[rows], query_hit_matrix.queries
+        )
+        passed_queries["classification"] = [result["satisfied_paths"] for result in classifications]
+    else:
+        passed_queries["classification"] = passed_queries["query_validation"].apply(
+            lambda x: check_classification_paths(str(x).split(";"), classification_tree)[
+                "satisfied_paths"
+            ]
+        )
+    filtered_classifications = passed_queries[
+        passed_queries["classification"].apply(lambda x: bool(x))
+    ]
+
+    return filtered_classifications
+
+
+def table_digest(table: pd.DataFrame) -> str:
+    """sha256 digest of the content of a table (values, index and column names)."""
+    digest = hashlib.sha256(json.dumps([str(column) for column in table.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(table, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+def derive_result_views(full_table: pd.DataFrame, only_library_matches: pd.DataFrame, classification_tree: dict,
+                        query_hit_matrix: QueryHitMatrix = None, exclude_string: str = "did not pass") -> dict:
+    """
+    Everything the results page shows that only depends on the result tables.
+
+    The app computes it once per analysis result (keyed by the table_digest of both
+    tables) instead of on every rerun. The input tables are not modified.
+
+    Returns:
+        dict: "full_table" (missing compound names as "No match"), "classifications" (the
+            classified scans, see get_bile_acids_classifications), "feature_ids" (scan ->
+            compound name of the classified scans, sorted by name), "classification_by_scan"
+            (scan -> satisfied paths), and "library_matches_view" and "full_table_view"
+            (the tables with the classification, RESULT_VIEW_COLUMNS first).
+    """
+    full_table = full_table.assign(Compound_Name=full_table["Compound_Name"].fillna("No match"))
+    classifications = get_bile_acids_classifications(
+        full_table,
+        exclude_string=exclude_string,
+        classification_tree=classification_tree,
+        query_hit_matrix=query_hit_matrix,
+    )
+    feature_ids = classifications[["#Scan#", "Compound_Name"]].astype(str).set_index("#Scan#")["Compound_Name"]
+    feature_ids = dict(sorted(feature_ids.to_dict().items(), key=lambda item: item[1]))
+
+    def with_classification(table):
+        table = table.merge(classifications[["#Scan#", "classification"]], on="#Scan#", how="left")
+        return table[RESULT_VIEW_COLUMNS + [col for col in table.columns if col not in RESULT_VIEW_COLUMNS]]
+
+    return {
+        "full_table": full_table,
+        "classifications": classifications,
+        "feature_ids": feature_ids,
+        "classification_by_scan": dict(zip(classifications["#Scan#"].astype(str), classifications["classification"])),
+        "library_matches_view": with_classification(only_library_matches),
+        "full_table_view": with_classification(full_table),
+    }
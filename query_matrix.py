@@ -0,0 +1,96 @@
+import ast
+from dataclasses import dataclass
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+# query_validation of scans no query matched
+NO_MATCH_VALIDATION = "Did not pass stage1 filtering"
+
+
+def normalize_massql_results(massql_results: List[dict]) -> List[dict]:
+    """Parse scan lists stored as strings (e.g. read back from CSV) into lists."""
+    return [
+        {"query": result["query"],
+         "scan_list": ast.literal_eval(result["scan_list"]) if isinstance(result["scan_list"], str)
+         else result["scan_list"]}
+        for result in massql_results
+    ]
+
+
+@dataclass
+class QueryHitMatrix:
+    """
+    Boolean matrix of MassQL hits, one row per scan and one column per query.
+
+    Rows are sorted by scan id (as strings, like a groupby on "#Scan#"), columns are in the
+    order of the MassQL results. String views such as the query_validation column are built
+    from it once per distinct combination of queries instead of once per scan.
+    """
+    scans: np.ndarray  # str, one per row, sorted
+    queries: List[str]
+    hits: np.ndarray   # bool, (len(scans), len(queries))
+
+    @classmethod
+    def from_massql_results(cls, massql_results: List[dict], scans: Iterable = None) -> "QueryHitMatrix":
+        """
+        Build the matrix from [{"query": query_name, "scan_list": [scan, ...]}, ...].
+
+        Args:
+            massql_results (list): Results of run_massql/run_massql_tree.
+            scans (iterable, optional): Scan ids of the rows. Defaults to every scan that
+                matched a query, hits on scans that are not rows are dropped.
+        """
+        massql_results = normalize_massql_results(massql_results)
+        scan_lists = [np.asarray([str(scan) for scan in result["scan_list"]], dtype=str)
+                      for result in massql_results]
+        if scans is None:
+            scans = np.concatenate(scan_lists) if scan_lists else np.empty(0, dtype=str)
+        row_scans = np.unique(np.asarray([str(scan) for scan in scans], dtype=str))
+
+        hits = np.zeros((len(row_scans), len(massql_results)), dtype=bool)
+        row_index = pd.Index(row_scans)
+        for column, scan_list in enumerate(scan_lists):
+            rows = row_index.get_indexer(scan_list)
+            hits[rows[rows >= 0], column] = True
+        return cls(row_scans, [result["query"] for result in massql_results], hits)
+
+    def rows(self, scans: Iterable) -> np.ndarray:
+        """Row of every scan id in scans, -1 for scans that are not in the matrix."""
+        return pd.Index(self.scans).get_indexer([str(scan) for scan in scans])
+
+    def query_validation(self, rows: np.ndarray = None, empty: str = NO_MATCH_VALIDATION) -> np.ndarray:
+        """
+        ";"-joined names of the matched queries for every row (or the given rows).
+
+        Rows without any hit get empty. Each distinct hit pattern is joined only once.
+        """
+        hits = self.hits if rows is None else self.hits[rows]
+        if len(hits) == 0:
+            return np.empty(0, dtype=object)
+        patterns, inverse = np.unique(np.packbits(hits, axis=1), axis=0, return_inverse=True)
+        queries = np.asarray(self.queries, dtype=object)
+        labels = np.empty(len(patterns), dtype=object)
+        for pattern_index, pattern in enumerate(np.unpackbits(patterns, axis=1, count=len(self.queries)).astype(bool)):
+            labels[pattern_index] = ";".join(queries[pattern]) if pattern.any() else empty
+        return labels[inverse.reshape(-1)]
+
+    def long_format(self, rows: np.ndarray) -> tuple:
+        """
+        (row position, query name) of every hit in rows, rows in the given order.
+
+        Rows without hits appear once with a NaN query, like a left merge with the exploded
+        MassQL results.
+        """
+        hits = self.hits[rows] if len(rows) else np.zeros((0, len(self.queries)), dtype=bool)
+        hits = hits & (np.asarray(rows) >= 0)[:, None]
+        hit_counts = hits.sum(axis=1)
+        positions = np.repeat(np.arange(len(rows)), np.maximum(hit_counts, 1))
+        names = np.full(len(positions), np.nan, dtype=object)
+        # Output slot of the first hit of every row, rows with hits are consecutive
+        first_slot = np.cumsum(np.maximum(hit_counts, 1)) - np.maximum(hit_counts, 1)
+        hit_rows, hit_columns = np.nonzero(hits)
+        hit_rank = np.arange(len(hit_rows)) - (np.cumsum(hit_counts) - hit_counts)[hit_rows]
+        names[first_slot[hit_rows] + hit_rank] = np.asarray(self.queries, dtype=object)[hit_columns]
+        return positions, names
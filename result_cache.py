@@ -0,0 +1,470 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+import compression
+
+# Environment variables configuring the persistent cache
+CACHE_DIR_ENV_VAR = "MASSQL_CACHE_DIR"
+CACHE_MAX_BYTES_ENV_VAR = "MASSQL_CACHE_MAX_BYTES"
+DEFAULT_CACHE_DIR = "cache"
+DEFAULT_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+# Temporary entries older than this are left over from crashed writers
+STALE_TMP_SECONDS = 6 * 3600
+# Directory of scratch_dir, for entries whose key is only known once they are written
+SCRATCH_KIND = "scratch"
+# Suffix and lock file of partial_dir
+PARTIAL_DIR_SUFFIX = ".tmp-partial"
+PARTIAL_LOCK_FILE = ".lock"
+# Lock file of every entry, held shared by the processes using it (see ResultCache.use)
+IN_USE_FILE = ".in-use"
+# Task id of an entry written inside ResultCache.use
+TASK_FILE = ".task"
+# Counters of evicted and reclaimed entries, shared by every process using the cache
+STATS_FILE = "stats.json"
+STATS_COUNTERS = ("evicted_entries", "evicted_bytes", "skipped_in_use", "reclaimed_orphans", "reclaimed_bytes")
+# The size of the cache is only measured again (walking every entry) after this long,
+# between walks it is tracked from the entries written by this process
+SIZE_RESYNC_SECONDS = 600
+
+
+def text_digest(text: str) -> str:
+    """sha256 hex digest of a string, e.g. a MassQL query."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_digest(path: str, chunk_size: int = 4 * 1024 * 1024) -> str:
+    """sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _directory_size(path: str) -> int:
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                pass
+    return total
+
+
+class ResultCache:
+    """
+    Content-addressed cache directory shared by processes and containers.
+
+    Every entry is a directory cache_dir/<kind>/<key[:2]>/<key>/ holding one or more files.
+    Entries are written to a temporary directory and renamed into place, so readers never
+    see partial entries and concurrent writers of the same key are harmless. Reading an entry
+    refreshes its mtime; when the total size goes over max_bytes the least recently used
+    entries are removed.
+
+    The total size is measured by walking the cache on the first write, then kept as a
+    ledger that every put adds the new entry to. The cache is only walked again when the
+    ledger goes over max_bytes, or after SIZE_RESYNC_SECONDS to catch the writes of other
+    processes.
+
+    Entries read or written inside a use() block are pinned until the block ends, eviction
+    never removes an entry a run (in any process) still uses. usage() reports the size per
+    kind and per task, and how many entries were evicted so far.
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None):
+        self.cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV_VAR, DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get(CACHE_MAX_BYTES_ENV_VAR, DEFAULT_CACHE_MAX_BYTES))
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size = None  # bytes, as of the last walk plus the entries written since
+        self._size_time = 0.0
+        self._local = threading.local()  # use() block of the current thread
+        self._pins = {}  # entry path -> [locked IN_USE_FILE, number of use() blocks holding it]
+        self._pins_lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Build a cache key from any number of parts (task id, digests, flags, ...)."""
+        return text_digest("\0".join(str(part) for part in parts))
+
+    def entry_path(self, kind: str, key: str) -> str:
+        return os.path.join(self.cache_dir, kind, key[:2], key)
+
+    def get(self, kind: str, key: str) -> Optional[str]:
+        """Return the entry directory if it exists, and mark it as recently used."""
+        path = self.entry_path(kind, key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        if self._scope() is not None and not self._pin(path):
+            # Evicted in the meantime
+            return None
+        return path
+
+    def put(self, kind: str, key: str, writer: Callable[[str], None]) -> str:
+        """
+        Create an entry by calling writer(directory) on an empty temporary directory.
+
+        Returns:
+            str: The entry directory. If another process stored the same key first, its
+                entry is kept and returned.
+        """
+        path = self.entry_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp_path)
+        try:
+            writer(tmp_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        return self.adopt(kind, key, tmp_path)
+
+    def adopt(self, kind: str, key: str, directory: str) -> str:
+        """
+        Move a directory written by the caller into place as an entry, like put.
+
+        Args:
+            directory (str): From scratch_dir or partial_dir, on the same file system as
+                the cache. It is removed if another process stored the same key first.
+
+        Returns:
+            str: The entry directory.
+        """
+        path = self.entry_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        scope = self._scope()
+        if scope is not None and scope["task_id"]:
+            with open(os.path.join(directory, TASK_FILE), "w") as f:
+                f.write(scope["task_id"])
+        try:
+            os.rename(directory, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            # Someone else finished the same entry first
+            shutil.rmtree(directory, ignore_errors=True)
+        if scope is not None:
+            self._pin(path)
+        self._account(path)
+        return path
+
+    @contextlib.contextmanager
+    def use(self, task_id: str = ""):
+        """
+        Pin every entry this thread gets or writes until the block ends, and tag the new
+        ones with task_id (see usage).
+
+        A pinned entry holds a shared lock on its IN_USE_FILE; evict only removes entries
+        it can lock exclusively, so the files of an in-flight run are never deleted under
+        it. The entries are reference counted per process, an entry stays pinned until the
+        last block holding it ends, and the locks go away with a crashed process. Nested
+        blocks belong to the outermost one.
+        """
+        if self._scope() is not None:
+            yield
+            return
+        self._local.scope = {"task_id": task_id, "paths": set()}
+        try:
+            yield
+        finally:
+            paths, self._local.scope = self._local.scope["paths"], None
+            with self._pins_lock:
+                for path in paths:
+                    pin = self._pins[path]
+                    pin[1] -= 1
+                    if pin[1] == 0:
+                        pin[0].close()
+                        del self._pins[path]
+
+    def current_use(self) -> Optional[dict]:
+        """The use() block of this thread, None outside of one (see join_use)."""
+        return self._scope()
+
+    @contextlib.contextmanager
+    def join_use(self, block: Optional[dict]):
+        """
+        Make the entries this thread gets or writes part of block, a current_use() of another
+        thread: they are tagged with its task id and pinned until it ends. For work a use()
+        block hands to other threads, e.g. future callbacks, which must finish before it ends.
+        """
+        previous = self._scope()
+        self._local.scope = block
+        try:
+            yield
+        finally:
+            self._local.scope = previous
+
+    def _scope(self) -> Optional[dict]:
+        return getattr(self._local, "scope", None)
+
+    def _pin(self, path: str) -> bool:
+        """Pin an entry for the use() block of this thread, False if the entry is gone."""
+        scope = self._scope()
+        with self._pins_lock:
+            if path in scope["paths"]:
+                return True
+            if path not in self._pins:
+                try:
+                    lock_file = open(os.path.join(path, IN_USE_FILE), "a")
+                except FileNotFoundError:
+                    return False
+                # Waits while an evict holding the exclusive lock removes the entry
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                try:
+                    removed = os.stat(lock_file.name).st_ino != os.fstat(lock_file.fileno()).st_ino
+                except FileNotFoundError:
+                    removed = True
+                if removed:
+                    lock_file.close()
+                    return False
+                self._pins[path] = [lock_file, 0]
+            self._pins[path][1] += 1
+            scope["paths"].add(path)
+        return True
+
+    @staticmethod
+    def _remove_unused(path: str, lock_name: str = IN_USE_FILE) -> bool:
+        """Remove an entry unless some process holds its lock file, True if it was removed."""
+        try:
+            lock_file = open(os.path.join(path, lock_name), "a")
+        except FileNotFoundError:
+            return True
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            shutil.rmtree(path, ignore_errors=True)
+        return True
+
+    def _account(self, path: str):
+        """Add a written entry to the size ledger, and evict if the cache is over max_bytes."""
+        if self._size is None or time.time() - self._size_time > SIZE_RESYNC_SECONDS:
+            self.evict(keep=path)
+            return
+        self._size += _directory_size(path)
+        if self._size > self.max_bytes:
+            self.evict(keep=path)
+
+    def scratch_dir(self) -> str:
+        """
+        New empty directory in the cache, for an entry whose key is only known once it is
+        written (see adopt). Removed like a stale temporary entry if it is never adopted.
+        """
+        path = os.path.join(self.cache_dir, SCRATCH_KIND, "00", f"entry.tmp-{uuid.uuid4().hex}")
+        os.makedirs(path)
+        return path
+
+    @contextlib.contextmanager
+    def partial_dir(self, kind: str, key: str):
+        """
+        Directory for the files of an entry that is still being downloaded (see adopt).
+
+        The same directory is given to every attempt, so an interrupted download can
+        continue where the previous one stopped. It is locked while in use: a process
+        asking for it while another one fills it waits, and gets None when the other
+        process stored the entry in the meantime. Removed like a stale temporary entry if
+        it is never adopted.
+
+        Yields:
+            str or None: The directory, or None if the entry exists.
+        """
+        path = f"{self.entry_path(kind, key)}{PARTIAL_DIR_SUFFIX}"
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, PARTIAL_LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.get(kind, key) is not None:
+                shutil.rmtree(path, ignore_errors=True)
+                yield None
+            else:
+                os.utime(path)
+                yield path
+
+    def get_json(self, kind: str, key: str):
+        with self.use():
+            path = self.get(kind, key)
+            if path is None:
+                return None
+            with open(os.path.join(path, "value.json"), "r") as f:
+                return json.load(f)
+
+    def put_json(self, kind: str, key: str, value) -> str:
+        def writer(directory):
+            with open(os.path.join(directory, "value.json"), "w") as f:
+                json.dump(value, f)
+        return self.put(kind, key, writer)
+
+    def get_pickle(self, kind: str, key: str):
+        with self.use():
+            path = self.get(kind, key)
+            if path is None:
+                return None
+            with compression.open_read(compression.find_file(os.path.join(path, "value.pkl"))) as f:
+                return pickle.loads(f.read())
+
+    def put_pickle(self, kind: str, key: str, value) -> str:
+        def writer(directory):
+            with compression.open_write(compression.compressed_path(os.path.join(directory, "value.pkl"))) as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return self.put(kind, key, writer)
+
+    def _entries(self, max_tmp_age: float = STALE_TMP_SECONDS):
+        """Yield (path, size, mtime) of every entry, removing temporary directories older than max_tmp_age."""
+        now = time.time()
+        for kind in os.listdir(self.cache_dir):
+            kind_path = os.path.join(self.cache_dir, kind)
+            if not os.path.isdir(kind_path):
+                continue
+            for prefix in os.listdir(kind_path):
+                prefix_path = os.path.join(kind_path, prefix)
+                try:
+                    names = os.listdir(prefix_path)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                for name in names:
+                    path = os.path.join(prefix_path, name)
+                    try:
+                        mtime = os.path.getmtime(path)
+                    except FileNotFoundError:
+                        continue
+                    if ".tmp-" in name:
+                        if now - mtime > max_tmp_age:
+                            self._reclaim(path)
+                        continue
+                    yield path, _directory_size(path), mtime
+
+    def evict(self, keep: str = None) -> int:
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+
+        Args:
+            keep (str, optional): Entry directory that must not be removed, e.g. the one
+                that was just written.
+
+        Returns:
+            int: Number of removed entries.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        removed_bytes = 0
+        in_use = 0
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            if not self._remove_unused(path):
+                in_use += 1
+                continue
+            total -= size
+            removed += 1
+            removed_bytes += size
+        self._size = total
+        self._size_time = time.time()
+        if removed or in_use:
+            self.add_stats(evicted_entries=removed, evicted_bytes=removed_bytes, skipped_in_use=in_use)
+            logging.info(f"Evicted {removed} cache entries ({in_use} kept, in use), cache size is now {total} bytes")
+        return removed
+
+    def _reclaim(self, path: str):
+        """Remove a temporary directory left over by a crashed writer, unless a download still fills it."""
+        size = _directory_size(path)
+        lock_name = PARTIAL_LOCK_FILE if path.endswith(PARTIAL_DIR_SUFFIX) else IN_USE_FILE
+        if self._remove_unused(path, lock_name):
+            self.add_stats(reclaimed_orphans=1, reclaimed_bytes=size)
+
+    def reclaim_orphans(self, max_age: float = STALE_TMP_SECONDS) -> dict:
+        """
+        Remove the temporary directories crashed writers left behind and evict down to
+        max_bytes, e.g. when a server starts.
+
+        Args:
+            max_age (float): Temporary directories younger than this may belong to a live
+                writer of another process and are kept.
+
+        Returns:
+            dict: usage() afterwards.
+        """
+        for _ in self._entries(max_tmp_age=max_age):
+            pass
+        self.evict()
+        return self.usage()
+
+    def usage(self) -> dict:
+        """
+        Current size of the cache, walking every entry, and the counters of STATS_FILE.
+
+        Returns:
+            dict: "bytes", "max_bytes", "entries", "in_use" (entries pinned by some run),
+                "kinds" and "tasks" (kind or task id -> {"bytes": ..., "entries": ...}, task
+                "" for entries written outside ResultCache.use), and the STATS_COUNTERS
+                since the cache was created.
+        """
+        usage = {"bytes": 0, "max_bytes": self.max_bytes, "entries": 0, "in_use": 0, "kinds": {}, "tasks": {}}
+        for path, size, _ in self._entries():
+            kind = os.path.relpath(path, self.cache_dir).split(os.sep)[0]
+            try:
+                with open(os.path.join(path, TASK_FILE), "r") as f:
+                    task_id = f.read().strip()
+            except FileNotFoundError:
+                task_id = ""
+            for group in (usage["kinds"].setdefault(kind, {"bytes": 0, "entries": 0}),
+                          usage["tasks"].setdefault(task_id, {"bytes": 0, "entries": 0}), usage):
+                group["bytes"] += size
+                group["entries"] += 1
+            usage["in_use"] += self._in_use(path)
+        usage.update(self._read_stats())
+        return usage
+
+    @staticmethod
+    def _in_use(path: str) -> bool:
+        # Opened read only, creating IN_USE_FILE would touch the entry and reorder the LRU
+        try:
+            fd = os.open(os.path.join(path, IN_USE_FILE), os.O_RDONLY)
+        except FileNotFoundError:
+            # Never pinned
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def _read_stats(self) -> dict:
+        try:
+            with open(os.path.join(self.cache_dir, STATS_FILE), "r") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                stats = json.loads(f.read() or "{}")
+        except FileNotFoundError:
+            stats = {}
+        return {counter: stats.get(counter, 0) for counter in STATS_COUNTERS}
+
+    def add_stats(self, **counts):
+        """Add to the counters of STATS_FILE, under a lock as every process updates them."""
+        fd = os.open(os.path.join(self.cache_dir, STATS_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        with open(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            stats = json.loads(f.read() or "{}")
+            for counter, count in counts.items():
+                stats[counter] = stats.get(counter, 0) + count
+            f.seek(0)
+            f.truncate()
+            json.dump(stats, f)
@@ -0,0 +1,172 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import compression
+from massql_fastpath import PeakCondition, _intensity_mask, compile_query
+from mgf_processing import DEFAULT_CHUNK_SIZE, PEAK_VALUE_LINE_PATTERN, PEPMASS_PATTERN, block_bytes, clean_mgf
+from spectrum_store import SpectrumStore
+
+# Environment variable to strip the peaks no query can use before stage 2 ("1")
+COMPACTION_ENV_VAR = "MASSQL_COMPACT"
+# Widening of the X dependent windows, the X values themselves are only known per query run
+VARIABLE_WINDOW_FACTOR = 1.5
+VARIABLE_WINDOW_MARGIN = 1e-6
+
+
+def use_compaction() -> bool:
+    """Whether stage 2 runs on compacted spectra (MASSQL_COMPACT, default off)."""
+    return os.environ.get(COMPACTION_ENV_VAR, "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+@dataclass
+class PeakWindow:
+    """
+    m/z window of one product ion condition, with the intensity filters of that condition.
+
+    Constant conditions have a fixed window. For X - c / X + c the window follows the
+    precursor m/z of every spectrum, since X is always within the MS2PREC=X tolerance of it.
+    """
+    condition: PeakCondition
+    precursor_condition: PeakCondition = None  # MS2PREC=X of the query, for X conditions
+
+    def bounds(self, precmz: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(low, high) of the window for peaks of spectra with the given precursor m/z."""
+        if not self.condition.uses_x:
+            values = self.condition.values(precmz)
+            tolerances = self.condition.tolerances(values)
+            return values - tolerances, values + tolerances
+        x_tolerance = (self.precursor_condition.tolerances(precmz) * VARIABLE_WINDOW_FACTOR
+                       + VARIABLE_WINDOW_MARGIN)
+        low_values = self.condition.values(precmz - x_tolerance)
+        high_values = self.condition.values(precmz + x_tolerance)
+        low_tolerances = self.condition.tolerances(low_values) * VARIABLE_WINDOW_FACTOR + VARIABLE_WINDOW_MARGIN
+        high_tolerances = self.condition.tolerances(high_values) * VARIABLE_WINDOW_FACTOR + VARIABLE_WINDOW_MARGIN
+        return low_values - low_tolerances, high_values + high_tolerances
+
+
+def compaction_windows(queries_dict: dict) -> Optional[List[PeakWindow]]:
+    """
+    The product ion windows of every query, with their intensity filters.
+
+    Returns:
+        list or None: One PeakWindow per distinct product ion condition, None when a query
+            is not supported by the vectorised engine (its peak needs are unknown, nothing
+            may be stripped).
+    """
+    windows = {}
+    for query_string in queries_dict.values():
+        compiled = compile_query(query_string)
+        if compiled is None:
+            return None
+        precursor_condition = next(
+            (condition for condition in compiled.conditions if condition.precursor and condition.uses_x), None
+        )
+        for condition in compiled.conditions:
+            if condition.precursor:
+                continue
+            key = (repr(condition), repr(precursor_condition) if condition.uses_x else None)
+            windows.setdefault(key, PeakWindow(condition, precursor_condition if condition.uses_x else None))
+    return list(windows.values())
+
+
+def keep_peaks(windows: List[PeakWindow], mz: np.ndarray, intensity: np.ndarray, intensity_norm: np.ndarray,
+               precmz: np.ndarray) -> np.ndarray:
+    """
+    Peaks some query can use, as a boolean mask.
+
+    A peak is kept if it is inside a window and passes the intensity filters of that
+    window's condition. The most intense peak of every spectrum (intensity_norm 1) is
+    always kept, so the normalised intensities and the set of spectra stay the same.
+
+    Args:
+        windows (list): From compaction_windows.
+        mz, intensity, intensity_norm (np.ndarray): One value per peak.
+        precmz (np.ndarray): Precursor m/z of the spectrum of every peak.
+    """
+    keep = intensity_norm >= 1.0
+    for window in windows:
+        low, high = window.bounds(precmz)
+        keep |= (mz > low) & (mz < high) & _intensity_mask(intensity, intensity_norm, window.condition)
+    return keep
+
+
+def compact_store(store: SpectrumStore, windows: List[PeakWindow]) -> SpectrumStore:
+    """Store with only the peaks keep_peaks keeps, every spectrum stays in it."""
+    keep = keep_peaks(windows, store.mz, store.intensity, store.intensity_norm, store.precmz[store.peak_spectrum])
+    offsets = np.zeros(len(store) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(store.peak_spectrum[keep], minlength=len(store)), out=offsets[1:])
+    return SpectrumStore(store.scans, store.precmz, offsets,
+                         store.mz[keep], store.intensity[keep], store.intensity_norm[keep])
+
+
+class _PeakLineFilter:
+    """Block consumer for clean_mgf that writes the blocks with the peak lines keep_peaks keeps."""
+
+    def __init__(self, windows: List[PeakWindow], outfile):
+        self.windows = windows
+        self.outfile = outfile
+        self.total_peaks = 0
+        self.kept_peaks = 0
+
+    def __call__(self, buffer: bytes, blocks: list):
+        block_lines = []
+        peak_lines = []  # (block, line) of every "m/z intensity" line
+        values = []
+        for block, (start, end, block_end, scan) in enumerate(blocks):
+            lines = block_bytes(buffer, start, block_end, scan).splitlines(keepends=True)
+            block_lines.append(lines)
+            for line_number, line in enumerate(lines):
+                parts = line.split()
+                if len(parts) >= 2 and PEAK_VALUE_LINE_PATTERN.match(line):
+                    peak_lines.append((block, line_number))
+                    values.extend(parts[:2])
+
+        values = np.fromiter(map(float, values), dtype=np.float64, count=len(values))
+        mz, intensity = values[0::2], values[1::2]
+        peak_block = np.fromiter((block for block, _ in peak_lines), dtype=np.int64, count=len(peak_lines))
+        # Same precursor m/z and normalisation as parse_spectra
+        precmz = np.zeros(len(blocks), dtype=np.float64)
+        for block, (start, end, _, _) in enumerate(blocks):
+            pepmass_match = PEPMASS_PATTERN.search(buffer, start, end + 1)
+            if pepmass_match is not None and pepmass_match.group(1).split():
+                precmz[block] = float(pepmass_match.group(1).split()[0])
+        block_max = np.full(len(blocks), -np.inf)
+        np.maximum.at(block_max, peak_block, intensity)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            intensity_norm = intensity / block_max[peak_block]
+        keep = keep_peaks(self.windows, mz, intensity, intensity_norm, precmz[peak_block])
+        # Zero intensity peaks are never read, the maximum is kept when the whole spectrum is zero
+        keep |= intensity == block_max[peak_block]
+        self.total_peaks += len(keep)
+        self.kept_peaks += int(keep.sum())
+
+        dropped = set(position for position, kept in zip(peak_lines, keep.tolist()) if not kept)
+        for block, lines in enumerate(block_lines):
+            self.outfile.write(b"".join(line for line_number, line in enumerate(lines)
+                                        if (block, line_number) not in dropped))
+
+
+def compact_mgf(input_mgf_path: str, output_mgf_path: str, windows: List[PeakWindow],
+                chunk_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[int, int]:
+    """
+    Write a copy of an MGF with only the peak lines some query can use (see keep_peaks).
+
+    Header lines and the order of the remaining peak lines are unchanged, so MassQL and
+    parse_spectra read the same precursor m/z, scans and normalised intensities as from
+    the input. Blocks without peaks are dropped like clean_mgf does.
+
+    Returns:
+        tuple: (peaks in the input, peaks written).
+    """
+    with compression.open_write(output_mgf_path, chunk_size) as outfile:
+        peak_filter = _PeakLineFilter(windows, outfile)
+        # The blocks come from clean_mgf, its own output is not needed
+        clean_mgf(input_mgf_path, os.devnull, chunk_size=chunk_size, block_consumer=peak_filter)
+    logging.getLogger(__name__).info(
+        f"Compacted {input_mgf_path}: kept {peak_filter.kept_peaks} of {peak_filter.total_peaks} peaks"
+    )
+    return peak_filter.total_peaks, peak_filter.kept_peaks
@@ -0,0 +1,130 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Arrays of a store, each saved as <column>.npy by SpectrumStore.save
+STORE_COLUMNS = ("scans", "precmz", "offsets", "mz", "intensity", "intensity_norm")
+
+
+@dataclass
+class SpectrumStore:
+    """
+    Columnar view of MS2 spectra: flat peak arrays plus per-spectrum offsets.
+
+    The peaks of spectrum k are mz[offsets[k]:offsets[k + 1]] (same for intensity and
+    intensity_norm) and are sorted by m/z. scans and precmz hold one value per spectrum.
+    """
+    scans: np.ndarray           # int64, one per spectrum
+    precmz: np.ndarray          # float64, one per spectrum
+    offsets: np.ndarray         # int64, n_spectra + 1
+    mz: np.ndarray              # float64, one per peak
+    intensity: np.ndarray       # float64, one per peak
+    intensity_norm: np.ndarray  # float64, intensity / max intensity of the spectrum
+    source: Optional[str] = None  # directory the store was loaded from, see load
+
+    def __len__(self):
+        return len(self.scans)
+
+    @property
+    def peak_spectrum(self) -> np.ndarray:
+        """Index of the owning spectrum for every peak."""
+        return np.repeat(np.arange(len(self.scans)), np.diff(self.offsets))
+
+    def spectrum_indices(self, scans) -> np.ndarray:
+        """Indices of the spectra whose scan number is in scans."""
+        wanted = np.fromiter((int(scan) for scan in scans), dtype=np.int64)
+        return np.flatnonzero(np.isin(self.scans, wanted))
+
+    def take(self, spectra: np.ndarray) -> "SpectrumStore":
+        """New store with the given spectra (indices into this store), in that order."""
+        spectra = np.asarray(spectra, dtype=np.int64)
+        starts = self.offsets[spectra]
+        counts = self.offsets[spectra + 1] - starts
+        offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        peaks = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        return SpectrumStore(self.scans[spectra], self.precmz[spectra], offsets,
+                             self.mz[peaks], self.intensity[peaks], self.intensity_norm[peaks])
+
+    def digest(self) -> str:
+        """sha256 hex digest of the content of the store, e.g. for cache keys."""
+        digest = hashlib.sha256()
+        for column in STORE_COLUMNS:
+            values = np.ascontiguousarray(getattr(self, column))
+            digest.update(f"{column}:{values.dtype.str}:{len(values)}".encode("utf-8"))
+            digest.update(memoryview(values).cast("B"))
+        return digest.hexdigest()
+
+    def save(self, directory: str):
+        """Write every column as directory/<column>.npy, see load."""
+        os.makedirs(directory, exist_ok=True)
+        for column in STORE_COLUMNS:
+            np.save(os.path.join(directory, f"{column}.npy"), np.ascontiguousarray(getattr(self, column)))
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "SpectrumStore":
+        """
+        Load a store written by save.
+
+        With mmap the columns are read-only memory maps of the files, so processes loading
+        the same directory share one copy of the peaks in the page cache.
+        """
+        mmap_mode = "r" if mmap else None
+        columns = {column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode=mmap_mode)
+                   for column in STORE_COLUMNS}
+        return cls(**columns, source=directory)
+
+    @classmethod
+    def concatenate(cls, stores: List["SpectrumStore"]) -> "SpectrumStore":
+        """Store with the spectra of all stores, one after the other."""
+        if not stores:
+            return cls.from_ms2_df(pd.DataFrame())
+        offsets = [np.zeros(1, dtype=np.int64)]
+        peak_total = 0
+        for store in stores:
+            offsets.append(store.offsets[1:] + peak_total)
+            peak_total += store.offsets[-1]
+        return cls(
+            scans=np.concatenate([store.scans for store in stores]),
+            precmz=np.concatenate([store.precmz for store in stores]),
+            offsets=np.concatenate(offsets),
+            mz=np.concatenate([store.mz for store in stores]),
+            intensity=np.concatenate([store.intensity for store in stores]),
+            intensity_norm=np.concatenate([store.intensity_norm for store in stores]),
+        )
+
+    @classmethod
+    def from_ms2_df(cls, ms2_df: pd.DataFrame) -> "SpectrumStore":
+        """
+        Build a store from the ms2_df MassQL loads (columns scan, mz, i, i_norm, precmz).
+
+        Using MassQL's own data frame keeps its parsing rules (dropped zero intensity peaks,
+        normalisation to the spectrum maximum) identical for both engines.
+        """
+        if len(ms2_df) == 0:
+            empty_float = np.empty(0, dtype=np.float64)
+            return cls(np.empty(0, dtype=np.int64), empty_float, np.zeros(1, dtype=np.int64),
+                       empty_float, empty_float, empty_float)
+
+        codes, scans = pd.factorize(ms2_df["scan"].astype(np.int64), sort=False)
+        mz = ms2_df["mz"].to_numpy(dtype=np.float64)
+        order = np.lexsort((mz, codes))
+        codes = codes[order]
+
+        counts = np.bincount(codes, minlength=len(scans))
+        offsets = np.zeros(len(scans) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        precmz = ms2_df["precmz"].to_numpy(dtype=np.float64)[order][offsets[:-1]]
+
+        return cls(
+            scans=np.asarray(scans, dtype=np.int64),
+            precmz=precmz,
+            offsets=offsets,
+            mz=mz[order],
+            intensity=ms2_df["i"].to_numpy(dtype=np.float64)[order],
+            intensity_norm=ms2_df["i_norm"].to_numpy(dtype=np.float64)[order],
+        )
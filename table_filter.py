@@ -0,0 +1,114 @@
+import re
+from collections import OrderedDict
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Search terms with one of these characters are regular expressions, like in str.contains
+REGEX_CHARACTERS = set(".^$*+?{}[]\\|()")
+# Masks of (column, term) searches kept per table
+FILTER_CACHE_SIZE = 256
+
+
+class TableFilter:
+    """
+    Case-insensitive "contains" filters over the columns of one table, as
+    table[column].str.contains(term, case=False, na=False) but cached.
+
+    The string values of a column are lowercased once, on its first search. The mask of
+    every (column, term) search is kept, and a new literal term is only looked for in the
+    rows matching the most selective cached term it contains: typing "chol" after "cho"
+    only scans the rows that contain "cho". Several filters are combined by intersecting
+    their masks, the table itself is never copied. The sort order of every column is
+    computed once as well, the filtered rows are put in that order by indexing.
+    """
+
+    def __init__(self, table: pd.DataFrame, max_cached_masks: int = FILTER_CACHE_SIZE):
+        self.table = table
+        self.max_cached_masks = max_cached_masks
+        self._strings = {}  # column -> (values as str or None, lowercased values)
+        self._masks = OrderedDict()  # (column, term) -> boolean mask over the rows
+        self._orders = {}  # (column, ascending) -> row positions in sorted order
+
+    def _column_strings(self, column: str) -> Tuple[pd.Series, pd.Series]:
+        if column not in self._strings:
+            values = self.table[column]
+            if values.dtype == object:
+                # Like the .str accessor, values that are not strings (lists, NaN) never match
+                strings = values.where(values.map(lambda value: isinstance(value, str)), None)
+            else:
+                strings = values.astype(str).where(values.notna(), None)
+            self._strings[column] = (strings.reset_index(drop=True), strings.str.lower().reset_index(drop=True))
+        return self._strings[column]
+
+    def column_mask(self, column: str, term: str) -> np.ndarray:
+        """Rows whose value in column contains term (ignoring case), from the cache if searched before."""
+        mask = self._masks.get((column, term))
+        if mask is not None:
+            self._masks.move_to_end((column, term))
+            return mask
+
+        strings, lowered = self._column_strings(column)
+        is_regex = any(character in REGEX_CHARACTERS for character in term)
+        if is_regex:
+            try:
+                re.compile(term)
+            except re.error:
+                # Not a valid pattern while it is being typed, searched for as plain text
+                is_regex = False
+        if is_regex:
+            mask = strings.str.contains(term, case=False, na=False, regex=True).to_numpy(dtype=bool)
+        else:
+            needle = term.lower()
+            # Rows containing needle are among the rows of any cached term it contains
+            rows = None
+            for (cached_column, cached_term), cached_mask in self._masks.items():
+                if (cached_column == column and cached_term.lower() in needle
+                        and not any(character in REGEX_CHARACTERS for character in cached_term)):
+                    cached_rows = np.flatnonzero(cached_mask)
+                    if rows is None or len(cached_rows) < len(rows):
+                        rows = cached_rows
+            if rows is None:
+                rows = slice(None)
+            mask = np.zeros(len(lowered), dtype=bool)
+            mask[rows] = lowered.iloc[rows].str.contains(needle, regex=False, na=False).to_numpy(dtype=bool)
+
+        self._masks[(column, term)] = mask
+        if len(self._masks) > self.max_cached_masks:
+            self._masks.popitem(last=False)
+        return mask
+
+    def mask(self, filters: List[Tuple[str, str]]) -> np.ndarray:
+        """
+        Rows matching every (column, term) filter, filters with an empty column or term are ignored.
+
+        Returns:
+            np.ndarray: Boolean mask over the rows of the table.
+        """
+        mask = np.ones(len(self.table), dtype=bool)
+        for column, term in filters:
+            if column and term:
+                mask &= self.column_mask(column, term)
+        return mask
+
+    def sort_order(self, column: str, ascending: bool = True) -> np.ndarray:
+        """Positions of all rows sorted by column (stable, missing values last), computed once."""
+        if (column, ascending) not in self._orders:
+            values = self.table[column].reset_index(drop=True)
+            try:
+                order = values.sort_values(ascending=ascending, kind="stable", na_position="last").index
+            except TypeError:
+                # Values that cannot be compared, e.g. lists, are sorted by their text
+                strings = values.astype(str).where(values.notna(), None)
+                order = strings.sort_values(ascending=ascending, kind="stable", na_position="last").index
+            self._orders[(column, ascending)] = order.to_numpy()
+        return self._orders[(column, ascending)]
+
+    def rows(self, filters: List[Tuple[str, str]], sort_column: str = None, ascending: bool = True) -> np.ndarray:
+        """Positions of the rows matching every filter (see mask), sorted by sort_column if given."""
+        mask = self.mask(filters)
+        if not sort_column:
+            return np.flatnonzero(mask)
+        order = self.sort_order(sort_column, ascending)
+        return order[mask[order]]
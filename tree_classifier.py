@@ -1,3 +1,9 @@
+import json
+from typing import List
+
+import numpy as np
+
+
 def extract_all_paths(tree, current_path=[]):
     """
     Recursively extract all possible paths from root to leaves in the classification tree.
@@ -24,11 +30,162 @@ def extract_all_paths(tree, current_path=[]):
     return paths
 
 
+def _result_from_matches(all_matches, bile_acid_category, path_length):
+    """Apply the chimeric stage 2 rule to the per-category matches and build the result dict."""
+    if all_matches:
+        if len(all_matches) >= 2 and all([lst[-1].endswith("stage2") for lst in all_matches]):
+            pass
+        elif len(all_matches) >= 2:
+            all_matches = [max(all_matches, key=len)]
+        return {
+            'satisfied_paths': all_matches,
+            'most_specific_path': max([lst for lst in all_matches], key=len),
+            'bile_acid_category': bile_acid_category,
+            'path_length': path_length,
+        }
+    return {
+        'satisfied_paths': [],
+        'most_specific_path': None,
+        'bile_acid_category': None,
+        'path_length': 0,
+    }
+
+
+class CompiledTree:
+    """
+    Classification tree compiled once into bitmasks over node ids.
+
+    Every path prefix check_classification_paths looks at is stored per bile acid category,
+    in the order it is visited, as a bitmask of the nodes it needs. A category's match is
+    the longest satisfied prefix, the first one visited among prefixes of the same length.
+    classify_batch evaluates all prefixes for all scans at once from a query hit matrix.
+    """
+
+    def __init__(self, classification_tree: dict):
+        self.node_ids = {}
+        self.categories = []
+        self.prefixes = []  # per category: [(prefix, mask as int), ...] in visiting order
+        for path in extract_all_paths(classification_tree):
+            for node in path[1:]:
+                self.node_ids.setdefault(node, len(self.node_ids))
+            if not self.categories or self.categories[-1] != path[0]:
+                self.categories.append(path[0])
+                self.prefixes.append([])
+            path_without_category = path[1:]
+            for i in range(1, len(path_without_category)):
+                current_subset = path_without_category[:i]
+                mask = 0
+                for node in current_subset:
+                    mask |= 1 << self.node_ids[node]
+                self.prefixes[-1].append((current_subset, mask))
+
+        # Same prefixes as arrays of 64 bit words, for classify_batch
+        self.n_words = max(1, (len(self.node_ids) + 63) // 64)
+        self._prefix_words = [
+            np.array([self._to_words(mask) for _, mask in prefixes], dtype=np.uint64).reshape(-1, self.n_words)
+            for prefixes in self.prefixes
+        ]
+        self._prefix_lengths = [np.array([len(prefix) for prefix, _ in prefixes], dtype=np.int64)
+                                for prefixes in self.prefixes]
+
+    def _to_words(self, mask: int) -> list:
+        return [(mask >> (64 * word)) & 0xFFFFFFFFFFFFFFFF for word in range(self.n_words)]
+
+    def _category_best(self, category_index: int, matches_mask: int):
+        best_match = None
+        for prefix, mask in self.prefixes[category_index]:
+            if mask & matches_mask == mask and (best_match is None or len(prefix) > len(best_match)):
+                best_match = prefix
+        return best_match
+
+    def _result(self, best_prefixes: list) -> dict:
+        """Result dict from the best prefix (or None) of every category."""
+        all_matches = []
+        bile_acid_category = None
+        for category, best_match in zip(self.categories, best_prefixes):
+            if best_match:
+                all_matches.append([category] + best_match)
+                bile_acid_category = category
+        # The length is reset for every category, so it is the one of the last category
+        path_length = len(best_prefixes[-1]) if best_prefixes and best_prefixes[-1] else 0
+        return _result_from_matches(all_matches, bile_acid_category, path_length)
+
+    def classify(self, matches) -> dict:
+        """Same result as check_classification_paths(matches, tree)."""
+        matches_mask = 0
+        for match in set(matches):
+            if match in self.node_ids:
+                matches_mask |= 1 << self.node_ids[match]
+        return self._result([self._category_best(index, matches_mask) for index in range(len(self.categories))])
+
+    def classify_batch(self, hits: np.ndarray, queries: List[str]) -> List[dict]:
+        """
+        Classify many scans at once.
+
+        Args:
+            hits (np.ndarray): Boolean (n_scans, len(queries)) matrix, e.g. QueryHitMatrix.hits.
+            queries (list): Query name of every column.
+
+        Returns:
+            list: One result dict per row, as check_classification_paths returns for the
+                names of the queries the row matched.
+        """
+        hits = np.asarray(hits, dtype=bool)
+        scan_words = np.zeros((len(hits), self.n_words), dtype=np.uint64)
+        for column, query in enumerate(queries):
+            node_id = self.node_ids.get(query)
+            if node_id is not None:
+                bit = np.uint64(1 << (node_id % 64))
+                scan_words[hits[:, column], node_id // 64] |= bit
+
+        # Index of the best prefix per scan and category, -1 if none is satisfied
+        best = np.full((len(hits), len(self.categories)), -1, dtype=np.int64)
+        for category_index, (prefix_words, lengths) in enumerate(zip(self._prefix_words, self._prefix_lengths)):
+            if len(lengths) == 0:
+                continue
+            satisfied = np.all((scan_words[:, None, :] & prefix_words[None, :, :]) == prefix_words[None, :, :], axis=2)
+            # Longest satisfied prefix, argmax picks the first visited one among equal lengths
+            scores = np.where(satisfied, lengths[None, :], -1)
+            best_index = np.argmax(scores, axis=1)
+            found = scores[np.arange(len(hits)), best_index] >= 0
+            best[found, category_index] = best_index[found]
+
+        # Scans with the same best prefixes share the same result, build each one once
+        patterns, inverse = np.unique(best, axis=0, return_inverse=True)
+        pattern_results = [
+            self._result([self.prefixes[category_index][prefix_index][0] if prefix_index >= 0 else None
+                          for category_index, prefix_index in enumerate(pattern)])
+            for pattern in patterns.tolist()
+        ]
+        return [
+            dict(result,
+                 satisfied_paths=[list(path) for path in result['satisfied_paths']],
+                 most_specific_path=result['most_specific_path'] and list(result['most_specific_path']))
+            for result in (pattern_results[pattern_index] for pattern_index in inverse.reshape(-1).tolist())
+        ]
+
+
+_compiled_trees = {}
+
+
+def compile_tree(classification_tree: dict) -> CompiledTree:
+    """CompiledTree for classification_tree, compiled once per distinct tree."""
+    tree_key = json.dumps(classification_tree, sort_keys=False)
+    compiled = _compiled_trees.get(tree_key)
+    if compiled is None:
+        compiled = _compiled_trees[tree_key] = CompiledTree(classification_tree)
+    return compiled
+
+
 def check_classification_paths(matches, classification_tree):
     """
     Find the single most specific path that matches the given classifications.
     Returns the most complete match possible, including the bile acid category name.
 
+    Per bile acid category the longest path prefix (without the leaf) whose nodes are all
+    in matches is kept. If several categories match, they are all reported when every one
+    ends in a stage 2 query (potentially chimeric spectrum), otherwise only the longest.
+
     Args:
         matches (list): List of classification matches for a compound
         classification_tree (dict): Hierarchical classification structure
@@ -36,67 +193,9 @@ def check_classification_paths(matches, classification_tree):
     Returns:
         dict: Results showing the most specific satisfied path with bile acid category
     """
+    return compile_tree(classification_tree).classify(matches)
 
-    # Extract all paths from the classification tree
-    all_paths = extract_all_paths(classification_tree)
-
-    matches_set = set(matches)  # Convert to set once for efficiency
-
-    best_match = None
-    all_matches = []
-    best_match_length = 0
-    best_match_bile_acid_category = None
-
-    for path in all_paths:
-        # Keep the first element (bile acid category name) for the result
-        bile_acid_category = path[0]
-        # Resets best_match to look for other possible classifications
-        if bile_acid_category != best_match_bile_acid_category:
-            if best_match:
-                all_matches.append([best_match_bile_acid_category] + best_match)
-            best_match = None
-            best_match_length = 0
-        # Remove the first element for matching logic
-        path_without_category = path[1:]
-
-        # Find the most complete match by checking from full path backwards
-        for i in range(1, len(path_without_category)):
-            current_subset = path_without_category[:i]
-
-            # Check if this subset of the path has all elements in matches
-            if set(current_subset).issubset(matches_set) and best_match != current_subset:
-                # If this is a better (longer) match, update our best match
-                if len(current_subset) > best_match_length:
-                    best_match = current_subset
-                    best_match_length = len(current_subset)
-                    best_match_bile_acid_category = bile_acid_category
-                # break
-
-    # Append the final best_match if it exists
-    if best_match:
-        all_matches.append([best_match_bile_acid_category] + best_match)
-
-    # Prepare results
-    if all_matches:
-        if len(all_matches) >= 2 and all([lst[-1].endswith("stage2") for lst in all_matches]):
-            pass
-        elif len(all_matches) >= 2:
-            all_matches = [max(all_matches, key=len)]
-        results = {
-            'satisfied_paths': all_matches,
-            'most_specific_path': max([lst for lst in all_matches], key=len),
-            'bile_acid_category': best_match_bile_acid_category,
-            'path_length': best_match_length,
-        }
-    else:
-        results = {
-            'satisfied_paths': [],
-            'most_specific_path': None,
-            'bile_acid_category': None,
-            'path_length': 0,
-        }
 
-    return results
 if __name__ == '__main__':
     from utils import bile_acid_tree
     # classification = ['Monohydroxy', "", 'Monohydroxy_stage1', 'Monohydroxy_stage2', 'Mono-7b-OH']
@@ -1,115 +1,212 @@
+from collections import OrderedDict
 from typing import List
 
+import numpy as np
 import plotly.graph_objects as go
 from utils import bile_acid_tree
 
 
+# Node colors per tree level, the last one is used for deeper levels
+LEVEL_COLORS = [
+    'rgba(46, 125, 50, 0.8)',    # Forest green - root level
+    'rgba(0, 150, 136, 0.8)',    # Teal - stage level
+    'rgba(3, 169, 244, 0.8)',    # Light blue - intermediate
+    'rgba(63, 81, 181, 0.8)',    # Indigo - specific compounds
+    'rgba(156, 39, 176, 0.8)',   # Purple -
+    'rgba(233, 30, 99, 0.8)',    # Pink - final level
+]
+HIGHLIGHT_NODE_COLOR = 'rgba(255, 107, 107, 0.9)'  # Bright red for highlighted path
+HIGHLIGHT_LINK_COLOR = 'rgba(255, 107, 107, 0.5)'  # Red for highlighted links
+LINK_COLOR = 'rgba(200, 200, 200, 0.4)'  # Default gray
+# Highlighted figures kept per path, flipping between features does not recolor them again
+FIGURE_CACHE_SIZE = 256
+
+
 class BileAcidTreeVisualizer:
-    def __init__(self, tree_dict):
+    """
+    Sankey diagrams of a classification tree, optionally highlighting one path.
+
+    The topology (labels, levels and the parent of every node, in depth-first order) and
+    the base figure are built once. Highlighting a path only swaps the node and link color
+    arrays of the base figure; the recolored figures of the last FIGURE_CACHE_SIZE paths
+    are kept.
+    """
+
+    def __init__(self, tree_dict, max_cached_figures=FIGURE_CACHE_SIZE):
         self.tree_dict = tree_dict
+        self.max_cached_figures = max_cached_figures
+        labels, levels, parents = [], [], []
+        stack = [(key, value, -1, 0) for key, value in reversed(list(tree_dict.items()))]
+        while stack:
+            key, value, parent_idx, level = stack.pop()
+            current_idx = len(labels)
+            labels.append(key)
+            levels.append(level)
+            parents.append(parent_idx)
+            if isinstance(value, dict) and value:
+                stack.extend((child, grandchildren, current_idx, level + 1)
+                             for child, grandchildren in reversed(list(value.items())))
+        self.labels = np.array(labels, dtype=object)
+        self.levels = np.array(levels)
+        self.parents = np.array(parents)
+        # One link per node with a parent, from the parent to the node
+        self.link_targets = np.flatnonzero(self.parents >= 0)
+        self.link_sources = self.parents[self.link_targets]
+        self.node_colors = np.array([LEVEL_COLORS[min(level, len(LEVEL_COLORS) - 1)] for level in levels],
+                                    dtype=object)
+        # Root-to-node label path of every node -> node index, as in satisfied_paths
+        node_paths = []
+        for label, parent_idx in zip(labels, parents):
+            node_paths.append((node_paths[parent_idx] if parent_idx >= 0 else ()) + (label,))
+        self.path_index = {path: idx for idx, path in enumerate(node_paths)}
+        # ancestors[i, j]: node j is node i or one of its ancestors
+        self.ancestors = np.eye(len(labels), dtype=bool)
+        current = np.arange(len(labels))
+        while (current >= 0).any():
+            current = np.where(current >= 0, self.parents[np.maximum(current, 0)], -1)
+            self.ancestors[np.flatnonzero(current >= 0), current[current >= 0]] = True
+        self._base_figure = None
+        self._figures = OrderedDict()
+
+    def _colors(self, highlight_path=None) -> (list, list):
+        """Node and link colors, nodes of highlight_path and links between two of them in red."""
+        node_colors = self.node_colors.copy()
+        link_colors = np.full(len(self.link_targets), LINK_COLOR, dtype=object)
+        if highlight_path:
+            highlighted = np.isin(self.labels, list(highlight_path))
+            node_colors[highlighted] = HIGHLIGHT_NODE_COLOR
+            link_colors[highlighted[self.link_targets] & highlighted[self.link_sources]] = HIGHLIGHT_LINK_COLOR
+        return node_colors.tolist(), link_colors.tolist()
 
     def build_sankey_data(self, highlight_path=None):
         """Build nodes and links for Sankey diagram with optional path highlighting."""
-        nodes = []
-        links = []
-        node_dict = {}
-        node_counter = 0
-
-        def add_nodes_and_links(data, parent_idx=None, level=0):
-            nonlocal node_counter
-
-            for key, value in data.items():
-                # Add node
-                current_idx = node_counter
-                node_dict[key] = current_idx
-
-                # Color based on highlighting and level
-                if highlight_path and key in highlight_path:
-                    color = 'rgba(255, 107, 107, 0.9)'  # Bright red for highlighted path
-                else:
-                    # Different colors for different levels
-                    level_colors = [
-                        'rgba(46, 125, 50, 0.8)',    # Forest green - root level
-                        'rgba(0, 150, 136, 0.8)',    # Teal - stage level
-                        'rgba(3, 169, 244, 0.8)',    # Light blue - intermediate
-                        'rgba(63, 81, 181, 0.8)',    # Indigo - specific compounds
-                        'rgba(156, 39, 176, 0.8)',   # Purple -
-                        'rgba(233, 30, 99, 0.8)',    # Pink - final level
-                    ]
-                    color = level_colors[min(level, len(level_colors)-1)]
-
-                nodes.append({
-                    'label': key,
-                    'color': color
-                })
-                node_counter += 1
-
-                # Add link from parent with highlighting
-                if parent_idx is not None:
-                    # Highlight links that are part of the path
-                    if highlight_path and key in highlight_path:
-                        parent_key = [k for k, v in node_dict.items() if v == parent_idx][0]
-                        if parent_key in highlight_path:
-                            link_color = 'rgba(255, 107, 107, 0.5)'  # Red for highlighted links
-                        else:
-                            link_color = 'rgba(200, 200, 200, 0.4)'  # Gray for non-highlighted
-                    else:
-                        link_color = 'rgba(200, 200, 200, 0.4)'  # Default gray
-
-                    links.append({
-                        'source': parent_idx,
-                        'target': current_idx,
-                        'value': 1,
-                        'color': link_color
-                    })
-
-                # Process children recursively
-                if isinstance(value, dict) and value:
-                    add_nodes_and_links(value, current_idx, level + 1)
-
-        add_nodes_and_links(bile_acid_tree)
+        node_colors, link_colors = self._colors(highlight_path)
+        nodes = [{'label': label, 'color': color} for label, color in zip(self.labels, node_colors)]
+        links = [
+            {'source': int(source), 'target': int(target), 'value': 1, 'color': color}
+            for source, target, color in zip(self.link_sources, self.link_targets, link_colors)
+        ]
+        node_dict = {label: idx for idx, label in enumerate(self.labels)}
         return nodes, links, node_dict
 
+    def base_figure(self) -> dict:
+        """The figure without highlighting or title as a dict, validated by plotly once."""
+        if self._base_figure is None:
+            nodes, links, _ = self.build_sankey_data()
+            fig = go.Figure(data=[go.Sankey(
+                node=dict(
+                    pad=15,
+                    thickness=20,
+                    line=dict(color="black", width=0.5),
+                    label=[" <i>or</i> <br>".join(node['label'].split('|')) for node in nodes],
+                    color=[node['color'] for node in nodes],
+                    align="left",
+                ),
+                link=dict(
+                    arrowlen=15,
+                    source=[link['source'] for link in links],
+                    target=[link['target'] for link in links],
+                    value=[link['value'] for link in links],
+                    color=[link['color'] for link in links]
+                ),
+                textfont=dict(
+                    size=16,
+                    color="black",
+                    shadow="0px -0px 2px white"),
+            )])
+            fig.update_layout(
+                font_size=14,
+                width=1400,
+                height=800,
+                # title_x=0.5
+            )
+            self._base_figure = fig.to_dict()
+        return self._base_figure
+
+    def _highlighted_figure(self, highlight_path=None) -> dict:
+        """The base figure recolored for highlight_path, from the LRU of recolored figures."""
+        path_key = tuple(highlight_path or ())
+        if path_key in self._figures:
+            self._figures.move_to_end(path_key)
+            return self._figures[path_key]
+        base = self.base_figure()
+        if path_key:
+            node_colors, link_colors = self._colors(path_key)
+            sankey = base['data'][0]
+            figure = dict(base, data=[dict(
+                sankey,
+                node=dict(sankey['node'], color=node_colors),
+                link=dict(sankey['link'], color=link_colors),
+            )])
+        else:
+            figure = base
+        self._figures[path_key] = figure
+        if len(self._figures) > self.max_cached_figures:
+            self._figures.popitem(last=False)
+        return figure
+
     def create_sankey_diagram(self, highlight_path=None, title_suffix=""):
         """Create a Sankey diagram with optional path highlighting."""
-        nodes, links, node_dict = self.build_sankey_data(highlight_path)
-        
-        fig = go.Figure(data=[go.Sankey(
-            node=dict(
-                pad=15,
-                thickness=20,
-                line=dict(color="black", width=0.5),
-                label=[" <i>or</i> <br>".join(node['label'].split('|')) for node in nodes],
-                color=[node['color'] for node in nodes],
-                align="left",
-            ),
-            link=dict(
-                arrowlen=15,
-                source=[link['source'] for link in links],
-                target=[link['target'] for link in links],
-                value=[link['value'] for link in links],
-                color=[link['color'] for link in links]
-            ),
-            textfont=dict(
-                size=16,
-                color="black",
-                shadow="0px -0px 2px white"),
-        )])
-        
+        figure = self._highlighted_figure(highlight_path)
+
         title = f"Bile Acid Classification Tree{title_suffix}"
         if highlight_path:
             title += f"<br><sub>Highlighted Path: {' → '.join(highlight_path)}</sub>"
-        
-        fig.update_layout(
-            title=title,
-            font_size=14,
-            width=1400,
-            height=800,
-            # title_x=0.5
-        )
-        
-        return fig
-    
+
+        # Everything but the title comes from the validated base figure, validating it
+        # again would cost more than building it
+        return go.Figure(dict(figure, layout=dict(figure['layout'], title=dict(text=title))), _validate=False)
+
+    def node_feature_counts(self, classifications) -> np.ndarray:
+        """
+        Number of features whose classification goes through every node, in one pass.
+
+        Args:
+            classifications: Satisfied paths of every feature (the "classification" column
+                of get_bile_acids_classifications), a feature may have several. Paths that
+                are not in the tree are ignored.
+
+        Returns:
+            np.ndarray: Feature count per node, in the order of self.labels.
+        """
+        path_counts = np.array([len(paths) for paths in classifications], dtype=np.int64)
+        # Unknown paths get index -1, the last row of nodes_of_path, which goes through no node
+        end_nodes = np.array([self.path_index.get(tuple(path), -1)
+                              for paths in classifications for path in paths], dtype=np.int64)
+        nodes_of_path = np.vstack([self.ancestors, np.zeros((1, len(self.labels)), dtype=bool)])[end_nodes]
+        if len(nodes_of_path) == 0:
+            return np.zeros(len(self.labels), dtype=np.int64)
+        # The paths of a feature are consecutive; a feature counts once per node, even
+        # when two of its paths go through it
+        starts = (np.cumsum(path_counts) - path_counts)[path_counts > 0]
+        return np.logical_or.reduceat(nodes_of_path, starts, axis=0).sum(axis=0)
+
+    def create_aggregated_diagram(self, classifications, title_suffix=""):
+        """
+        Sankey diagram of all features at once, the width of a link is the number of
+        features going through the node it leads to (see node_feature_counts).
+        """
+        counts = self.node_feature_counts(classifications)
+        base = self.base_figure()
+        sankey = base['data'][0]
+        shown = counts[self.link_targets] > 0
+        labels = [f"{label} ({count})" for label, count in zip(sankey['node']['label'], counts.tolist())]
+        figure = dict(base, data=[dict(
+            sankey,
+            node=dict(sankey['node'], label=labels),
+            link=dict(
+                sankey['link'],
+                source=self.link_sources[shown].tolist(),
+                target=self.link_targets[shown].tolist(),
+                value=counts[self.link_targets[shown]].tolist(),
+                color=[LINK_COLOR] * int(shown.sum()),
+            ),
+        )])
+        title = (f"Bile Acid Classification Tree{title_suffix}"
+                 f"<br><sub>{len(classifications)} classified features</sub>")
+        # Built from the validated base figure, see create_sankey_diagram
+        return go.Figure(dict(figure, layout=dict(figure['layout'], title=dict(text=title))), _validate=False)
+
     def create_multiple_diagrams(self, paths_dict):
         """Create multiple diagrams showing different highlighted paths."""
         figs = []
@@ -135,6 +232,13 @@ def create_custom_tree(custom_path:List, path_name="Custom Path"):
     return fig
 
 
+# Overview of every classified feature
+def create_aggregated_tree(classifications, name="All Features"):
+    """Create diagram with the number of features through every node."""
+    fig = visualizer.create_aggregated_diagram(classifications, f" - {name}")
+    return fig
+
+
 # Function to easily highlight any path
 def highlight_path(path, name="Highlighted Path"):
     """Convenience function to highlight a specific path."""
@@ -1,18 +1,20 @@
-import os
-import subprocess
-import uuid
+import atexit
+import io
 import logging
-from typing import List
+from typing import Callable, List
 
 from streamlit import cache_data
 from dataclasses import dataclass
 
 import pandas as pd
 import yaml
-from gnpsdata import workflow_fbmn
+from pandas.io.formats.style import Styler
 
-import massql_launch
+import pipeline
 import streamlit as st
+from job_queue import JobQueue, JobRunner
+from result_cache import ResultCache
+from table_filter import TableFilter
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -46,92 +48,67 @@ class MassQLQueries:
 with open('bile_acid_tree.yaml', 'r') as file:
     bile_acid_tree = yaml.safe_load(file)
 
-@cache_data
-def download_and_filter_mgf(task_id: str) -> (str, str):
-    os.makedirs("temp_mgf", exist_ok=True)
-    unique_uuid = str(uuid.uuid4())
-    mgf_file_path = f"temp_mgf/{unique_uuid}_mgf_all.mgf"
-
-    logging.info("Downloading mgf...")
-    workflow_fbmn.download_mgf(task_id, mgf_file_path)
-    logging.info(f"MGF saved to {mgf_file_path}")
-
-    logging.info("Starting MGF filtering...")
-    ## Extract all scan numbers from the MGF file
-    scans_list = []
-    with open(mgf_file_path, "r") as mgf_file:
-        lines = mgf_file.readlines()
-    cleaned_mgf_lines = []
-    inside_scan = False
-    current_scan = []
-    for line in lines:
-        if line.startswith("BEGIN IONS"):
-            inside_scan = True
-            current_scan = [line]  # Start a new scan block
-        elif line.startswith("END IONS"):
-            current_scan.append(line)
-            if any(
-                    len(peak.split()) == 2
-                    and all(part.replace(".", "", 1).isdigit() for part in peak.split())
-                    for peak in current_scan
-            ):
-                cleaned_mgf_lines.extend(current_scan)
-            inside_scan = False
-        elif inside_scan:
-            current_scan.append(line)
-        else:
-            cleaned_mgf_lines.append(line)
-    # Save the cleaned MGF file
-    cleaned_mgf = f"temp_mgf/{unique_uuid}_mgf_cleaned.mgf"
-    with open(cleaned_mgf, "w") as fout:
-        fout.writelines(cleaned_mgf_lines)
-    logging.info(f"Cleaned MGF saved to {cleaned_mgf}")
+# Choices of rows per page of the result tables (see add_df_and_filtering)
+PAGE_SIZES = [50, 100, 500, 1000]
+# Results whose derived tables are kept in memory (see get_derived_results)
+DERIVED_RESULTS_CACHE_ENTRIES = 16
+
+@st.cache_resource
+def get_result_cache() -> ResultCache:
+    """Persistent cache shared by every session (and every replica mounting the same directory)."""
+    return ResultCache()
 
-    # Extract all scan numbers from the cleaned MGF file
-    with open(cleaned_mgf, "r") as mgf_file:
-        for line in mgf_file:
-            if line.startswith("SCANS="):
-                scans_list.append(line.strip().split("=")[1])
 
-    return cleaned_mgf, scans_list
+@st.cache_resource
+def get_job_runner() -> JobRunner:
+    """Job worker processes of this server (MASSQL_JOB_WORKERS of them), stopped when it exits."""
+    job_runner = JobRunner().start()
+    atexit.register(job_runner.stop)
+    return job_runner
+
+
+def get_job_queue() -> JobQueue:
+    """Queue of analysis jobs, shared by every session and served by get_job_runner's workers."""
+    job_runner = get_job_runner()
+    return JobQueue(job_runner.db_path)
+
+
+@st.cache_resource(max_entries=DERIVED_RESULTS_CACHE_ENTRIES)
+def get_derived_results(full_table_digest: str, library_matches_digest: str, has_query_hit_matrix: bool,
+                        _full_table: pd.DataFrame, _only_library_matches: pd.DataFrame,
+                        _query_hit_matrix=None) -> dict:
+    """
+    pipeline.derive_result_views of a result, computed once per digest of its tables
+    (pipeline.table_digest) and shared by every rerun and session showing it. The tables
+    are not hashed by Streamlit, their digests and whether a query hit matrix is given
+    are the key. The returned tables must not be modified.
+    """
+    return pipeline.derive_result_views(_full_table, _only_library_matches, bile_acid_tree, _query_hit_matrix)
 
 
 @cache_data
-def filter_mgf_by_scans(input_mgf_path, output_mgf_path, scans_to_keep):
+def _download_mgf(task_id: str) -> (str, str):
+    """Raw MGF of a task from the result cache, downloaded on a miss. Returns (path, sha256 digest)."""
+    return pipeline.download_mgf(task_id, get_result_cache())
+
+
+def download_and_filter_mgf(task_id: str) -> (str, str):
+    mgf_file_path, mgf_digest = _download_mgf(task_id)
+    return pipeline.clean_and_index_mgf(mgf_file_path, mgf_digest, get_result_cache(), task_id)
+
+
+def add_df_and_filtering(df, key_prefix:str, default_cols: List = None,
+                         style: Callable[[pd.DataFrame], Styler] = None) -> pd.DataFrame:
     """
-    Write a new MGF file containing only the scans in scans_to_keep.
-    :param input_mgf_path: Path to the input MGF file.
-    :param output_mgf_path: Path to the output filtered MGF file.
-    :param scans_to_keep: List of scan numbers (as strings or ints) to keep.
+    Filter fields, a page of the filtered table and its download buttons.
+
+    Filtering, sorting and paging happen here, only the rows of the current page are
+    styled (with style, if given) and sent to the browser. The downloads hold every
+    filtered row, they are only built when clicked.
+
+    Returns:
+        pd.DataFrame: The rows of the page shown.
     """
-    scans_to_keep = set(str(s) for s in scans_to_keep)
-    total_scans = 0
-    kept_scans = 0
-    with open(input_mgf_path, "r") as infile, open(output_mgf_path, "w") as outfile:
-        write_block = False
-        block_lines = []
-        for line in infile:
-            if line.strip() == "BEGIN IONS":
-                block_lines = [line]
-                write_block = False
-            elif line.startswith("SCANS="):
-                total_scans += 1
-                scan_num = line.strip().split("=")[1]
-                if scan_num in scans_to_keep:
-                    write_block = True
-                block_lines.append(line)
-            elif line.strip() == "END IONS":
-                block_lines.append(line)
-                if write_block:
-                    outfile.writelines(block_lines)
-                    kept_scans += 1
-            else:
-                block_lines.append(line)
-    logging.info(f"Total Scans: {total_scans} ** Kept: {kept_scans} scans ** Excluded: {total_scans - kept_scans}")
-    return output_mgf_path
-
-
-def add_df_and_filtering(df, key_prefix:str, default_cols: List = None) -> pd.DataFrame:
     # Session state for tracking number of filters
     if f"{key_prefix}_filter_count" not in st.session_state:
         st.session_state[f"{key_prefix}_filter_count"] = 1
@@ -145,7 +122,11 @@ def add_df_and_filtering(df, key_prefix:str, default_cols: List = None) -> pd.Da
         if st.button("➖ Remove Filter Field", use_container_width=True, key=f"{key_prefix}_rmv_btn"):
             st.session_state[f"{key_prefix}_filter_count"] -= 1
 
-    filtered_df = df.copy()
+    # Lowercased columns and search results are kept per table across reruns
+    table_filter = st.session_state.get(f"{key_prefix}_table_filter")
+    if table_filter is None or table_filter.table is not df:
+        table_filter = st.session_state[f"{key_prefix}_table_filter"] = TableFilter(df)
+    filters = []
     cols = st.columns([1, 2])  # for headers
     cols[0].markdown("**Filter Column**")
     cols[1].markdown("**Search String**")
@@ -162,12 +143,10 @@ def add_df_and_filtering(df, key_prefix:str, default_cols: List = None) -> pd.Da
                 f"Contains (Column {i+1})", key=f"{key_prefix}_search_input_{i}"
             )
 
-        if selected_col and search_term:
-            filtered_df = filtered_df[filtered_df[selected_col].str.contains(search_term, case=False, na=False)]
+        filters.append((selected_col, search_term))
 
     # Show result
     st.markdown("### 🔎 Filtered Results")
-    st.write(f"Total results: {len(filtered_df)}")
     all_cols = df.columns
     if default_cols:
         with st.expander('Cols to show'):
@@ -176,7 +155,66 @@ def add_df_and_filtering(df, key_prefix:str, default_cols: List = None) -> pd.Da
     else:
         cols_to_show = all_cols
 
-    return filtered_df[cols_to_show]
+    sort_col, order_col, size_col, page_col = st.columns(4)
+    with sort_col:
+        sort_by = st.selectbox("Sort by", [None] + list(all_cols), key=f"{key_prefix}_sort_by",
+                               format_func=lambda col: "Table order" if col is None else col)
+    with order_col:
+        descending = st.selectbox("Order", [False, True], key=f"{key_prefix}_sort_descending",
+                                  format_func=lambda value: "Descending" if value else "Ascending")
+    rows = table_filter.rows(filters, sort_by, ascending=not descending)
+    with size_col:
+        page_size = st.selectbox("Rows per page", PAGE_SIZES, key=f"{key_prefix}_page_size")
+    page_count = max(1, -(-len(rows) // page_size))
+    # Fewer pages after a filter change, stay on the last one
+    if st.session_state.get(f"{key_prefix}_page", 1) > page_count:
+        st.session_state[f"{key_prefix}_page"] = page_count
+    with page_col:
+        page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count,
+                               key=f"{key_prefix}_page")
+
+    page_rows = rows[(page - 1) * page_size:page * page_size]
+    st.write(f"Total results: {len(rows)}" + (
+        f", rows {(page - 1) * page_size + 1} to {(page - 1) * page_size + len(page_rows)}" if len(rows) else ""
+    ))
+    # Only the rows and columns of the page are copied and styled
+    page_df = df.iloc[page_rows][list(cols_to_show)]
+    st.dataframe(style(page_df) if style is not None else page_df)
+
+    csv_col, parquet_col, _, _ = st.columns(4)
+    for column, output_format, mime in ((csv_col, "csv", "text/csv"),
+                                        (parquet_col, "parquet", "application/vnd.apache.parquet")):
+        with column:
+            st.download_button(
+                f"⬇️ Download {output_format.upper()} ({len(rows)} rows)",
+                # Built on click, from the filtered and sorted rows
+                data=lambda output_format=output_format: table_export_bytes(
+                    df.iloc[rows][list(cols_to_show)], output_format
+                ),
+                file_name=f"{key_prefix}.{output_format}",
+                mime=mime,
+                on_click="ignore",
+                use_container_width=True,
+                key=f"{key_prefix}_download_{output_format}",
+            )
+    return page_df
+
+
+def table_export_bytes(df: pd.DataFrame, output_format: str) -> bytes:
+    """df as a CSV or Parquet file."""
+    buffer = io.BytesIO()
+    if output_format == "parquet":
+        df.to_parquet(buffer, index=False)
+    else:
+        df.to_csv(buffer, index=False)
+    return buffer.getvalue()
+
+
+def highlight_classification(df: pd.DataFrame) -> Styler:
+    """df with highlight_hydroxy applied to its classification column, if shown."""
+    if "classification" not in df.columns:
+        return df.style
+    return df.style.apply(highlight_hydroxy, subset=["classification"])
 
 
 def highlight_hydroxy(s):
@@ -195,18 +233,8 @@ def highlight_hydroxy(s):
 
 if __name__ == "__main__":
     task_id = "4e5f76ebc4c6481aba4461356f20bc35"
-    cleaned_mgf, scans_list = download_and_filter_mgf(task_id)
-    mgf_path = cleaned_mgf
-
-    with open('massql_queries.yaml', 'r') as file:
-        data = yaml.safe_load(file)
-        ALL_MASSQL_QUERIES = data['ALL_MASSQL_QUERIES']
-
-    only_stage1 = {key: value for key, value in ALL_MASSQL_QUERIES.items() if "stage1" in key}
-
-    stage1_all_results = massql_launch.run_massql(mgf_path, queries_dict=only_stage1)
-    stage1_results_df = pd.DataFrame(stage1_all_results)
-    scans_to_keep = set(sum(stage1_results_df['scan_list'], []))
-
-    stage1_passed_mgf = filter_mgf_by_scans(mgf_path, f"temp_mgf/{uuid.uuid4()}_scans_passed_stg1.mgf",
-                                            scans_to_keep)
+    mgf_file_path, mgf_digest = _download_mgf(task_id)
+    cleaned_mgf, scans_list, stage1_results, _, stage1_store = pipeline.prefilter_mgf(
+        mgf_file_path, mgf_digest, MassQLQueries.stage1, get_result_cache(), task_id
+    )
+    logging.info(f"{len(stage1_store)} of {len(scans_list)} scans passed stage 1")